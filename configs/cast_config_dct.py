@@ -20,8 +20,10 @@ def get_config():
             "wandb_mode": "online",
             #Tokenizers
             "language_tokenizer": "google/paligemma-3b-mix-224",
-            "action_tokenizer": f"action_tokenizer.dct(action_dim=2, time_horizon={action_horizon}, save_path='tmp', fit=True, pretrained_path=None, default_path='gs://cat-logs/action-tokenizer-dct')",
+            "action_tokenizer": f"action_tokenizer.dct(action_dim=2, time_horizon={action_horizon}, max_tokens=18, save_path='tmp', do_fit=True, pretrained_path=None)",
             "sequence_builder": "sequence_builder.default(prompt_pad_length=50, gen_pad_length=20)",
+            # Batches of actions (per host) the DCT tokenizer is fit to
+            "action_tokenizer_fit_batches": 10,
             # Initialization
             "load_fns": [
                 (
@@ -0,0 +1,97 @@
+"""
+Benchmarks PaliVLA beam search: the compiled-loop, gather-based `_beam_search`
+against the Python-driven, one-hot reordering `_beam_decode`.
+
+Usage:
+    python scripts/benchmark_beam_search.py --config configs/smoke_test.py \
+        --beam_sizes 4,8,16
+"""
+
+import time
+
+import flax.linen as nn
+import jax
+import jax.numpy as jnp
+from absl import app, flags
+from ml_collections import config_flags
+from prettytable import PrettyTable
+from scalax.sharding import PartitionSpec
+
+from benchmark_packing import make_synthetic_batch
+from palivla.predict_fns import _beam_decode, _beam_search
+from train import create_model, make_sharding
+
+
+def time_fn(fn, num_steps: int) -> float:
+    jax.block_until_ready(fn())  # Compile and warm up
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        out = fn()
+    jax.block_until_ready(out)
+    return (time.perf_counter() - start) / num_steps
+
+
+def main(_):
+    config = flags.FLAGS.config
+    sharding_metadata = make_sharding(config)
+    batch_size = flags.FLAGS.batch_size or config.batch_size
+
+    model = create_model(config, sharding_metadata)
+    batch = make_synthetic_batch(config, model, batch_size)
+    inputs, _ = model._build_predict_inputs(batch, include_action_tokens=True)
+    params = model.train_state.get_params()
+    mesh = model.sharding.mesh.mesh
+    decode_kwargs = dict(
+        model=model.train_state.model,
+        max_decode_len=inputs["gen"]["tokens"].shape[1],
+        eos_token=model.language_tokenizer.eos_token_id,
+    )
+
+    table = PrettyTable(["beam size", "implementation", "time (s)", "examples/s", "speedup"])
+    for beam_size in map(int, flags.FLAGS.beam_sizes):
+        with mesh, nn.logical_axis_rules([("act_batch", "fsdp")]):
+            baseline = time_fn(
+                lambda: _beam_decode(
+                    params,
+                    inputs,
+                    batch_valid_mask=jnp.ones((batch_size,), jnp.bool_),
+                    devices=mesh.devices.reshape(-1),
+                    beam_size=beam_size,
+                    **decode_kwargs,
+                ),
+                flags.FLAGS.num_steps,
+            )
+            compiled = time_fn(
+                lambda: _beam_search(
+                    params,
+                    inputs,
+                    mesh=mesh,
+                    out_sharding=PartitionSpec("fsdp"),
+                    beam_size=beam_size,
+                    **decode_kwargs,
+                ),
+                flags.FLAGS.num_steps,
+            )
+        for name, seconds in [("one-hot, python loop", baseline), ("gather, compiled", compiled)]:
+            table.add_row(
+                [
+                    beam_size,
+                    name,
+                    f"{seconds:.3f}",
+                    f"{batch_size / seconds:.1f}",
+                    f"{baseline / seconds:.2f}x",
+                ]
+            )
+
+    if jax.process_index() == 0:
+        print(table)
+
+
+if __name__ == "__main__":
+    config_flags.DEFINE_config_file(
+        "config", "configs/smoke_test.py", "Path to the config file."
+    )
+    flags.DEFINE_integer("batch_size", None, "Batch size (defaults to the config's).")
+    flags.DEFINE_integer("num_steps", 5, "Number of timed decodes per setting.")
+    flags.DEFINE_list("beam_sizes", ["4", "8", "16"], "Beam sizes to benchmark.")
+    app.run(main)
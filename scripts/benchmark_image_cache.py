@@ -0,0 +1,111 @@
+"""
+Benchmarks PaliVLA inference over rollouts with a history of `window_size`
+frames: encoding every frame of each observation against encoding each frame
+once with an `ImageEmbeddingCache`, optionally with image token pooling
+(`image_token_pool`). Reports the prefix length and the latency per step.
+
+Usage:
+    python scripts/benchmark_image_cache.py --config configs/smoke_test.py \
+        --window_size 4 --pools 1,2
+"""
+
+import time
+
+import numpy as np
+from absl import app, flags
+from ml_collections import config_flags
+from prettytable import PrettyTable
+
+from benchmark_packing import make_synthetic_batch
+from palivla.image_embedding_cache import ImageEmbeddingCache
+from train import create_model, make_sharding
+
+
+def make_rollout_batches(config, model, batch_size: int, window_size: int, num_steps: int):
+    """
+    Observations of `batch_size` episodes over `num_steps` steps, each holding
+    the last `window_size` frames (repeating the first one, like the dataset).
+    """
+    frames = np.random.randint(
+        0, 255, (batch_size, num_steps, 224, 224, 3), dtype=np.uint8
+    )
+    batch = make_synthetic_batch(config, model, batch_size)
+    batches = []
+    for t in range(num_steps):
+        history = np.arange(t - window_size + 1, t + 1)
+        timesteps = np.maximum(history, 0)
+        frame_ids = np.stack(
+            np.broadcast_arrays(np.arange(batch_size)[:, None], timesteps[None]), -1
+        )
+        observation = {
+            "image_primary": frames[:, timesteps],
+            "pad_mask_dict": {
+                "image_primary": np.broadcast_to(history >= 0, (batch_size, window_size))
+            },
+        }
+        batches.append((batch | {"observation": observation}, frame_ids))
+    return batches
+
+
+def main(_):
+    config = flags.FLAGS.config
+    sharding_metadata = make_sharding(config)
+    batch_size = flags.FLAGS.batch_size or config.batch_size
+    window_size = flags.FLAGS.window_size
+    action_horizon = config.dataset_kwargs.traj_transform_kwargs.action_horizon
+
+    table = PrettyTable(
+        ["pool", "image cache", "image tokens", "prefix length", "step time (s)", "speedup"]
+    )
+    baseline = None
+    for pool in map(int, flags.FLAGS.pools):
+        with config.unlocked():
+            config.model_config.image_token_pool = pool
+        model = create_model(config, sharding_metadata)
+        batches = make_rollout_batches(
+            config, model, batch_size, window_size, flags.FLAGS.num_steps
+        )
+        predict_kwargs = dict(
+            action_dim=model.action_tokenizer.action_dim, action_horizon=action_horizon
+        )
+        first_batch, first_frame_ids = batches[0]
+        embeds = ImageEmbeddingCache(model).embed_observation(
+            first_batch["observation"], first_frame_ids
+        )
+        image_tokens = window_size * embeds["image_primary_embeds"].shape[-2]
+        # Image tokens, the modality start token and the prompt.
+        prefix_length = image_tokens + 1 + model.sequence_builder.prompt_pad_length
+
+        for use_cache in (False, True):
+            cache = ImageEmbeddingCache(model) if use_cache else None
+            times = []
+            for batch, frame_ids in batches:
+                start = time.perf_counter()
+                model.predict(batch, **predict_kwargs, image_cache=cache, frame_ids=frame_ids)
+                times.append(time.perf_counter() - start)
+            # The first steps compile (and fill the cache).
+            seconds = np.mean(times[window_size:])
+            baseline = baseline or seconds
+            table.add_row(
+                [
+                    pool,
+                    "yes" if use_cache else "no",
+                    image_tokens,
+                    prefix_length,
+                    f"{seconds:.3f}",
+                    f"{baseline / seconds:.2f}x",
+                ]
+            )
+
+    print(table)
+
+
+if __name__ == "__main__":
+    config_flags.DEFINE_config_file(
+        "config", "configs/smoke_test.py", "Path to the config file."
+    )
+    flags.DEFINE_integer("batch_size", None, "Batch size (defaults to the config's).")
+    flags.DEFINE_integer("window_size", 4, "Number of frames per observation.")
+    flags.DEFINE_integer("num_steps", 16, "Number of rollout steps.")
+    flags.DEFINE_list("pools", ["1", "2"], "Image token pooling sizes to benchmark.")
+    app.run(main)
@@ -0,0 +1,115 @@
+"""
+Benchmarks memory and throughput of the PaliVLA training step under different
+mixed precision policies.
+
+Usage:
+    python scripts/benchmark_precision.py --config configs/smoke_test.py
+"""
+
+import time
+
+import jax
+import numpy as np
+from absl import app, flags
+from ml_collections import config_flags
+from prettytable import PrettyTable
+
+from train import create_model, make_sharding
+
+POLICIES = {
+    "fp32": ({}, {}),
+    "bf16_params_fp32_master": (
+        {"param_dtype": "bfloat16"},
+        {"master_weights_dtype": "float32"},
+    ),
+    "bf16_params_bf16_moments": (
+        {"param_dtype": "bfloat16"},
+        {"master_weights_dtype": "float32", "moment_dtype": "bfloat16"},
+    ),
+    "bf16_params_int8_moments": (
+        {"param_dtype": "bfloat16"},
+        {"master_weights_dtype": "float32", "moment_dtype": "int8"},
+    ),
+}
+
+
+def tree_bytes(tree):
+    return sum(x.size * x.dtype.itemsize for x in jax.tree.leaves(tree))
+
+
+def make_synthetic_batch(config, model, batch_size: int):
+    action_tokenizer = model.action_tokenizer
+    action_horizon = config.dataset_kwargs.traj_transform_kwargs.action_horizon
+    return {
+        "observation": {
+            "image_primary": np.random.randint(
+                0, 255, (batch_size, 1, 224, 224, 3), dtype=np.uint8
+            ),
+            "pad_mask_dict": {
+                "image_primary": np.ones((batch_size, 1), dtype=bool),
+            },
+        },
+        "task": {
+            "language_instruction": np.array(
+                [b"go to the kitchen and stop at the door"] * batch_size
+            ),
+            "pad_mask_dict": {
+                "language_instruction": np.ones((batch_size,), dtype=bool),
+            },
+        },
+        "action": np.random.uniform(
+            -1, 1, (batch_size, 1, action_horizon, action_tokenizer.action_dim)
+        ).astype(np.float32),
+    }
+
+
+def main(_):
+    config = flags.FLAGS.config
+    sharding_metadata = make_sharding(config)
+    batch_size = flags.FLAGS.batch_size or config.batch_size
+
+    table = PrettyTable(
+        ["policy", "params (GB)", "opt state (GB)", "step time (s)", "examples/s"]
+    )
+    for name, (model_overrides, optimizer_overrides) in POLICIES.items():
+        policy_config = config.copy_and_resolve_references()
+        policy_config.model_config.update(model_overrides)
+        policy_config.optimizer.kwargs.update(optimizer_overrides)
+        if policy_config.optimizer.kwargs.optimizer != "adamw":
+            policy_config.optimizer.kwargs.optimizer = "adamw"
+
+        model = create_model(policy_config, sharding_metadata)
+        batch = make_synthetic_batch(policy_config, model, batch_size)
+
+        # Compile and warm up
+        for _ in range(2):
+            jax.block_until_ready(model.train_step(batch))
+
+        start = time.perf_counter()
+        for _ in range(flags.FLAGS.num_steps):
+            info = model.train_step(batch)
+        jax.block_until_ready(info)
+        step_time = (time.perf_counter() - start) / flags.FLAGS.num_steps
+
+        table.add_row(
+            [
+                name,
+                f"{tree_bytes(model.train_state.params) / 1e9:.2f}",
+                f"{tree_bytes(model.train_state.opt_state) / 1e9:.2f}",
+                f"{step_time:.3f}",
+                f"{batch_size / step_time:.1f}",
+            ]
+        )
+        del model
+
+    if jax.process_index() == 0:
+        print(table)
+
+
+if __name__ == "__main__":
+    config_flags.DEFINE_config_file(
+        "config", "configs/smoke_test.py", "Path to the config file."
+    )
+    flags.DEFINE_integer("batch_size", None, "Batch size (defaults to the config's).")
+    flags.DEFINE_integer("num_steps", 10, "Number of timed steps per policy.")
+    app.run(main)
@@ -0,0 +1,106 @@
+"""
+Compares host memory of the frame shuffle buffer with encoded images stored per
+frame (the default) vs. referenced by id (`shuffle_image_refs=True`).
+
+Each mode runs in its own subprocess, fills the shuffle buffer, and reports the
+peak RSS and the frame throughput.
+
+Usage:
+    python scripts/benchmark_shuffle_memory.py --config configs/smoke_test.py \
+        --shuffle_buffer_size 100000
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from absl import app, flags
+from ml_collections import config_flags
+from prettytable import PrettyTable
+
+sys.path.append(".")
+
+MODES = {"images": False, "image_refs": True}
+
+
+def run_mode(config, shuffle_image_refs: bool) -> dict:
+    from octo.data.oxe import make_oxe_dataset_kwargs_and_weights
+    from palivla.octo.dataset import make_interleaved_dataset
+
+    kwargs = config.dataset_kwargs.to_dict()
+    if kwargs.get("oxe_kwargs") is not None:
+        dataset_kwargs_list, sample_weights = make_oxe_dataset_kwargs_and_weights(
+            **kwargs["oxe_kwargs"]
+        )
+    else:
+        dataset_kwargs_list = list(kwargs["dataset_kwargs_list"].values())
+        sample_weights = kwargs["sample_weights"]
+
+    dataset = make_interleaved_dataset(
+        dataset_kwargs_list,
+        sample_weights,
+        train=True,
+        shuffle_buffer_size=flags.FLAGS.shuffle_buffer_size,
+        traj_transform_kwargs=kwargs["traj_transform_kwargs"],
+        frame_transform_kwargs=kwargs["frame_transform_kwargs"],
+        balance_weights=kwargs.get("balance_weights", False),
+        traj_transform_threads=kwargs.get("traj_transform_threads"),
+        traj_read_threads=kwargs.get("traj_read_threads"),
+        shuffle_image_refs=shuffle_image_refs,
+    )
+
+    # The first frame only comes out once the shuffle buffer is full.
+    iterator = dataset.as_numpy_iterator()
+    next(iterator)
+    start = time.perf_counter()
+    for _ in range(flags.FLAGS.num_frames):
+        next(iterator)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "peak_rss_gb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20,
+        "frames_per_sec": flags.FLAGS.num_frames / elapsed,
+        "image_store_gb": (
+            dataset.image_store.num_bytes() / 2**30 if dataset.image_store else 0.0
+        ),
+    }
+
+
+def main(_):
+    if flags.FLAGS.mode:
+        print(json.dumps(run_mode(flags.FLAGS.config, MODES[flags.FLAGS.mode])))
+        return
+
+    table = PrettyTable(
+        ["mode", "shuffle buffer", "peak RSS (GB)", "image store (GB)", "frames/s"]
+    )
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, *sys.argv, f"--mode={mode}"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        table.add_row(
+            [
+                mode,
+                flags.FLAGS.shuffle_buffer_size,
+                f"{result['peak_rss_gb']:.2f}",
+                f"{result['image_store_gb']:.2f}",
+                f"{result['frames_per_sec']:.1f}",
+            ]
+        )
+    print(table)
+
+
+if __name__ == "__main__":
+    config_flags.DEFINE_config_file(
+        "config", "configs/smoke_test.py", "Path to the config file."
+    )
+    flags.DEFINE_integer("shuffle_buffer_size", 50000, "Frame shuffle buffer size.")
+    flags.DEFINE_integer("num_frames", 2000, "Frames timed after the buffer is full.")
+    flags.DEFINE_enum("mode", None, list(MODES), "Run a single mode (internal).")
+    app.run(main)
@@ -0,0 +1,74 @@
+"""
+Exports a training checkpoint to a local inference-only artifact.
+
+Usage:
+    python scripts/export_for_inference.py --config configs/inference_config.py \
+        --checkpoint_dir gs://bucket/run --checkpoint_step 55000 \
+        --export_dir /tmp/palivla_export --param_format bfloat16
+
+Serve it with `scripts/inference_server.py --export_dir /tmp/palivla_export`.
+"""
+
+import sys
+
+import jax
+import numpy as np
+import orbax.checkpoint as ocp
+from absl import app, flags
+from ml_collections import config_flags
+from PIL import Image
+
+sys.path.append(".")
+from palivla.export import export_for_inference
+from palivla.inference import make_inference_batch, make_sharding
+from palivla.model_components import ModelComponents
+
+
+def main(_):
+    config = flags.FLAGS.config
+    if flags.FLAGS.platform == "tpu":
+        jax.distributed.initialize()
+    sharding_metadata = make_sharding(config)
+
+    model = ModelComponents.load_static(
+        flags.FLAGS.checkpoint_dir, sharding_metadata, weights_only=True
+    )
+    manager = ocp.CheckpointManager(
+        flags.FLAGS.checkpoint_dir, options=ocp.CheckpointManagerOptions()
+    )
+    model.load_state(flags.FLAGS.checkpoint_step, manager, weights_only=True)
+
+    resize_size = config.dataset_kwargs.frame_transform_kwargs.resize_size.primary
+    warmup_image = Image.fromarray(np.zeros((*resize_size, 3), dtype=np.uint8))
+    warmup_batch = make_inference_batch(
+        "warmup", warmup_image, config, config.get("inference_device", "gpu")
+    )
+
+    sampler = config.get("sampler", "greedy")
+    export_for_inference(
+        model,
+        flags.FLAGS.export_dir,
+        warmup_batch,
+        param_format=flags.FLAGS.param_format,
+        use_ema_params=flags.FLAGS.use_ema_params,
+        sampler=sampler,
+        temperature=None if sampler == "greedy" else config["temperature"],
+    )
+
+
+if __name__ == "__main__":
+    config_flags.DEFINE_config_file(
+        "config", "configs/inference_config.py", "Path to the config file."
+    )
+    flags.DEFINE_string("platform", "gpu", "Platform to run on.")
+    flags.DEFINE_string("checkpoint_dir", "", "Path to the checkpoint directory.")
+    flags.DEFINE_integer("checkpoint_step", -1, "Step to export.")
+    flags.DEFINE_string("export_dir", "", "Local directory to write the artifact to.")
+    flags.DEFINE_enum(
+        "param_format",
+        None,
+        ["float32", "bfloat16", "int8"],
+        "Storage format of the params (default: keep the checkpoint's dtypes).",
+    )
+    flags.DEFINE_bool("use_ema_params", False, "Export the EMA params.")
+    app.run(main)
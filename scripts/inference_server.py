@@ -1,5 +1,9 @@
+import collections
+import concurrent.futures
+import threading
 import numpy as np
 import sys
+from absl import flags
 import wandb
 import time
 from ml_collections import config_flags
@@ -16,7 +20,10 @@ from PIL import Image
 
 # Palivla
 from palivla.model_components import ModelComponents
-from palivla.inference import run_inference, make_sharding
+from palivla.export import load_for_inference
+from palivla.inference import run_inference, make_sharding, make_inference_batch
+from palivla.continuous_batching import ContinuousBatchingEngine
+from palivla.image_embedding_cache import ImageEmbeddingCache
 
 # Jax imports
 import jax
@@ -41,11 +48,43 @@ run_with_ngrok(app)
 
 config = None
 model = None
+engine = None
+image_cache = None
+window_size = 1
 avg_time = []
 input_prompt = ""
+
+# Frame history of the latest episodes: episode id -> (index, deque of (timestep, image))
+MAX_EPISODES = 256
+histories = collections.OrderedDict()
+history_lock = threading.Lock()
+next_episode = 0
+
+
+def add_to_history(episode_id, timestep, obs):
+    """
+    Adds a frame to its episode's history. Returns the last `window_size` frames
+    (repeating the first one, like the dataset) and their (episode, timestep) ids.
+    """
+    global next_episode
+    with history_lock:
+        if episode_id not in histories:
+            histories[episode_id] = (next_episode, collections.deque(maxlen=window_size))
+            next_episode += 1
+            if len(histories) > MAX_EPISODES:
+                histories.popitem(last=False)
+        histories.move_to_end(episode_id)
+        index, frames = histories[episode_id]
+        frames.append((timestep, obs))
+        frames = [frames[0]] * (window_size - len(frames)) + list(frames)
+    images = [image for _, image in frames]
+    frame_ids = np.array([[index, t] for t, _ in frames], dtype=np.int64)
+    return images, frame_ids
+
+
 @app.route('/gen_action', methods=["POST"])
 def gen_action():
-    global config, model, run, input_prompt
+    global config, model, engine, image_cache, window_size, run, input_prompt
 
     # If first time getting inference, load the model
     if model is None: 
@@ -58,12 +97,34 @@ def gen_action():
             jax.distributed.initialize()
         sharding_metadata = make_sharding(config)
 
-        print("\nLoading model...", flags.FLAGS.checkpoint_dir)
-        model = ModelComponents.load_static(f"gs://{flags.FLAGS.checkpoint_dir}", sharding_metadata, weights_only=True)
-        manager = ocp.CheckpointManager(flags.FLAGS.checkpoint_dir, options=ocp.CheckpointManagerOptions())
-        model.load_state(flags.FLAGS.checkpoint_step, manager, weights_only=True)
+        if flags.FLAGS.export_dir:
+            # Inference-only artifact from scripts/export_for_inference.py
+            print("\nLoading exported model...", flags.FLAGS.export_dir)
+            model = load_for_inference(flags.FLAGS.export_dir, sharding_metadata)
+        else:
+            print("\nLoading model...", flags.FLAGS.checkpoint_dir)
+            model = ModelComponents.load_static(f"gs://{flags.FLAGS.checkpoint_dir}", sharding_metadata, weights_only=True)
+            manager = ocp.CheckpointManager(flags.FLAGS.checkpoint_dir, options=ocp.CheckpointManagerOptions())
+            model.load_state(flags.FLAGS.checkpoint_step, manager, weights_only=True)
         print("\nModel loaded!")
 
+        # Consecutive requests of an episode share window_size - 1 frames, which are encoded once
+        window_size = config["dataset_kwargs"]["traj_transform_kwargs"].get("window_size", 1)
+        image_cache = ImageEmbeddingCache(model)
+
+        if flags.FLAGS.continuous_batching_slots > 0:
+            # Requests from different robots are decoded together as they arrive
+            engine = ContinuousBatchingEngine(
+                model,
+                action_dim=2,
+                action_horizon=config["dataset_kwargs"]["traj_transform_kwargs"]["action_horizon"],
+                num_slots=flags.FLAGS.continuous_batching_slots,
+                sampler=config.get("sampler") or "greedy",
+                temperature=config.get("temperature") if config.get("sampler", "greedy") != "greedy" else None,
+                image_cache=image_cache,
+            )
+            engine.start()
+
     # Receive data 
     data = request.get_json()
     obs_data = base64.b64decode(data['obs'])
@@ -77,9 +138,28 @@ def gen_action():
 
     print(f"Prompt: {prompt}")
 
+    # Clients sending an episode id and timestep get the episode's frame history as observation.
+    # Episode ids must not be reused for different episodes.
+    images, frame_ids = obs, None
+    if data.get("episode_id") is not None:
+        images, frame_ids = add_to_history(data["episode_id"], int(data["timestep"]), obs)
+
     # Run inference
     start_time = time.time()
-    action, viz = run_inference(model, prompt, obs, config)
+    if engine is not None:
+        # One example per request: the TPU batch of copies would take several slots
+        batch = make_inference_batch(prompt, images, config, inference_device="gpu")
+        try:
+            future = engine.submit(batch, frame_ids=None if frame_ids is None else frame_ids[None])[0]
+            action, _ = future.result(timeout=flags.FLAGS.request_timeout)
+        except concurrent.futures.TimeoutError:
+            return jsonify(error="Timed out waiting for the action"), 504
+        action, viz = action.squeeze(), None
+    else:
+        action, viz = run_inference(
+            model, prompt, images, config,
+            image_cache=None if frame_ids is None else image_cache, frame_ids=frame_ids,
+        )
 
     print(action)
     
@@ -101,5 +181,8 @@ if __name__ == "__main__":
     flags.DEFINE_string("platform", "gpu", "Platform to run on.")
     flags.DEFINE_string("checkpoint_dir", "", "Path to the checkpoint directory.")
     flags.DEFINE_integer("checkpoint_step", -1, "Step to resume from.")
+    flags.DEFINE_string("export_dir", "", "Path to an exported inference artifact (overrides checkpoint_dir).")
     flags.DEFINE_string("prompt", "", "Prompt to generate action from.")
+    flags.DEFINE_integer("continuous_batching_slots", 0, "Decode concurrent requests with continuous batching in this many slots (0 disables).")
+    flags.DEFINE_float("request_timeout", 60.0, "Seconds to wait for a continuous batching request.")
     app.run()
\ No newline at end of file
@@ -1,10 +1,9 @@
 import os
-import matplotlib.pyplot as plt
 import datetime, time
 import shutil
 
 from big_vision.utils import Registry
-from palivla.components.action_tokenizer import ActionTokenizer, DCTActionTokenizer
+from palivla.components.action_tokenizer import ActionTokenizer
 from palivla.components.model import PaliVLAModel
 from palivla.components.sequence_builder import SequenceBuilder
 from palivla.components.train_state import ShardingMetadata
@@ -14,10 +13,10 @@ os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
 import jax
 import jax.numpy as jnp
 import numpy as np
+from jax.experimental import multihost_utils
 import orbax.checkpoint as ocp
 import tensorflow as tf
 import tqdm
-import pickle as pkl
 from absl import app, flags
 from absl import logging as absl_logging
 from flax.core.frozen_dict import freeze
@@ -28,6 +27,7 @@ from transformers import AutoTokenizer
 import wandb
 import palivla.load_fns
 from palivla.dataset import make_base_dataset
+from palivla.evaluator import Evaluator
 from palivla.model_components import ModelComponents
 from palivla.optimizer import make_optimizer
 from palivla.spec import ModuleSpec, OptimizerSpec
@@ -81,12 +81,15 @@ def create_model(config: ConfigDict, sharding_metadata: ShardingMetadata):
     language_tokenizer = AutoTokenizer.from_pretrained(config.language_tokenizer)
     action_tokenizer: ActionTokenizer = Registry.lookup(config.action_tokenizer)()
     sequence_builder: SequenceBuilder = Registry.lookup(config.sequence_builder)()
-    
-    if isinstance(action_tokenizer, DCTActionTokenizer):
-        raise NotImplementedError(
-            "DCTActionTokenizer is not yet implemented in the training script. Please use a different action tokenizer."
+
+    # The generated sequence holds <begin_of_action>, the action tokens and <eos>
+    if action_tokenizer.num_tokens + 2 > sequence_builder.gen_pad_length:
+        raise ValueError(
+            f"gen_pad_length ({sequence_builder.gen_pad_length}) must fit the "
+            f"{action_tokenizer.num_tokens} action tokens and the <begin_of_action> "
+            "and <eos> delimiters"
         )
-    
+
     # Add the extra tokens to the language tokenizer for actions
     extra_tokens = [
         "<begin_of_action>",
@@ -118,6 +121,18 @@ def create_model(config: ConfigDict, sharding_metadata: ShardingMetadata):
     )
 
 
+def fit_action_tokenizer(model: ModelComponents, train_it, num_batches: int):
+    """Fits the action tokenizer to the actions of `num_batches` batches of every host."""
+    actions = np.concatenate(
+        [next(train_it)["action"][..., -1, :, :] for _ in range(num_batches)]
+    )
+    # All hosts must fit the same tokenizer
+    actions = multihost_utils.process_allgather(actions)
+    actions = actions.reshape((-1, *actions.shape[-2:]))
+    model.action_tokenizer.fit(actions)
+    print(f"Fit the action tokenizer to {len(actions)} action chunks")
+
+
 def main(_):
     if flags.FLAGS.platform == "tpu":
         jax.distributed.initialize()
@@ -164,6 +179,33 @@ def main(_):
         train_ds.batch(per_host_train_batch_size).iterator(),
     )
 
+    # Tokenizers fit to the data (e.g. DCT with do_fit) are fit before being saved
+    if config.resume_checkpoint_dir is None and getattr(model.action_tokenizer, "do_fit", False):
+        fit_action_tokenizer(model, train_it, config.get("action_tokenizer_fit_batches", 10))
+
+    # Held-out evaluation on the validation split
+    eval_num_batches = config.get("eval_num_batches", 0)
+    if eval_num_batches > 0:
+        per_host_eval_batch_size = config.eval_batch_size // jax.process_count()
+        eval_ds = make_base_dataset(**config.dataset_kwargs.to_dict(), train=False)
+        eval_it = eval_ds.batch(per_host_eval_batch_size).iterator()
+    else:
+        eval_it = None
+    evaluator = Evaluator(
+        eval_it,
+        eval_num_batches,
+        num_visualizations=5 if config.visualize else 0,
+    )
+    # (eval step, image paths) pairs written by the evaluator's background thread
+    visualization_paths = []
+
+    def log_visualizations():
+        while visualization_paths:
+            step, paths = visualization_paths.pop(0)
+            wandb.log(
+                {"action_prediction": [wandb.Image(p) for p in paths]}, step=step
+            )
+
     # W&B setup
     if jax.process_index() == 0:
         wandb_kwargs = {
@@ -221,53 +263,29 @@ def main(_):
             )
             
             if (i + 1) % config.eval_interval == 0:
+                if eval_num_batches > 0:
+                    # Held-out evaluation over several validation batches
+                    eval_info = evaluator.run(
+                        model, i + 1, on_visualize=visualization_paths.append
+                    )
+                else:
+                    eval_data = model.eval_step(
+                        batch, teacher_forced=config.get("eval_teacher_forced", False)
+                    )
+                    eval_info = eval_data["eval_info"]
+                    if config.visualize and "pred_actions" in eval_data["eval_data"] and jax.process_index() == 0:
+                        evaluator.visualize(
+                            model,
+                            batch,
+                            eval_data["eval_data"]["pred_actions"],
+                            i + 1,
+                            on_visualize=visualization_paths.append,
+                        )
+                if jax.process_index() == 0:
+                    wandb.log(eval_info, step=i + 1, commit=False)
 
-                # Get eval info
-                eval_data = model.eval_step(batch)
-                eval_info = eval_data["eval_info"]
-                eval_plots = eval_data["eval_data"]
-
-                # Select random subset of the batch to visualize
-                if config.visualize:
-                    if jax.process_index() == 0:
-                        print("Visualizing evaluation results...")
-                        
-                        wandb_list = []
-                        idxs = np.random.choice(np.arange(eval_plots["pred_actions"].shape[0]//jax.process_count()), 5)
-                        
-                        # Get the ground truth and predicted actions
-                        gt_viz = eval_plots["gt_actions"][idxs, ...]
-                        gt_viz = np.cumsum(gt_viz, axis=1)
-                        gt_viz = gt_viz - gt_viz[:, 0, :].reshape(-1, 1, model.action_tokenizer.action_dim)
-
-                        pred_viz = eval_plots["pred_actions"][idxs, ...]
-                        pred_viz = np.cumsum(pred_viz, axis=1)
-                        try:
-                            pred_viz = pred_viz - pred_viz[:, 0, :].reshape(-1, 1, model.action_tokenizer.action_dim)
-                        except:
-                            pred_viz = pred_viz - pred_viz[:, 0, :].reshape(-1, 1, 2)
-                        
-                        context = batch["observation"]["image_primary"][idxs, ...]
-                        prompts = [model.sequence_builder.prepare_prompt(p) for p in batch["task"]["language_instruction"][idxs]]
-                        for j in range(pred_viz.shape[0]):
-                            fig, ax = plt.subplots(1,2)
-                            ax[0].plot(gt_viz[j,:,0], gt_viz[j,:,1], 'r')
-                            ax[0].plot(gt_viz[j,-1,0], gt_viz[j,-1,1], 'ro')
-                            ax[0].plot(pred_viz[j,:,0], pred_viz[j,:,1], 'b')
-                            ax[0].plot(gt_viz[j,-1,0], gt_viz[j,-1,1], 'ro')
-                            ax[1].imshow(context[j, ...].squeeze(0))
-                            ax[1].set_title(prompts[j])
-                            plt.legend()
-                            save_path = f"images/eval_gt_{i+1}_{j}.png"
-                            plt.savefig(save_path)
-                            wandb_list.append(wandb.Image(save_path))
-                            plt.close()
-                            
-                            wandb.log({"action_prediction": wandb_list}, commit=False)
-                            wandb.log(eval_info, step=i + 1, commit=False)
-                            with open("batch.pkl", "wb") as f:
-                                pkl.dump(batch, f)
-                            wandb.save("batch.pkl")
+            # Visualizations are written in the background; log them once ready
+            log_visualizations()
 
             if (i + 1) % config.log_interval == 0:
                 avg_info = jax.tree.map(
@@ -281,6 +299,8 @@ def main(_):
                 if config.save_path is not None:
                     model.save_state(i + 1, checkpoint_save_manager)
 
+    evaluator.wait_until_finished()
+    log_visualizations()
     if config.save_path is not None:
         checkpoint_save_manager.wait_until_finished()
 
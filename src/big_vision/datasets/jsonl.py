@@ -14,6 +14,8 @@
 
 """Simple data input from .jsonl files."""
 
+import collections
+from concurrent import futures
 import hashlib
 import json
 from multiprocessing.pool import ThreadPool
@@ -55,16 +57,60 @@ def cached_download(url, dest=None, verbose=True):
   return dest
 
 
+def line_offsets(fname):
+  """Returns the byte offsets of all lines in `fname`, followed by its size.
+
+  The offsets are cached next to the file (or, if that isn't writable, in the
+  local temp folder) and recomputed when the file's size or modification time
+  changes.
+  """
+  stat = tf.io.gfile.stat(fname)
+  size, mtime = stat.length, stat.mtime_nsec
+  cache_names = [
+      fname + ".offsets.npz",
+      os.path.join(tempfile.gettempdir(), "bv",
+                   hashlib.md5(fname.encode()).hexdigest() + ".offsets.npz"),
+  ]
+  for cache_name in cache_names:
+    if tf.io.gfile.exists(cache_name):
+      with tf.io.gfile.GFile(cache_name, "rb") as f:
+        cache = np.load(f)
+        offsets, cached_mtime = cache["offsets"], cache["mtime_nsec"]
+      if offsets[-1] == size and cached_mtime == mtime:
+        return offsets
+
+  # One pass over the raw bytes, without decoding or parsing any lines.
+  offsets, pos = [np.zeros(1, np.int64)], 0
+  with tf.io.gfile.GFile(fname, "rb") as f:
+    while chunk := f.read(64 << 20):
+      newlines = np.flatnonzero(np.frombuffer(chunk, np.uint8) == ord("\n"))
+      offsets.append(newlines.astype(np.int64) + pos + 1)
+      pos += len(chunk)
+  offsets = np.concatenate(offsets)
+  if offsets[-1] != size:  # No trailing newline.
+    offsets = np.append(offsets, size)
+
+  for cache_name in cache_names:
+    try:
+      tf.io.gfile.makedirs(os.path.dirname(cache_name))
+      with tf.io.gfile.GFile(cache_name, "wb") as f:
+        np.savez(f, offsets=offsets, mtime_nsec=np.int64(mtime))
+      break
+    except (tf.errors.OpError, OSError):
+      logging.info("Could not cache line offsets at %s", cache_name)
+  return offsets
+
+
 class DataSource(ds_core.DataSource):
   """.jsonl DataSource."""
 
   def __init__(self, fname, *, fopen_keys=(), download_keys=(),
-               start=0, stop=float("inf")):
+               start=0, stop=float("inf"), streaming=False):
     """Create data-source that's jsonl + data files (eg images).
 
     This correctly supports multi-host in that each host only reads a subset of
-    the dataset automatically. However, currently, all hosts download all items
-    if `download_keys` is specified. TODO: b/lbeyer - This can be improved.
+    the dataset automatically. However, without `streaming`, all hosts parse
+    the whole file and download all items if `download_keys` is specified.
 
     Args:
       fname: str, the path to the jsonl file that holds the dataset.
@@ -81,6 +127,10 @@ class DataSource(ds_core.DataSource):
         Must be a subset of `fopen_keys`.
       start: int, index of the first row to use; use for slicing the data.
       stop: int or inf, index of the row after the last one to use.
+      streaming: bool, if True, only the byte offsets of the lines are
+        indexed up front (see `line_offsets`); each process then lazily reads
+        and parses only its own examples, and downloads only those, while
+        they are being consumed.
 
     Note:
       This simple data input does not allow for nested/hierarchical values,
@@ -88,6 +138,28 @@ class DataSource(ds_core.DataSource):
 
       The way start/stop arguments are used is as in list slicing[start:stop].
     """
+    for k in download_keys:
+      assert k in fopen_keys, (
+          f"{k} in download_keys but missing from fopen_keys {fopen_keys}")
+
+    # Normalize.
+    if isinstance(fopen_keys, (list, tuple)):
+      self.fopen_keys = {k: "" for k in fopen_keys}
+    else:
+      self.fopen_keys = fopen_keys or {}
+
+    self.fname = fname
+    self.download_keys = download_keys
+    self.streaming = streaming
+    if streaming:
+      offsets = line_offsets(fname)
+      num_lines = len(offsets) - 1
+      start, stop = start or 0, min(stop or float("inf"), num_lines)
+      self._offsets = offsets[start:int(max(stop, start)) + 1]
+      self._first_line = start
+      self.examples = None
+      return
+
     self.examples = []
 
     with tf.io.gfile.GFile(fname) as f:
@@ -99,10 +171,6 @@ class DataSource(ds_core.DataSource):
             raise ValueError(f"Invalid JSON in line {i}:\n{line}") from e
 
     if download_keys:
-      for k in download_keys:
-        assert k in fopen_keys, (
-            f"{k} in download_keys but missing from fopen_keys {fopen_keys}")
-
       # TODO: b/lbeyer - use info from trainer instead, move that to utils.
       logging.info(  # pylint: disable=logging-fstring-interpolation
           f"\u001b[33mNOTE\u001b[0m: Downloading {download_keys} "
@@ -116,20 +184,58 @@ class DataSource(ds_core.DataSource):
       print("Done")
       logging.info("\u001b[33mNOTE\u001b[0m: Done downloading.")
 
-    # Normalize.
-    if isinstance(fopen_keys, (list, tuple)):
-      self.fopen_keys = {k: "" for k in fopen_keys}
-    else:
-      self.fopen_keys = fopen_keys or {}
-
     # We need to apply fopen path prefix here already, because doing so while
     # actually reading the files in TF, things are symbolic :(
     for ex in self.examples:
       for k, dirname in self.fopen_keys.items():
         ex[k] = os.path.join(dirname, ex[k])
 
+  def _read_example(self, f, i):
+    """Reads and parses example `i` from the open (binary) jsonl file `f`."""
+    f.seek(int(self._offsets[i]))
+    line = f.read(int(self._offsets[i + 1] - self._offsets[i]))
+    try:
+      return json.loads(line)
+    except json.decoder.JSONDecodeError as e:
+      raise ValueError(
+          f"Invalid JSON in line {self._first_line + i}:\n{line}") from e
+
+  def _prepare_example(self, ex):
+    for k in self.download_keys:
+      ex[k] = cached_download(ex[k], verbose=False)
+    # Same as in the non-streaming case, the fopen prefix is applied in python.
+    for k, dirname in self.fopen_keys.items():
+      ex[k] = os.path.join(dirname, ex[k])
+    return ex
+
+  def _stream_examples(self, idxs, num_ahead=256):
+    """Lazily yields (i, example) for `idxs`, downloading ahead in threads."""
+    with tf.io.gfile.GFile(self.fname, "rb") as f:
+      if not self.download_keys:
+        for i in idxs:
+          yield i, self._prepare_example(self._read_example(f, i))
+        return
+
+      # Keep at most `num_ahead` examples in flight, so memory stays bounded.
+      with futures.ThreadPoolExecutor(100) as pool:
+        pending = collections.deque()
+        for i in idxs:
+          ex = self._read_example(f, i)
+          pending.append((i, pool.submit(self._prepare_example, ex)))
+          if len(pending) >= num_ahead:
+            j, fut = pending.popleft()
+            yield j, fut.result()
+        for j, fut in pending:
+          yield j, fut.result()
+
+  @property
+  def _num_examples(self):
+    if self.streaming:
+      return len(self._offsets) - 1
+    return len(self.examples)
+
   def _indices(self, *, process_split=True, process_index=None):
-    indices = np.arange(len(self.examples))
+    indices = np.arange(self._num_examples)
 
     if not process_split:
       return list(indices)
@@ -140,18 +246,27 @@ class DataSource(ds_core.DataSource):
   @overrides.overrides
   def get_tfdata(self, ordered=False, *, process_split=True, allow_cache=True):
     del allow_cache  # We don't cache anything anyways.
-    assert not process_split or len(self.examples) >= jax.process_count(), (
+    assert not process_split or self._num_examples >= jax.process_count(), (
         "Process splitting the data with fewer examples than processes!?")
 
     my_idxs = self._indices(process_split=process_split)
     if not ordered:
       np.random.shuffle(my_idxs)
 
+    if self.streaming:
+      with tf.io.gfile.GFile(self.fname, "rb") as f:
+        first_example = self._read_example(f, my_idxs[0])
+      generator = lambda: ({"id": str(i), **ex}  # pylint: disable=g-long-lambda
+                           for i, ex in self._stream_examples(my_idxs))
+    else:
+      first_example = self.examples[0]
+      generator = lambda: ({"id": str(i), **self.examples[i]} for i in my_idxs)
+
     dataset = tf.data.Dataset.from_generator(
-        generator=lambda: ({"id": str(i), **self.examples[i]} for i in my_idxs),
+        generator=generator,
         output_signature={
             "id": _guess_signature("0"),
-            **{k: _guess_signature(v) for k, v in self.examples[0].items()},
+            **{k: _guess_signature(v) for k, v in first_example.items()},
             })
 
     def _read_files(example):
@@ -165,7 +280,7 @@ class DataSource(ds_core.DataSource):
   @property
   @overrides.overrides
   def total_examples(self):
-    return len(self.examples)
+    return self._num_examples
 
   @overrides.overrides
   def num_examples_per_process(self):
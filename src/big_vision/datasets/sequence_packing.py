@@ -20,6 +20,7 @@
 
 from typing import Dict, Optional, List, Union
 
+import numpy as np
 import tensorflow as tf
 
 AUTOTUNE = tf.data.experimental.AUTOTUNE
@@ -27,7 +28,8 @@ AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 def pack_dataset(dataset: tf.data.Dataset,
                  key2length: Union[int, Dict[str, int]],
-                 keys: Optional[List[str]] = None) -> tf.data.Dataset:
+                 keys: Optional[List[str]] = None,
+                 strategy: str = 'next_fit') -> tf.data.Dataset:
   """Creates a 'packed' version of a dataset on-the-fly.
  
   Adapted from the mesh-tf implementation.
@@ -57,10 +59,19 @@ def pack_dataset(dataset: tf.data.Dataset,
   0 represents padding in both the inputs and the outputs.
   Sequences in the incoming examples are truncated to length "length", and the
   sequences in the output examples all have fixed (padded) length "length".
+
+  Examples are packed in chunks of max(lengths) examples by a vectorized NumPy
+  packer that runs in a parallel map. With `strategy="next_fit"` an example is
+  appended to the current packed example if it fits, otherwise a new one is
+  started (the same packing as the original mesh-tf implementation). With
+  "first_fit" it goes into the first packed example of the chunk it fits in,
+  which wastes less padding but reorders examples. "tf_ops" is the original,
+  much slower tf.while_loop implementation of "next_fit".
   Args:
     dataset: a tf.data.Dataset
     key2length: an integer, or a dict from feature-key to integer
     keys: a list of strings (e.g. ["inputs", "targets"])
+    strategy: one of "next_fit", "first_fit" or "tf_ops".
   Returns:
     a tf.data.Dataset
   """
@@ -92,7 +103,12 @@ def pack_dataset(dataset: tf.data.Dataset,
   batch_size = max(key2length.values())
   dataset = dataset.padded_batch(
       batch_size, padded_shapes={k: [-1] for k in keys})
-  dataset = _pack_with_tf_ops(dataset, keys, key2length)
+  if strategy == 'tf_ops':
+    dataset = _pack_with_tf_ops(dataset, keys, key2length)
+  elif strategy in ('next_fit', 'first_fit'):
+    dataset = _pack_with_numpy(dataset, keys, key2length, strategy)
+  else:
+    raise ValueError(f'Unknown packing strategy: {strategy}')
 
   # Set the Tensor shapes correctly since they get lost in the process.
   def my_fn(x):
@@ -207,3 +223,106 @@ def _pack_with_tf_ops(dataset: tf.data.Dataset, keys: List[str],
 
   dataset = dataset.map(map_fn, num_parallel_calls=AUTOTUNE)
   return dataset.unbatch()
+
+
+def _assign_bins(lengths: np.ndarray, capacity: np.ndarray,
+                 strategy: str) -> np.ndarray:
+  """Assigns each example to a packed example (bin).
+
+  Args:
+    lengths: [num_examples, num_keys] sequence lengths.
+    capacity: [num_keys] length of the packed sequences.
+    strategy: "next_fit" or "first_fit".
+  Returns:
+    [num_examples] bin index of every example. Bins are numbered from 0 in the
+    order they are opened.
+  """
+  n = len(lengths)
+  bins = np.zeros(n, np.int32)
+  if strategy == 'next_fit':
+    fill, b = np.zeros_like(capacity), 0
+    for i in range(n):
+      if np.any(fill + lengths[i] > capacity):
+        fill, b = np.zeros_like(capacity), b + 1
+      fill = fill + lengths[i]
+      bins[i] = b
+  else:
+    # Remaining capacity of every bin that could possibly be opened.
+    free = np.broadcast_to(capacity, (n, len(capacity))).copy()
+    for i in range(n):
+      # Bins are opened in order, so the first fitting bin is never past the
+      # first unused one (which always fits, lengths are truncated).
+      b = np.argmax(np.all(free >= lengths[i], axis=1))
+      free[b] -= lengths[i]
+      bins[i] = b
+  return bins
+
+
+def pack_numpy(batch: Dict[str, np.ndarray], key2length: Dict[str, int],
+               strategy: str = 'next_fit') -> Dict[str, np.ndarray]:
+  """Packs a padded batch of sequences, see `pack_dataset`.
+
+  Args:
+    batch: dict of [num_examples, max_len] arrays; sequences are the prefix up
+      to their number of non-zero entries.
+    key2length: dict from feature-key to packed length.
+    strategy: "next_fit" or "first_fit".
+  Returns:
+    dict with the packed [num_packed, length] int32 arrays for every key, and
+    the "_seg" and "_pos" arrays.
+  """
+  keys = list(batch)
+  capacity = np.array([key2length[k] for k in keys])
+  lengths = np.stack([
+      np.minimum(np.count_nonzero(batch[k], axis=1), key2length[k])
+      for k in keys
+  ], axis=1)
+  bins = _assign_bins(lengths, capacity, strategy)
+  num_bins = int(bins.max()) + 1 if len(bins) else 0
+
+  # Examples keep their relative order within a bin.
+  order = np.argsort(bins, kind='stable')
+  packed = {}
+  for j, k in enumerate(keys):
+    # Offset of every example within its bin.
+    sorted_lengths = lengths[order, j]
+    ends = np.cumsum(sorted_lengths)
+    sorted_bins = bins[order]
+    bin_starts = np.searchsorted(sorted_bins, sorted_bins)
+    starts_of_bin = np.concatenate([[0], ends])[bin_starts]
+    offsets = np.empty_like(lengths[:, j])
+    offsets[order] = ends - sorted_lengths - starts_of_bin
+
+    # Scatter all tokens at once.
+    ex, t = np.nonzero(np.arange(batch[k].shape[1]) < lengths[:, j, None])
+    dest = (bins[ex], offsets[ex] + t)
+    tokens = np.zeros((num_bins, key2length[k]), np.int32)
+    tokens[dest] = batch[k][ex, t]
+    pos = np.zeros((num_bins, key2length[k]), np.int32)
+    pos[dest] = t
+    packed[k] = tokens
+    packed[k + '_pos'] = pos
+    packed[k + '_seg'] = (
+        np.cumsum(pos == 0, axis=1, dtype=np.int32) * (tokens != 0))
+  return packed
+
+
+def _pack_with_numpy(dataset: tf.data.Dataset, keys: List[str],
+                     key2length: Dict[str, int],
+                     strategy: str) -> tf.data.Dataset:
+  """Packs a dataset of padded batches with `pack_numpy`."""
+  out_keys = [k + suffix for k in keys for suffix in ('', '_pos', '_seg')]
+
+  def _pack(*arrays):
+    packed = pack_numpy(dict(zip(keys, arrays)), key2length, strategy)
+    return [packed[k] for k in out_keys]
+
+  def map_fn(x):
+    packed = tf.numpy_function(
+        _pack, [x[k] for k in keys], [tf.int32] * len(out_keys),
+        stateful=False)
+    return {k: tf.reshape(v, [-1, key2length[k]])
+            for k, v in zip(out_keys, packed)}
+
+  dataset = dataset.map(map_fn, num_parallel_calls=AUTOTUNE)
+  return dataset.unbatch()
@@ -0,0 +1,87 @@
+# Copyright 2024 Big Vision Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for sequence packing."""
+
+from absl.testing import parameterized
+from big_vision.datasets import sequence_packing
+import numpy as np
+import tensorflow as tf
+
+
+def _random_dataset(num_examples, seed=0):
+  rng = np.random.default_rng(seed)
+  examples = {"inputs": [], "targets": []}
+  for _ in range(num_examples):
+    examples["inputs"].append(rng.integers(1, 100, rng.integers(0, 12)))
+    examples["targets"].append(rng.integers(1, 100, rng.integers(1, 8)))
+  return tf.data.Dataset.from_generator(
+      lambda: ({k: v[i] for k, v in examples.items()}
+               for i in range(num_examples)),
+      output_signature={k: tf.TensorSpec([None], tf.int64) for k in examples})
+
+
+class SequencePackingTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.parameters("next_fit", "tf_ops")
+  def test_docstring_example(self, strategy):
+    ds = tf.data.Dataset.from_tensor_slices({
+        "inputs": [[8, 7, 1, 0], [2, 3, 4, 1]],
+        "targets": [[4, 1, 0], [5, 6, 1]],
+    })
+    packed = list(sequence_packing.pack_dataset(
+        ds, 10, strategy=strategy).as_numpy_iterator())
+    self.assertLen(packed, 1)
+    self.assertAllEqual(packed[0]["inputs"], [8, 7, 1, 2, 3, 4, 1, 0, 0, 0])
+    self.assertAllEqual(packed[0]["inputs_seg"], [1, 1, 1, 2, 2, 2, 2, 0, 0, 0])
+    self.assertAllEqual(packed[0]["inputs_pos"], [0, 1, 2, 0, 1, 2, 3, 0, 0, 0])
+    self.assertAllEqual(packed[0]["targets"], [4, 1, 5, 6, 1, 0, 0, 0, 0, 0])
+    self.assertAllEqual(packed[0]["targets_seg"], [1, 1, 2, 2, 2, 0, 0, 0, 0, 0])
+    self.assertAllEqual(packed[0]["targets_pos"], [0, 1, 0, 1, 2, 0, 0, 0, 0, 0])
+
+  def test_next_fit_matches_tf_ops(self):
+    key2length = {"inputs": 16, "targets": 10}
+    expected = list(sequence_packing.pack_dataset(
+        _random_dataset(100), key2length, strategy="tf_ops"
+    ).as_numpy_iterator())
+    actual = list(sequence_packing.pack_dataset(
+        _random_dataset(100), key2length, strategy="next_fit"
+    ).as_numpy_iterator())
+    self.assertEqual(len(actual), len(expected))
+    for a, e in zip(actual, expected):
+      self.assertSameElements(a.keys(), e.keys())
+      for k in e:
+        self.assertAllEqual(a[k], e[k])
+
+  def test_first_fit_keeps_all_tokens(self):
+    key2length = {"inputs": 16, "targets": 10}
+    next_fit = list(sequence_packing.pack_dataset(
+        _random_dataset(100), key2length, strategy="next_fit"
+    ).as_numpy_iterator())
+    first_fit = list(sequence_packing.pack_dataset(
+        _random_dataset(100), key2length, strategy="first_fit"
+    ).as_numpy_iterator())
+    for k in key2length:
+      tokens = lambda packed: np.sort(np.concatenate([x[k] for x in packed]))  # pylint: disable=cell-var-from-loop
+      self.assertAllEqual(tokens(first_fit)[tokens(first_fit) != 0],
+                          tokens(next_fit)[tokens(next_fit) != 0])
+      for x in first_fit:
+        # Positions restart at every segment.
+        seg, pos = x[k + "_seg"], x[k + "_pos"]
+        for s in np.unique(seg[seg > 0]):
+          self.assertAllEqual(pos[seg == s], np.arange(np.sum(seg == s)))
+
+
+if __name__ == "__main__":
+  tf.test.main()
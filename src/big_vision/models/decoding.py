@@ -0,0 +1,252 @@
+# Copyright 2024 Big Vision Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Autoregressive decoding shared by the sequence models.
+
+A model plugs in with a `step_fn(tokens, cache) -> (logits, cache)` which
+extends its kv-cache by one token per sequence (tokens [B, 1], logits [B, V]).
+`sample` then decodes in a single compiled `lax.while_loop`, drawing tokens
+with `sample_logits` (temperature, top-k and top-p). Several samples per
+prompt are decoded from a cache expanded with `expand_cache`, or with a
+model-specific function sharing the prompt's cache between the samples.
+"""
+
+import functools
+from typing import Any, Callable
+
+import flax
+import jax
+from jax import lax
+from jax import numpy as jnp
+import numpy as np
+
+
+NEG_INF = np.array(-1.0e7)  # Effective negative infinity.
+
+StepFn = Callable[[jax.Array, Any], tuple[jax.Array, Any]]
+
+
+def flatten_samples_dim(x):
+  """Flattens samples dim into batch dim."""
+  if x.ndim == 0:  # ignore scalars (e.g. cache index)
+    return x
+  return x.reshape((x.shape[0] * x.shape[1],) + x.shape[2:])
+
+
+def unflatten_samples_dim(x, batch_size, num_samples):
+  """Unflattens first dim into batch and samples dims."""
+  if x.ndim == 0:  # ignore scalars (e.g. cache index)
+    return x
+  assert batch_size * num_samples == x.shape[0]
+  return x.reshape((batch_size, num_samples) + x.shape[1:])
+
+
+def repeat_samples(x, num_samples):
+  """Repeats each batch item `num_samples` times along the batch dim."""
+  if x.ndim == 0:  # ignore scalars (e.g. cache index)
+    return x
+  return jnp.repeat(x, num_samples, axis=0)
+
+
+def cache_map(fn, cache, scan=False):
+  """Maps function over caches, even multiple caches in various layers."""
+  if scan:
+    # Assuming the cache is scanned over the first dimension, we apply a map
+    # function over this dimension for scanned models
+    fn_mod = lambda x: jax.lax.map(fn, x) if x.ndim > 0 else fn(x)
+  else:
+    fn_mod = fn
+
+  frozen = isinstance(cache, flax.core.FrozenDict)
+  if frozen:
+    cache = flax.core.unfreeze(cache)
+  flat_cache = flax.traverse_util.flatten_dict(cache)
+  # Exclude cached relative position bias from beam expansion, etc.
+  keyvals = {k: v for k, v in flat_cache.items() if k[-1] != "cached_bias"}
+  keyvals = jax.tree.map(fn_mod, keyvals)
+  flat_cache.update(keyvals)
+  new_cache = flax.traverse_util.unflatten_dict(flat_cache)
+  if frozen:
+    new_cache = flax.core.freeze(new_cache)
+  return new_cache
+
+
+def expand_cache(cache, num_samples):
+  """Copies the cache of each sequence for `num_samples` samples."""
+  return cache_map(functools.partial(repeat_samples, num_samples=num_samples),
+                   cache)
+
+
+def sample_logits(logits, rng, *, temperature=1.0, top_k=0, top_p=0.0,
+                  top_p_candidates=None, mask_token_ids=()):
+  """Samples tokens from `logits` [..., V].
+
+  Args:
+    logits: unnormalized log-probabilities of the tokens.
+    rng: PRNG key.
+    temperature: logits are divided by it before sampling. Zero means argmax.
+    top_k: only sample among the `top_k` most likely tokens. Zero means no
+      limit.
+    top_p: only sample among the smallest set of most likely tokens with
+      cumulative probability >= `top_p`. Zero means no limit. Cannot use both
+      top_p and top_k.
+    top_p_candidates: with `top_p`, only the (approximate) top
+      `top_p_candidates` tokens are candidates, so the vocabulary is never
+      sorted. None considers all tokens.
+    mask_token_ids: if set then tokens with given ids are not sampled.
+
+  Returns:
+    int32 tokens [...].
+  """
+  if top_k > 0 and top_p > 0.0:
+    raise ValueError(f"Cannot use both top_k {top_k} and top_p {top_p}.")
+  for i in mask_token_ids:
+    logits = logits.at[..., i].set(NEG_INF)
+  if not temperature:
+    return jnp.argmax(logits, axis=-1)
+  logits = logits / temperature
+
+  vocab_size = logits.shape[-1]
+  candidates = None
+  if top_k:
+    logits, candidates = lax.top_k(logits, top_k)
+  elif top_p:
+    log_z = jax.nn.logsumexp(logits, axis=-1, keepdims=True)
+    k = min(top_p_candidates or vocab_size, vocab_size)
+    if k < vocab_size:
+      logits, candidates = lax.approx_max_k(logits, k)
+      # approx_max_k does not guarantee the order of its results.
+      order = jnp.argsort(-logits, axis=-1)
+    else:
+      candidates = order = jnp.argsort(-logits, axis=-1)
+    logits = jnp.take_along_axis(logits, order, axis=-1)
+    if k < vocab_size:
+      candidates = jnp.take_along_axis(candidates, order, axis=-1)
+    # Probabilities are normalized over the full vocabulary. If the candidates
+    # hold less than `top_p` of the mass, all of them are kept.
+    cum_probs = jnp.cumsum(jnp.exp(logits - log_z), axis=-1)
+    cutoff_index = jnp.minimum(
+        jnp.sum(cum_probs < top_p, axis=-1, keepdims=True), k - 1)
+    cutoff_logit = jnp.take_along_axis(logits, cutoff_index, axis=-1)
+    logits = jnp.where(logits < cutoff_logit, NEG_INF, logits)
+
+  tokens = jax.random.categorical(rng, logits)
+  if candidates is not None:
+    tokens = jnp.take_along_axis(candidates, tokens[..., None], axis=-1)
+    tokens = tokens[..., 0]
+  return tokens.astype(jnp.int32)
+
+
+@flax.struct.dataclass
+class DecodeState:
+  """Internal state of the `sample` loop."""
+  step: jax.Array      # Position of the token sampled next.
+  cache: Any           # Cache for fast auto-regressive decoding.
+  logits: jax.Array    # Logits of the next token [B, V].
+  tokens: jax.Array    # Generated sequences [B, L], 0 after eos.
+  logprobs: jax.Array  # Log probs of the generated tokens [B, L].
+  done: jax.Array      # Flags indicating whether the sequence reached eos [B].
+  rng: jax.Array       # PRNGKey of the loop state.
+
+
+def _sample_token(state, *, prompts, eos_token, sample_fn):
+  """Samples the token at `state.step` of every sequence."""
+  rng, rng_sampling = jax.random.split(state.rng)
+  tokens = sample_fn(state.logits, rng_sampling).astype(jnp.int32)
+  in_prompt = jnp.zeros_like(state.done)
+  if prompts is not None:
+    prompt = lax.dynamic_index_in_dim(prompts, state.step, 1, keepdims=False)
+    in_prompt = prompt != 0
+    tokens = jnp.where(in_prompt, prompt, tokens)
+  tokens = jnp.where(state.done, 0, tokens)
+
+  logprobs = jnp.take_along_axis(
+      jax.nn.log_softmax(state.logits.astype(jnp.float32)),
+      tokens[:, None], axis=-1)[:, 0]
+  logprobs = jnp.where(state.done, 0.0, logprobs)
+
+  done = state.done
+  if eos_token is not None:
+    # Only out of prompt sequences can finish.
+    done = done | (~in_prompt & (tokens == eos_token))
+  return state.replace(
+      step=state.step + 1,
+      tokens=state.tokens.at[:, state.step].set(tokens),
+      logprobs=state.logprobs.at[:, state.step].set(logprobs),
+      done=done,
+      rng=rng,
+  ), tokens
+
+
+def sample(step_fn: StepFn, logits, cache, rng, *, max_decode_len,
+           eos_token=None, prompts=None, num_samples=1,
+           expand_cache_fn=expand_cache, sample_fn=None, **sample_kwargs):
+  """Samples continuations of B prompts in a compiled loop.
+
+  Args:
+    step_fn: `(tokens [B, 1], cache) -> (logits [B, V], cache)`, extends the
+      cache by one token per sequence.
+    logits: [B, V] logits of the first token, e.g. from prefilling the cache.
+    cache: cache of the prompts.
+    rng: PRNG key, split once per step.
+    max_decode_len: number of tokens to decode (L).
+    eos_token: sequences are finished after it and decoding stops once all
+      are. None never finishes early.
+    prompts: optional [B, L] tokens which are forced instead of sampled where
+      they are not 0.
+    num_samples: number of samples per prompt. They are decoded as one batch,
+      ordered like `jnp.repeat(x, num_samples, axis=0)`.
+    expand_cache_fn: `(cache, num_samples) -> cache` for num_samples > 1.
+    sample_fn: optional `(logits, rng) -> tokens` replacing `sample_logits`.
+    **sample_kwargs: passed to `sample_logits`.
+
+  Returns:
+    tokens: generated sequences [B * num_samples, L], 0 after eos.
+    logprobs: log probs of the tokens [B * num_samples, L], 0 after eos.
+  """
+  if isinstance(rng, int):
+    rng = jax.random.PRNGKey(rng)
+  if num_samples > 1:
+    logits = repeat_samples(logits, num_samples)
+    cache = expand_cache_fn(cache, num_samples)
+    if prompts is not None:
+      prompts = repeat_samples(prompts, num_samples)
+
+  batch_size = logits.shape[0]
+  state = DecodeState(
+      step=jnp.array(0, jnp.int32),
+      cache=cache,
+      logits=logits,
+      tokens=jnp.zeros((batch_size, max_decode_len), jnp.int32),
+      logprobs=jnp.zeros((batch_size, max_decode_len), jnp.float32),
+      done=jnp.zeros((batch_size,), jnp.bool_),
+      rng=rng,
+  )
+  sample_fn = sample_fn or functools.partial(sample_logits, **sample_kwargs)
+  sample_token = functools.partial(
+      _sample_token, prompts=prompts, eos_token=eos_token, sample_fn=sample_fn)
+
+  def cond_fn(state):
+    return (state.step < max_decode_len - 1) & ~jnp.all(state.done)
+
+  def body_fn(state):
+    state, tokens = sample_token(state)
+    logits, cache = step_fn(tokens[:, None], state.cache)
+    return state.replace(logits=logits, cache=cache)
+
+  state = lax.while_loop(cond_fn, body_fn, state)
+  # The last token does not need to be fed to the model. If all sequences
+  # finished early, this only writes padding.
+  state, _ = sample_token(state)
+  return state.tokens, state.logprobs
@@ -0,0 +1,97 @@
+# Copyright 2024 Big Vision Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the shared decoding loop and samplers."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from big_vision.models import decoding
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+_VOCAB = 6
+
+
+def _one_hot_logits(tokens):
+  return 100.0 * jax.nn.one_hot(tokens, _VOCAB)
+
+
+def _next_token_step(tokens, cache):
+  """Toy model which always predicts the next token id."""
+  return _one_hot_logits(tokens[:, 0] + 1), cache + 1
+
+
+class DecodingTest(parameterized.TestCase):
+
+  def test_argmax(self):
+    logits = jax.random.normal(jax.random.PRNGKey(0), (4, _VOCAB))
+    tokens = decoding.sample_logits(
+        logits, jax.random.PRNGKey(1), temperature=0.0)
+    np.testing.assert_array_equal(tokens, jnp.argmax(logits, axis=-1))
+
+  @parameterized.parameters(
+      dict(top_k=1),
+      dict(top_p=0.5),
+      dict(top_p=0.5, top_p_candidates=2),
+  )
+  def test_top_k_top_p_keep_most_likely(self, **kwargs):
+    logits = jnp.log(jnp.array([[0.05, 0.05, 0.7, 0.1, 0.05, 0.05]] * 64))
+    tokens = decoding.sample_logits(logits, jax.random.PRNGKey(0), **kwargs)
+    np.testing.assert_array_equal(tokens, 2)
+
+  def test_top_p_keeps_enough_mass(self):
+    logits = jnp.log(jnp.array([[0.3, 0.0, 0.3, 0.0, 0.4, 0.0]] * 256))
+    tokens = decoding.sample_logits(
+        logits, jax.random.PRNGKey(0), top_p=0.6, top_p_candidates=4)
+    self.assertEqual(set(np.unique(tokens)), {0, 2, 4})
+
+  def test_mask_token_ids(self):
+    logits = _one_hot_logits(jnp.array([1, 2]))
+    tokens = decoding.sample_logits(
+        logits, jax.random.PRNGKey(0), temperature=0.0, mask_token_ids=(1,))
+    self.assertNotIn(1, tokens.tolist())
+    self.assertEqual(tokens[1], 2)
+
+  def test_sample_stops_at_eos(self):
+    logits = _one_hot_logits(jnp.array([1, 3]))
+    tokens, logprobs = jax.jit(
+        lambda l: decoding.sample(
+            _next_token_step, l, jnp.zeros((2,)), jax.random.PRNGKey(0),
+            max_decode_len=5, eos_token=4, temperature=0.0))(logits)
+    np.testing.assert_array_equal(tokens, [[1, 2, 3, 4, 0], [3, 4, 0, 0, 0]])
+    np.testing.assert_allclose(logprobs, 0.0, atol=1e-5)
+
+  def test_sample_forces_prompts(self):
+    logits = _one_hot_logits(jnp.array([1]))
+    prompts = jnp.array([[0, 0, 1, 0]])
+    tokens, _ = decoding.sample(
+        _next_token_step, logits, jnp.zeros((1,)), jax.random.PRNGKey(0),
+        max_decode_len=4, eos_token=4, prompts=prompts, temperature=0.0)
+    np.testing.assert_array_equal(tokens, [[1, 2, 1, 2]])
+
+  def test_num_samples(self):
+    logits = jnp.zeros((2, _VOCAB))
+    cache = {"k": jnp.arange(2.0)}
+    tokens, logprobs = decoding.sample(
+        lambda t, c: (jnp.zeros((t.shape[0], _VOCAB)), c),
+        logits, cache, jax.random.PRNGKey(0), max_decode_len=8, num_samples=3)
+    self.assertEqual(tokens.shape, (6, 8))
+    np.testing.assert_allclose(logprobs, np.log(1 / _VOCAB), rtol=1e-5)
+    # Samples of the same prompt are drawn independently.
+    self.assertFalse(np.all(tokens[0] == tokens[1]))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -147,6 +147,46 @@ def _update_kv_cache(module, k, v, cache_size, cache_dtype):
   return k_cache.value.astype(k.dtype), v_cache.value.astype(v.dtype)
 
 
+def _update_paged_kv_cache(module, k, v, block_table, page_size, num_pages,
+                           cache_dtype):
+  """Updates paged KV cache and returns the contents of each sequence's pages.
+
+  The keys and values of all sequences are stored in one pool of `num_pages`
+  pages of `page_size` rows each. Cache row r of sequence b is stored in page
+  `block_table[b, r // page_size]`, so memory is only used for the rows which
+  hold tokens. Page 0 is never allocated: the rows a sequence does not use
+  (e.g. padding before its prompt) are all written to it.
+
+  This only saves cache storage: attention still gathers each sequence's
+  pages into dense `[batch, cache_size]` keys and values at every step.
+  """
+  batch_size, update_len, num_heads, head_dim = k.shape
+  cache_dtype = cache_dtype or k.dtype
+
+  idx = module.variable("cache", "idx", jnp.zeros, (batch_size,), jnp.int32)
+
+  pages_shape = (num_pages, page_size, num_heads, head_dim)
+  k_pages = module.variable(
+      "cache", "k_pages", jnp.zeros, pages_shape, cache_dtype)
+  v_pages = module.variable(
+      "cache", "v_pages", jnp.zeros, pages_shape, cache_dtype)
+
+  # Write k, v of the prompt (prefill) or next token to their pages.
+  rows = idx.value[:, None] + jnp.arange(update_len)[None, :]
+  pages = jnp.take_along_axis(block_table, rows // page_size, axis=1)
+  k_pages.value = k_pages.value.at[pages, rows % page_size].set(
+      k.astype(cache_dtype))
+  v_pages.value = v_pages.value.at[pages, rows % page_size].set(
+      v.astype(cache_dtype))
+  idx.value = idx.value + update_len
+
+  # Gather the pages of each sequence: [batch, cache_size, heads, head_dim].
+  kv_shape = (batch_size, -1, num_heads, head_dim)
+  k = k_pages.value[block_table].reshape(kv_shape).astype(k.dtype)
+  v = v_pages.value[block_table].reshape(kv_shape).astype(v.dtype)
+  return k, v
+
+
 def trunc_norm_init(in_axis, out_axis, batch_axis):
   return nn.initializers.variance_scaling(
       1.0, "fan_in", "truncated_normal",
@@ -207,6 +247,8 @@ class Attention(nn.Module):
   head_dim: int
 
   cache_dtype: str | None = None
+  cache_page_size: int | None = None
+  cache_num_pages: int | None = None
 
   def setup(self):
     if self.num_kv_heads == self.num_heads:
@@ -232,7 +274,8 @@ class Attention(nn.Module):
     )
 
   @nn.compact
-  def __call__(self, x, positions, attn_mask, decode, deterministic=True):
+  def __call__(self, x, positions, attn_mask, decode, deterministic=True,
+               block_table=None):
     if self.num_kv_heads == self.num_heads:
       q, k, v = self.qkv_einsum("BSD,3KDH->3BSKH", x)
     else:
@@ -243,19 +286,44 @@ class Attention(nn.Module):
     q *= self.head_dim**-0.5
 
     k = _apply_rope(k, positions=positions)
-    if decode:
+
+    # With a shared prefix (see `share_prefix_cache`), the keys and values of
+    # the prefix are stored once per example and those of the tokens decoded
+    # after it once per sample; the attention mask spans both.
+    prefix_len = 0
+    if decode and self.has_variable("cache", "prefix_k"):
+      prefix_k = self.get_variable("cache", "prefix_k").astype(k.dtype)
+      prefix_v = self.get_variable("cache", "prefix_v").astype(v.dtype)
+      prefix_len = prefix_k.shape[1]
+    if decode and self.cache_page_size:
+      # The pool must be sized for the expected tokens in flight: as many pages
+      # as a dense cache would save no memory.
+      if not self.cache_num_pages:
+        raise ValueError("A paged kv-cache needs cache_num_pages.")
+      k, v = _update_paged_kv_cache(self, k, v, block_table,
+                                    page_size=self.cache_page_size,
+                                    num_pages=self.cache_num_pages,
+                                    cache_dtype=self.cache_dtype)
+    elif decode:
       k, v = _update_kv_cache(self, k, v,
-                              cache_size=attn_mask.shape[-1],
+                              cache_size=attn_mask.shape[-1] - prefix_len,
                               cache_dtype=self.cache_dtype)
 
     q = einops.rearrange(q, "B T (K G) H -> B T K G H", K=self.num_kv_heads)
     logits = jnp.einsum("BTKGH,BSKH->BKGTS", q, k)
+    if prefix_len:
+      q_per_prefix = einops.rearrange(
+          q, "(B N) T K G H -> B N T K G H", B=prefix_k.shape[0])
+      prefix_logits = jnp.einsum("BNTKGH,BSKH->BNKGTS", q_per_prefix, prefix_k)
+      prefix_logits = einops.rearrange(
+          prefix_logits, "B N K G T S -> (B N) K G T S")
+      logits = jnp.concatenate([prefix_logits, logits], axis=-1)
     logits = logits.astype(jnp.float32)
 
-    if attn_mask.shape != (q.shape[0], 1, q.shape[1], k.shape[1]):
+    if attn_mask.shape != (q.shape[0], 1, q.shape[1], prefix_len + k.shape[1]):
       raise ValueError(
           f"Attention mask with shape {attn_mask.shape} but shapes for q and k "
-          f"are: {q.shape} and {k.shape}"
+          f"are: {q.shape} and {k.shape} (prefix length {prefix_len})"
       )
 
     # big_neg = jnp.finfo(logits.dtype).min
@@ -264,7 +332,13 @@ class Attention(nn.Module):
 
     probs = jax.nn.softmax(masked_logits, axis=-1).astype(k.dtype)
 
-    encoded = jnp.einsum("BKGTS,BSKH->BTKGH", probs, v)
+    encoded = jnp.einsum("BKGTS,BSKH->BTKGH", probs[..., prefix_len:], v)
+    if prefix_len:
+      prefix_probs = einops.rearrange(
+          probs[..., :prefix_len], "(B N) K G T S -> B N K G T S",
+          B=prefix_k.shape[0])
+      prefix_encoded = jnp.einsum("BNKGTS,BSKH->BNTKGH", prefix_probs, prefix_v)
+      encoded += einops.rearrange(prefix_encoded, "B N T K G H -> (B N) T K G H")
     encoded = einops.rearrange(encoded, "B T K G H -> B T (K G) H")
     attn_output = self.attn_vec_einsum("BTNH,NHD->BTD", encoded)
 
@@ -312,6 +386,8 @@ class Block(nn.Module):
   dropout: float = 0.0
   dropout_bdims: tuple[int, ...] = ()
   cache_dtype: str | None = None
+  cache_page_size: int | None = None
+  cache_num_pages: int | None = None
 
   def setup(self):
     self.pre_attention_norm = RMSNorm()
@@ -321,6 +397,8 @@ class Block(nn.Module):
         features=self.embed_dim,
         head_dim=self.head_dim,
         cache_dtype=self.cache_dtype,
+        cache_page_size=self.cache_page_size,
+        cache_num_pages=self.cache_num_pages,
     )
     self.pre_ffw_norm = RMSNorm()
     self.mlp = FeedForward(features=self.embed_dim, hidden_dim=self.hidden_dim)
@@ -330,11 +408,11 @@ class Block(nn.Module):
       self.drop = lambda x, _: x
 
   def __call__(self, x, unused_scan_arg, positions, attn_mask,
-               decode, deterministic=True):
+               decode, deterministic=True, block_table=None):
     x = nn.with_logical_constraint(x, ("act_batch", "act_len", "act_emb"))
     inputs_normalized = self.pre_attention_norm(x)
     attn_output = self.attn(inputs_normalized, positions, attn_mask,
-                            decode, deterministic)
+                            decode, deterministic, block_table)
     attn_output = self.drop(attn_output, deterministic)
     attn_output += x
     residual = attn_output
@@ -362,6 +440,10 @@ class Model(nn.Module):
   dropout: float = 0.0
   dropout_bdims: tuple[int, ...] = ()  # Every float is dropped independently.
   cache_dtype: str | None = None
+  # With a page size, the kv-cache is a pool of `cache_num_pages` pages shared
+  # by all sequences (see `_update_paged_kv_cache`) instead of a dense buffer.
+  cache_page_size: int | None = None
+  cache_num_pages: int | None = None
 
   # TODO: Wire this in all places needed so that the model can be
   # run with different activation dtype. For now only float32 runs.
@@ -378,6 +460,7 @@ class Model(nn.Module):
       pre_logits=None,
       positions=None, mask=None,
       decode=False, deterministic=True,
+      block_table=None,
   ):
     """Embed only, or complete forward pass.
 
@@ -391,6 +474,8 @@ class Model(nn.Module):
       mask: Optional attention mask `[B, T, S]`.
       decode: Whether to use kv-cache. Caller must pass masks and positions.
       deterministic: Forwarded to all dropout layers.
+      block_table: int `[B, S / cache_page_size]` pages of each sequence's
+        kv-cache rows. Required to decode with a paged cache.
 
     Returns:
       If `embed_only=False`, then `(logits, out)` will be returned.
@@ -455,6 +540,8 @@ class Model(nn.Module):
         dropout=self.dropout,
         dropout_bdims=self.dropout_bdims,
         cache_dtype=self.cache_dtype,
+        cache_page_size=self.cache_page_size,
+        cache_num_pages=self.cache_num_pages,
     )
     layers = self.scope.push("layers")
     if self.scan:
@@ -479,7 +566,8 @@ class Model(nn.Module):
     unused_scan_arg = ()
     for block in blocks:
       x, unused_scan_arg = block(
-          x, unused_scan_arg, positions, mask, decode, deterministic)
+          x, unused_scan_arg, positions, mask, decode, deterministic,
+          block_table)
 
     assert x.dtype == jnp.dtype(self.embed_dtype)  # Sanity check.
     out["encoded"] = x
@@ -17,6 +17,7 @@
 import functools
 from typing import Any, Optional
 
+from big_vision.models import decoding
 from big_vision.models.proj.givt import parallel_decode
 import flax
 from flax import linen as nn
@@ -46,45 +47,6 @@ def _sample_gmm(
   return samples, logprobs
 
 
-# Beam search reshaping utils
-def _flatten_samples_dim(x):
-  """Flattens samples dimension into batch dimension."""
-  if x.ndim == 0:  # ignore scalars (e.g. cache index)
-    return x
-  return x.reshape((x.shape[0] * x.shape[1],) + x.shape[2:])
-
-
-def _unflatten_samples_dim(x, batch_size, num_samples):
-  """Unflattens first dimension into batch and samples dimensions."""
-  if x.ndim == 0:  # ignore scalars (e.g. cache index)
-    return x
-  assert batch_size * num_samples == x.shape[0]
-  return x.reshape((batch_size, num_samples) + x.shape[1:])
-
-
-def _cache_map(fn, cache, scan=False):
-  """Maps function over cache."""
-  if scan:
-    # Assuming the chache is scanned over the first dimension, we apply a map
-    # function over this dimension for scanned models
-    fn_mod = lambda x: jax.lax.map(fn, x) if x.ndim > 0 else fn(x)
-  else:
-    fn_mod = fn
-
-  frozen = isinstance(cache, flax.core.FrozenDict)
-  if frozen:
-    cache = flax.core.unfreeze(cache)
-  flat_cache = flax.traverse_util.flatten_dict(cache)
-  # Exclude cached relative position bias from beam expansion, etc.
-  keyvals = {k: v for k, v in flat_cache.items() if k[-1] != "cached_bias"}
-  keyvals = jax.tree_map(fn_mod, keyvals)
-  flat_cache.update(keyvals)
-  new_cache = flax.traverse_util.unflatten_dict(flat_cache)
-  if frozen:
-    new_cache = flax.core.freeze(new_cache)
-  return new_cache
-
-
 @flax.struct.dataclass
 class LoopState:
   """Internal state of the sampling loop."""
@@ -95,10 +57,11 @@ class LoopState:
   # s:  seaquence length
   # d:  feature dimension
   rng: jnp.ndarray        # PRNGKey of the loop state.
-  cache: Any              # Cache for fast auto-regressive decoding.
+  # Cache for fast auto-regressive decoding. With CFG, it holds the
+  # unconditional branch as a second half of the batch (2 * b).
+  cache: Any
   sequences: jnp.ndarray  # (b * nb, s, d)
   logprobs: jnp.ndarray   # (b * nb, s, d)
-  cache_u: Any            # Uncond cache if cfg, otherwise None
 
 
 def _create_cache(
@@ -107,14 +70,9 @@ def _create_cache(
     init_sequence,
     params,
     encoded,
-    uncond=False,
+    drop_labels=None,
 ):
   """Creates the cache and returns initial logits."""
-  if uncond:
-    assert labels is not None  # Need labels for CFG!
-    drop_labels = jnp.ones((labels.shape[0],), dtype=jnp.bool_)
-  else:
-    drop_labels = None
 
   def init_cache(model):
     return model.decode(
@@ -135,6 +93,11 @@ def _create_cache(
   return cache, prefill_logits
 
 
+def _with_uncond_branch(*xs):
+  """Appends a copy of the batch for the unconditional CFG branch."""
+  return [None if x is None else jnp.concatenate([x, x]) for x in xs]
+
+
 def generate(
     params: Any,
     seed: jax.Array,
@@ -188,14 +151,29 @@ def generate(
   else:
     encoded = None
 
-  cache, prefill_logits = _create_cache(
-      labels, model, init_sequence, params, encoded
-  )
-
   cfg_inference_weight = config.pop("cfg_inference_weight", None)
   if cfg_inference_weight == 0.0:
     cfg_inference_weight = None
-  cfg = cfg_inference_weight is not None
+  # Token t is sampled with CFG if start <= t < end.
+  start, end = parallel_decode.get_guidance_steps(
+      seq_len, config.pop("cfg_interval", (0.0, 1.0)))
+  cfg = cfg_inference_weight is not None and start < end
+
+  if cfg:
+    assert beam_size == 1 and fan_size == 1  # CFG + Beam not supported.
+    assert labels is not None  # Need labels for CFG!
+    # Both branches share the encoded image and are prefilled and decoded
+    # together, the unconditional one as the second half of the batch.
+    cfg_labels, cfg_encoded = _with_uncond_branch(labels, encoded)
+    cfg_drop_labels = jnp.arange(2 * batch_size) >= batch_size
+    cache, prefill_logits = _create_cache(
+        cfg_labels, model, *_with_uncond_branch(init_sequence), params,
+        cfg_encoded, drop_labels=cfg_drop_labels)
+    prefill_logits, prefill_logits_u = jnp.split(prefill_logits, 2)
+  else:
+    cache, prefill_logits = _create_cache(
+        labels, model, init_sequence, params, encoded
+    )
 
   get_pdf = functools.partial(
       model.get_pdf,
@@ -203,51 +181,41 @@ def generate(
       temperature_probs=config.pop("temp_probs", None),
   )
 
-  # setup sampling function
-  sample = functools.partial(
-      _sample_gmm, cfg_inference_weight=cfg_inference_weight
-  )
-
   # draw first output token
   pdf_first = get_pdf(prefill_logits)
   rng_first, rng = jax.random.split(seed)
 
-  if cfg:
-    assert beam_size == 1 and fan_size == 1  # CFG + Beam not supported.
-    cache_u, prefill_logits_u = _create_cache(
-        labels, model, init_sequence, params, encoded, uncond=True
-    )
-    pdf_first_u = get_pdf(prefill_logits_u)
+  if cfg and start == 0:
+    tokens_first, logprobs_first = _sample_gmm(
+        pdf_first, rng=rng_first, cfg_inference_weight=cfg_inference_weight,
+        gmm_pdf_uncond=get_pdf(prefill_logits_u))
   else:
-    cache_u = None
-    pdf_first_u = None
-
-  tokens_first, logprobs_first = sample(
-      pdf_first, rng=rng_first, gmm_pdf_uncond=pdf_first_u
-  )
+    tokens_first, logprobs_first = _sample_gmm(pdf_first, rng=rng_first)
   init_sequence = init_sequence.at[:, 0].set(tokens_first.squeeze(axis=1))
   init_logprobs = init_logprobs.at[:, 0].set(logprobs_first.squeeze(axis=1))
 
-  def tokens_to_logits(tokens, cache, uncond=False):
-    if uncond:
-      drop_labels = jnp.ones((labels.shape[0],), dtype=jnp.bool_)
-    else:
-      drop_labels = None
+  def tokens_to_logits(tokens, cache, fused):
+    """Returns the conditional and (if `fused`) unconditional logits."""
+    if fused:
+      tokens, = _with_uncond_branch(tokens)
 
     def decode_step(model, tokens):
-      return model.decode(tokens, labels, encoded,
-                          decode=True, drop_labels=drop_labels)
+      if fused:
+        return model.decode(tokens, cfg_labels, cfg_encoded,
+                            decode=True, drop_labels=cfg_drop_labels)
+      return model.decode(tokens, labels, encoded, decode=True)
 
     logits, aux = nn.apply(decode_step, model, mutable=True)(
         {"params": params["params"], "cache": cache}, tokens)
-    return logits, aux["cache"]
+    if fused:
+      return *jnp.split(logits, 2), aux["cache"]
+    return logits, None, aux["cache"]
 
   init_state = LoopState(
       cache=cache,
       sequences=init_sequence,  # (b * nb, s, d)
       logprobs=init_logprobs,   # (b * nb, s, d)
       rng=rng,
-      cache_u=cache_u,
   )
 
   rand_top_k = config.pop("rand_top_k", False)
@@ -255,32 +223,31 @@ def generate(
 
   assert not config, f"Sampling config is expected to be empty: {config}"
 
-  def sampling_iteration(i, state):
+  def sampling_iteration(i, state, fused, guided):
+    """Samples token i + 1, with CFG if `guided`."""
     rng_sampling, rng_local = jax.random.split(state.rng)
     cur_tokens = state.sequences[:, i][:, None]
     # (b * nb, d)
-    cur_logits, cache = tokens_to_logits(cur_tokens, state.cache)
+    cur_logits, cur_logits_u, cache = tokens_to_logits(
+        cur_tokens, state.cache, fused)
 
     # (b, nb, d)
-    cur_logits = _unflatten_samples_dim(
+    cur_logits = decoding.unflatten_samples_dim(
         cur_logits, batch_size, beam_size).squeeze(axis=2)
 
     # (b, nb * nf, d)
     cur_pdf = get_pdf(cur_logits.repeat(fan_size, axis=1))
 
-    if cfg:
-      cur_logits_u, cache_u = tokens_to_logits(
-          cur_tokens, state.cache_u, uncond=True
-      )
-      cur_logits_u = _unflatten_samples_dim(
+    if guided:
+      cur_logits_u = decoding.unflatten_samples_dim(
           cur_logits_u, batch_size, beam_size).squeeze(axis=2)
       cur_pdf_u = get_pdf(cur_logits_u.repeat(fan_size, axis=1))
-      new_tokens, new_logprobs = sample(
-          cur_pdf, rng=rng_sampling, gmm_pdf_uncond=cur_pdf_u
+      new_tokens, new_logprobs = _sample_gmm(
+          cur_pdf, rng=rng_sampling, cfg_inference_weight=cfg_inference_weight,
+          gmm_pdf_uncond=cur_pdf_u
       )
     else:
-      new_tokens, new_logprobs = sample(cur_pdf, rng=rng_sampling)
-      cache_u = None
+      new_tokens, new_logprobs = _sample_gmm(cur_pdf, rng=rng_sampling)
 
     if gt is not None:
       assert keep_gt is not None
@@ -295,11 +262,11 @@ def generate(
           rng=rng_local,
           sequences=sequences,
           logprobs=state.logprobs,
-          cache_u=cache_u,
       )
 
     # (b, nb, s, d)
-    logprobs = _unflatten_samples_dim(state.logprobs, batch_size, beam_size)
+    logprobs = decoding.unflatten_samples_dim(
+        state.logprobs, batch_size, beam_size)
     cur_logprobs = logprobs[:, :, i]  # (b, nb, d)
     # (b, nb * nf, d)
     new_logprobs = new_logprobs + cur_logprobs.repeat(fan_size, axis=1)
@@ -343,43 +310,48 @@ def generate(
       #                f"{top_beam_fan_indices.max()} vs. {x.shape[1]}")
       return jnp.take_along_axis(x, top_beam_fan_indices[..., None], axis=1)
     # (b, nb, s, d)
-    sequences = _unflatten_samples_dim(state.sequences, batch_size, beam_size)
+    sequences = decoding.unflatten_samples_dim(
+        state.sequences, batch_size, beam_size)
     sequences = _gather_beams(sequences)  # (b, nb, s, d)
     sequences = sequences.at[:, :, i + 1].set(_gather_tokens(new_tokens))
     # (b, nb, s, d)
-    sequences = _flatten_samples_dim(sequences)
+    sequences = decoding.flatten_samples_dim(sequences)
 
     logprobs = _gather_beams(logprobs)
     logprobs = logprobs.at[:, :, i + 1].set(_gather_tokens(new_logprobs))
-    logprobs = _flatten_samples_dim(logprobs)
+    logprobs = decoding.flatten_samples_dim(logprobs)
 
     scanned_cache = getattr(model, "scan", False)
-    cache = _cache_map(
-        lambda x: _unflatten_samples_dim(x, batch_size, beam_size),
+    cache = decoding.cache_map(
+        lambda x: decoding.unflatten_samples_dim(x, batch_size, beam_size),
         cache, scanned_cache)
-    cache = _cache_map(_gather_beams, cache, scanned_cache)
-    cache = _cache_map(_flatten_samples_dim, cache, scanned_cache)
-
-    if cfg:
-      assert cache_u is not None
-      cache_u = _cache_map(
-          lambda x: _unflatten_samples_dim(x, batch_size, beam_size),
-          cache_u, scanned_cache
-      )
-      cache_u = _cache_map(_gather_beams, cache_u, scanned_cache)
-      cache_u = _cache_map(_flatten_samples_dim, cache_u, scanned_cache)
-    else:
-      assert cache_u is None
+    cache = decoding.cache_map(_gather_beams, cache, scanned_cache)
+    cache = decoding.cache_map(
+        decoding.flatten_samples_dim, cache, scanned_cache)
 
     return LoopState(
         cache=cache,
         rng=rng_local,
         sequences=sequences,
         logprobs=logprobs,
-        cache_u=cache_u,
     )
 
-  final_state = lax.fori_loop(0, seq_len, sampling_iteration, init_state)
+  # Iteration i samples token i + 1. The iterations before, during and after
+  # the CFG interval run as separate loops. The unconditional branch is
+  # evaluated until the end of the interval (to keep its cache complete), and
+  # then dropped from the cache.
+  state, i = init_state, 0
+  if cfg:
+    for guided, until in ((False, max(start - 1, 0)), (True, end - 1)):
+      if until > i:
+        state = lax.fori_loop(i, until, functools.partial(
+            sampling_iteration, fused=True, guided=guided), state)
+        i = until
+    state = state.replace(cache=decoding.cache_map(
+        lambda x: x if x.ndim == 0 else x[:batch_size],
+        state.cache, getattr(model, "scan", False)))
+  final_state = lax.fori_loop(i, seq_len, functools.partial(
+      sampling_iteration, fused=False, guided=False), state)
   final_logprobs = final_state.logprobs[::beam_size][:, -1].sum(axis=-1)
 
   # return top beams and corresponding log probs
@@ -116,6 +116,38 @@ class DecodeTest(parameterized.TestCase):
     config = {"cfg_inference_weight": cfg_inference_weight}
     self._test_model(rng, model, variables, config)
 
+  @parameterized.product(
+      cfg_interval=[(0.0, 0.5), (0.25, 0.75), (0.5, 1.0)],
+      encoder=[True, False],
+  )
+  def test_cfg_interval(self, cfg_interval, encoder):
+    model, variables = self._make_model(
+        num_mixtures=1,
+        drop_labels_probability=0.1,
+        num_layers=1 if encoder else 0,
+    )
+    config = {"cfg_inference_weight": 1.0, "cfg_interval": cfg_interval}
+    self._test_model(jax.random.PRNGKey(0), model, variables, config)
+
+  def test_empty_cfg_interval_skips_cfg(self):
+    model, variables = self._make_model(
+        num_mixtures=1, drop_labels_probability=0.1)
+    labels = jnp.ones((_BATCH_SIZE,), dtype=jnp.int32)
+    results = [
+        decode.generate(
+            params=variables,
+            seed=jax.random.PRNGKey(0),
+            seq_len=_SEQ_LEN,
+            feature_dim=_OUT_DIM,
+            labels=labels,
+            model=model,
+            config=config,
+        )[0]
+        for config in ({}, {"cfg_inference_weight": 1.0,
+                            "cfg_interval": (0.5, 0.5)})
+    ]
+    self.assertTrue(jnp.array_equal(*results))
+
 
 if __name__ == "__main__":
   googletest.main()
@@ -30,6 +30,7 @@ In each step:
 """
 
 import dataclasses
+import functools
 from typing import Literal
 
 from absl import logging
@@ -43,19 +44,46 @@ import jax.numpy as jnp
 _CONFIDENCE_OF_KNOWN_TOKENS = jnp.inf
 
 
-@jax.vmap
-def _get_per_batch_mask(arr, k):
-  (d,) = arr.shape
-  indices = jnp.argsort(arr)
-  valid_indices = jnp.arange(d) < k
-  return jnp.zeros((d,), jnp.bool_).at[indices].set(valid_indices)
+def _sortable_keys(arr):
+  """Maps float values to uint32 keys which compare like the values."""
+  arr = arr.astype(jnp.float32)
+  # Like sorting, treat -0 as 0 and put all NaNs after inf.
+  arr = jnp.where(arr == 0, 0.0, arr)
+  arr = jnp.where(jnp.isnan(arr), jnp.nan, arr)
+  bits = jax.lax.bitcast_convert_type(arr, jnp.uint32)
+  sign = jnp.uint32(1 << 31)
+  # Negative values have the sign bit set and order by decreasing magnitude.
+  return jnp.where(bits >= sign, ~bits, bits | sign)
 
 
 def _get_bottom_k_mask(arr, k):
+  """Returns a mask of the `k` smallest values in the last axis of `arr`.
+
+  Ties are broken by position, as with a stable argsort. As `k` is a traced
+  (per-row) value, this finds the k-th smallest value by bisecting its bits
+  (32 counting passes) instead of sorting each row.
+
+  Args:
+    arr: values [..., d].
+    k: number of values to select per row, broadcastable to [prod(...), 1].
+
+  Returns:
+    bool mask [..., d].
+  """
   *leading, d = arr.shape
-  arr = arr.reshape((-1, d))
-  mask = _get_per_batch_mask(arr, k)
-  return mask.reshape(*leading, -1)
+  keys = _sortable_keys(arr.reshape((-1, d)))
+  k = jnp.reshape(k, (-1, 1))
+  # The k-th smallest key is the largest threshold with fewer than k keys
+  # below it, found from the most significant bit down.
+  threshold = jnp.zeros((keys.shape[0], 1), jnp.uint32)
+  for bit in reversed(range(32)):
+    candidate = threshold | jnp.uint32(1 << bit)
+    num_below = jnp.sum(keys < candidate, axis=-1, keepdims=True)
+    threshold = jnp.where(num_below < k, candidate, threshold)
+  num_below = jnp.sum(keys < threshold, axis=-1, keepdims=True)
+  ties = keys == threshold
+  mask = (keys < threshold) | (ties & (jnp.cumsum(ties, -1) <= k - num_below))
+  return mask.reshape(*leading, d)
 
 
 def mask_by_random_topk(rng, mask_len, probs, temperature=1.0):
@@ -226,6 +254,8 @@ class MaskedGenerationConfig:
       maskgit: Maskgit style, use P[samples]
     schedule: Inference mask schedule.
     cfg_inference_weight: CFG Inference weight.
+    cfg_interval: (start, end) fractions of the steps during which CFG is
+      applied. The unconditional branch is not evaluated on other steps.
   """
   num_steps: int = 16
   should_anneal_temperature: bool = True
@@ -233,6 +263,17 @@ class MaskedGenerationConfig:
   ordering: Literal["maskgit"] = "maskgit"
   schedule: str = "cosine"
   cfg_inference_weight: float = 0.0
+  cfg_interval: tuple[float, float] = (0.0, 1.0)
+
+
+def get_guidance_steps(
+    num_steps: int, cfg_interval: tuple[float, float]
+) -> tuple[int, int]:
+  """Returns the [start, end) steps in which to apply CFG."""
+  start, end = cfg_interval
+  if not 0.0 <= start <= end <= 1.0:
+    raise ValueError(f"Invalid CFG interval: {cfg_interval}")
+  return round(start * num_steps), round(end * num_steps)
 
 
 def _assert_single_component_get_loc_scale(
@@ -407,21 +448,30 @@ def decode_masked(
       num_steps=config.num_steps,
   )
 
-  def loop_cond_fn(state: DecodeState):
-    return state.step < state.num_steps
-
-  def tokens_to_logits(tokens, input_mask, drop_labels=None):
-    return model.apply(
+  # With CFG, the unconditional branch is appended to the batch, so both are
+  # evaluated in one call.
+  cfg_labels = jnp.concatenate([labels, labels])
+  cfg_drop_labels = jnp.arange(2 * b) >= b
+
+  def tokens_to_logits(tokens, input_mask, guided):
+    """Returns the conditional and (if `guided`) unconditional logits."""
+    if guided:
+      tokens = jnp.concatenate([tokens, tokens])
+      input_mask = jnp.concatenate([input_mask, input_mask])
+    logits = model.apply(
         variables,
         tokens,
-        labels=labels,
+        labels=cfg_labels if guided else labels,
         # Note that the model applies the mask token internally given the input.
         input_mask=input_mask,
-        drop_labels=drop_labels,
+        drop_labels=cfg_drop_labels if guided else None,
         method="decode",
     )
+    if guided:
+      return jnp.split(logits, 2)
+    return logits, None
 
-  def loop_body_fn(state: DecodeState) -> DecodeState:
+  def loop_body_fn(state: DecodeState, guided: bool) -> DecodeState:
     # 1 where we should mask, cumulative.
     unknown = jnp.logical_not(state.total_uncovered)
 
@@ -441,17 +491,15 @@ def decode_masked(
         jnp.minimum(num_unknown - 1, mask_len))
 
     # Run model ---
-    logits = tokens_to_logits(state.current_inputs_q, unknown)
+    logits, logits_uncond = tokens_to_logits(
+        state.current_inputs_q, unknown, guided
+    )
     # Book keeping: store all logits.
     state = state.set_logits_at_current_step(logits)
 
     pdf = model.get_pdf(logits)
     state, sample_rng = state.split_rng()
-    if config.cfg_inference_weight > 0:
-      drop_all_labels = jnp.full((b,), True, jnp.bool_)
-      logits_uncond = tokens_to_logits(
-          state.current_inputs_q, unknown, drop_labels=drop_all_labels
-      )
+    if guided:
       state = state.set_uncond_logits_at_current_step(logits_uncond)
       pdf_uncond = model.get_pdf(logits_uncond)
       state, cfg_rng = state.split_rng()
@@ -480,7 +528,7 @@ def decode_masked(
     prob = pdf.prob(sampled)
     if model.multivariate:
       assert prob.ndim == 2  # (b, seq_len) already
-    elif model.per_channel_mixtures or config.cfg_inference_weight > 0:
+    elif model.per_channel_mixtures or guided:
       # Independence accross channels.
       # This reduction is also required when using CFG and also
       # `model.per_channel_mixtures == False` due to the 2-step CFG redefining
@@ -520,4 +568,19 @@ def decode_masked(
     state = state.set_next_input(sampled)
     return state.increment_step()
 
-  return jax.lax.while_loop(loop_cond_fn, loop_body_fn, init_state)
+  if config.cfg_inference_weight > 0:
+    start, end = get_guidance_steps(config.num_steps, config.cfg_interval)
+  else:
+    start = end = 0
+  # Steps before, during and after the CFG interval run as separate loops, so
+  # that the unguided steps skip the unconditional branch.
+  state, step = init_state, 0
+  for guided, until in ((False, start), (True, end), (False, config.num_steps)):
+    if until > step:
+      state = jax.lax.while_loop(
+          lambda state, until=until: state.step < until,
+          functools.partial(loop_body_fn, guided=guided),
+          state,
+      )
+      step = until
+  return state
@@ -71,6 +71,20 @@ class HelperTest(googletest.TestCase):
           parallel_decode._get_bottom_k_mask(values, k), _mask(1, 1, 1, 0, 0)
       )
 
+  def test_bottom_k_mask_matches_argsort(self):
+    # Few distinct values, so that most rows have ties.
+    values = jax.random.randint(jax.random.PRNGKey(0), (2, 8, 64), -3, 3)
+    values = jnp.asarray([-jnp.inf, -1.5, -0.0, 0.0, 0.5, jnp.inf])[values + 3]
+    k = jax.random.randint(jax.random.PRNGKey(1), (16, 1), 0, 66)
+    expected = jnp.zeros((16, 64), jnp.bool_)
+    indices = jnp.argsort(values.reshape(16, 64), axis=-1)
+    expected = jax.vmap(lambda m, i, v: m.at[i].set(v))(
+        expected, indices, jnp.arange(64) < k)
+    chex.assert_trees_all_equal(
+        parallel_decode._get_bottom_k_mask(values, k),
+        expected.reshape(2, 8, 64),
+    )
+
 
 class ParallelDecodeTest(parameterized.TestCase):
 
@@ -149,6 +163,29 @@ class ParallelDecodeTest(parameterized.TestCase):
     )
     self._test_model(rng, model, variables, config)
 
+  @parameterized.product(
+      cfg_interval=[(0.0, 0.5), (0.25, 0.75), (0.5, 1.0)],
+      per_channel_mixtures=[True, False],
+  )
+  def test_cfg_interval(self, cfg_interval, per_channel_mixtures):
+    model, variables = self._make_model(
+        num_mixtures=1 if per_channel_mixtures else 3,
+        drop_labels_probability=0.1,
+        per_channel_mixtures=per_channel_mixtures,
+    )
+    config = parallel_decode.MaskedGenerationConfig(
+        num_steps=4,
+        cfg_inference_weight=1.0,
+        cfg_interval=cfg_interval,
+    )
+    self._test_model(jax.random.PRNGKey(0), model, variables, config)
+
+  def test_get_guidance_steps(self):
+    self.assertEqual(
+        parallel_decode.get_guidance_steps(16, (0.25, 0.75)), (4, 12))
+    with self.assertRaises(ValueError):
+      parallel_decode.get_guidance_steps(16, (0.75, 0.25))
+
 
 if __name__ == "__main__":
   googletest.main()
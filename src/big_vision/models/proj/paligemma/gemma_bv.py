@@ -14,6 +14,8 @@
 
 """Gemma wrapper to make it work for us."""
 
+from collections.abc import Mapping
+
 from big_vision.models.ppp import gemma
 import flax.linen as nn
 import jax
@@ -29,6 +31,8 @@ def _get_config(model):
   config.dropout = model.dropout
   config.dropout_bdims = model.dropout_bdims
   config.cache_dtype = model.cache_dtype
+  config.cache_page_size = model.cache_page_size
+  config.cache_num_pages = model.cache_num_pages
   return config
 
 
@@ -46,6 +50,21 @@ def _left_to_right_align(x, input_mask, attn_mask):
   return x, input_mask, attn_mask
 
 
+def _allocate_pages(cache_begin, cache_size, page_size):
+  """Returns a block table with consecutive pages for the rows in use.
+
+  Each sequence gets pages for its rows from `cache_begin` to `cache_size`
+  (the prompt and the tokens to decode), rows before point to the unused
+  page 0.
+  """
+  num_blocks = cache_size // page_size
+  first = (cache_begin // page_size)[:, None]
+  counts = num_blocks - first
+  start = 1 + jnp.cumsum(counts, axis=0) - counts
+  blocks = jnp.arange(num_blocks)[None, :]
+  return jnp.where(blocks >= first, start + blocks - first, 0).astype(jnp.int32)
+
+
 class Model(nn.Module):
   """Wrapping gemma big_vision model."""
   variant: str = "gemma_2b"
@@ -56,6 +75,14 @@ class Model(nn.Module):
   dropout: float = 0.0
   dropout_bdims: tuple[int, ...] = ()  # Every float is dropped independently.
   cache_dtype: str | None = "bfloat16"  # bfloat16 to save memory and transfers.
+  # Paged cache (see `gemma._update_paged_kv_cache`): memory scales with the
+  # tokens of each sequence instead of the padded prompt plus decode length,
+  # given a pool of `cache_num_pages` smaller than a dense cache. Only plain
+  # `prefill_cache`/`extend_cache` decoding supports it: `share_prefix_cache`
+  # and `insert_prefilled` (so best-of-n, beam search and continuous batching)
+  # need a dense cache.
+  cache_page_size: int | None = None
+  cache_num_pages: int | None = None
 
   def setup(self):
     # The parent+name avoids an unnecessary nesting in params pytree.
@@ -87,7 +114,8 @@ class Model(nn.Module):
     )
     return logits, out
 
-  def prefill_cache(self, x, input_mask, attn_mask, *, cache_size):
+  def prefill_cache(self, x, input_mask, attn_mask, *, cache_size,
+                    block_table=None):
     """Initializes decoding cache with `x` [B, N, E] as prompt.
 
     IMPORTANT: Inputs MUST be left-aligned and attn_mask should not allow
@@ -107,7 +135,12 @@ class Model(nn.Module):
       cache_size: int. Indicates the size of the cache. The prompt will consume
         the first N entries of the cache. Each subsequent extend_cache will
         consume one entry. Behaviour is undefined when prefill_len plus number
-        of extend_cache exceeds the cache_size.
+        of extend_cache exceeds the cache_size. With a paged cache, it is
+        rounded up to a multiple of the page size.
+      block_table: Optional int[B, cache_size / cache_page_size] pages of each
+        sequence's cache rows, e.g. from an allocator shared by requests. By
+        default the rows in use are given consecutive pages from page 1. The
+        behaviour is undefined if the pages exceed `cache_num_pages`.
 
     Returns:
       logits of the last valid token (i.e. last logits where input_mask=True).
@@ -137,6 +170,14 @@ class Model(nn.Module):
         "cache", "cache_end", jnp.full((batch_size,), prefill_len, jnp.int32)
     )
 
+    if self.cache_page_size:
+      page_size = self.cache_page_size
+      cache_size = -(-cache_size // page_size) * page_size
+      if block_table is None:
+        block_table = _allocate_pages(prefill_len - seq_len, cache_size,
+                                      page_size)
+      self.put_variable("cache", "block_table", block_table)
+
     # Pad attention to set the cache size.
     mask = jnp.pad(attn_mask, ((0, 0), (0, 0), (0, cache_size - prefill_len)))
 
@@ -146,14 +187,22 @@ class Model(nn.Module):
         positions=positions,
         mask=mask,
         decode=True,
+        block_table=block_table,
     )
     return self.compute_logits(aux["pre_logits"][:, -1:])
 
   def extend_cache(self, x):
     """Extends decoding cache with `x` [B, 1, E] and returns logits."""
     assert x.shape[1] == 1, "Only supports extend the cache by one token."
-    if self.model.scan:
-      cache_size = self.variables["cache"]["layers"]["attn"]["k_cache"].shape[2]
+    block_table = None
+    if self.cache_page_size:
+      block_table = self.get_variable("cache", "block_table")
+      cache_size = block_table.shape[1] * self.cache_page_size
+    elif self.model.scan:
+      attn_cache = self.variables["cache"]["layers"]["attn"]
+      cache_size = attn_cache["k_cache"].shape[2]
+      if "prefix_k" in attn_cache:  # See `share_prefix_cache`.
+        cache_size += attn_cache["prefix_k"].shape[2]
     else:
       raise NotImplementedError("Not implemented yet.")
 
@@ -172,7 +221,8 @@ class Model(nn.Module):
 
     logits, _ = self.model(
         tokens=None, embedded_prefix=x,
-        positions=positions[:, None], mask=mask, decode=True)
+        positions=positions[:, None], mask=mask, decode=True,
+        block_table=block_table)
     return logits
 
   @property
@@ -180,4 +230,98 @@ class Model(nn.Module):
     return _get_config(self).width
 
 
+def share_prefix_cache(cache, n, suffix_len):
+  """Turns a cache prefilled with B prompts into one to decode B*n samples.
+
+  Unlike repeating the whole cache n times, the keys and values of the prompts
+  are kept once per prompt (as "prefix_k"/"prefix_v"), and only `suffix_len`
+  new cache entries are allocated per sample. The prompts must have been
+  prefilled with `cache_size` equal to their length, i.e. no room to decode.
+  Samples are ordered as `(prompt, sample)`, like `jnp.repeat(x, n, axis=0)`.
+
+  Args:
+    cache: the "cache" collection after `Model.prefill_cache`.
+    n: number of samples per prompt.
+    suffix_len: maximum number of tokens decoded per sample.
+
+  Returns:
+    The cache collection to call `Model.extend_cache` with.
+  """
+  if "block_table" in cache:
+    raise ValueError("A paged cache can not be shared by samples.")
+  shared = {}
+  for name, x in cache.items():
+    if isinstance(x, Mapping):
+      shared[name] = share_prefix_cache(x, n, suffix_len)
+    elif name in ("k_cache", "v_cache"):
+      # [batch, (layers,) cache_size, kv_heads, head_dim]
+      shared[f"prefix_{name[0]}"] = x
+      shared[name] = jnp.zeros(
+          (x.shape[0] * n, *x.shape[1:-3], suffix_len, *x.shape[-2:]), x.dtype)
+    elif name == "idx":  # Next cache row to write, now in the sample's cache.
+      shared[name] = jnp.zeros((x.shape[0] * n, *x.shape[1:]), x.dtype)
+    else:
+      shared[name] = jnp.repeat(x, n, axis=0)
+  return shared
+
+
+def insert_prefilled(cache, prefilled, slots, end):
+  """Writes prefilled prompts into `slots` of a decoding cache.
+
+  This is used to admit new sequences into a running batch (continuous
+  batching). All sequences of `cache` write their next token to the same row
+  `end` (see `_update_kv_cache`), so the prompts are placed to end there. Keys
+  and values are cached after RoPE with their own positions, so the rows they
+  occupy do not matter.
+
+  Args:
+    cache: the "cache" collection being decoded, with S sequences.
+    prefilled: the "cache" collection after `Model.prefill_cache` of n prompts
+      with `cache_size` equal to their padded length P.
+    slots: int[n], the sequences of `cache` to replace.
+    end: int, the next row of `cache` to write. Must be at least P.
+
+  Returns:
+    The updated cache collection.
+  """
+  if "block_table" in cache:
+    raise ValueError("Slots of a paged cache are set by its block table.")
+  out = {}
+  for name, x in cache.items():
+    y = prefilled[name]
+    if isinstance(x, Mapping):
+      out[name] = insert_prefilled(x, y, slots, end)
+    elif name in ("k_cache", "v_cache"):
+      # [batch, (layers,) cache_size, kv_heads, head_dim]
+      start = (0,) * (x.ndim - 3) + (end - y.shape[-3], 0, 0)
+      rows = jax.lax.dynamic_update_slice(x[slots], y.astype(x.dtype), start)
+      out[name] = x.at[slots].set(rows)
+    elif name in ("idx", "cache_end"):  # Shared by all sequences.
+      out[name] = x
+    elif name == "cache_begin":
+      out[name] = x.at[slots].set(y + end - prefilled["cache_end"])
+    else:
+      out[name] = x.at[slots].set(y)
+  return out
+
+
+def shift_cache(cache, shift):
+  """Moves the rows of a decoding cache `shift` rows towards the start.
+
+  Frees `shift` rows at the end of the cache for decoding, dropping the first
+  `shift` rows, which must not be in use by any sequence still decoding.
+  """
+  out = {}
+  for name, x in cache.items():
+    if isinstance(x, Mapping):
+      out[name] = shift_cache(x, shift)
+    elif name in ("k_cache", "v_cache"):
+      out[name] = jnp.roll(x, -shift, axis=-3)
+    elif name in ("idx", "cache_begin", "cache_end"):
+      out[name] = x - shift
+    else:
+      out[name] = x
+  return out
+
+
 load = gemma.load
@@ -0,0 +1,79 @@
+# Copyright 2024 Big Vision Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from absl.testing import parameterized
+from big_vision.models.proj.paligemma import gemma_bv
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from absl.testing import absltest
+
+
+_BATCH_SIZE = 2
+_PROMPT_LEN = 6
+_CACHE_SIZE = 12
+_NUM_STEPS = 3
+
+
+def _decode(model, params, x, input_mask, **kwargs):
+  """Returns the logits of prefilling `x` and extending by _NUM_STEPS tokens."""
+  attn_mask = jnp.tril(jnp.ones((_PROMPT_LEN, _PROMPT_LEN), jnp.bool_))
+  attn_mask = attn_mask[None] & input_mask[:, None, :]
+  logits, variables = model.apply(
+      {"params": params}, x, input_mask, attn_mask, cache_size=_CACHE_SIZE,
+      method=model.prefill_cache, mutable=["cache"], **kwargs)
+  all_logits = [logits]
+  for step in range(_NUM_STEPS):
+    token = jax.random.normal(
+        jax.random.PRNGKey(step), (_BATCH_SIZE, 1, x.shape[-1]))
+    logits, variables = model.apply(
+        {"params": params, "cache": variables["cache"]}, token,
+        method=model.extend_cache, mutable=["cache"])
+    all_logits.append(logits)
+  return jnp.concatenate(all_logits, axis=1)
+
+
+class PagedCacheTest(parameterized.TestCase):
+
+  @parameterized.parameters(False, True)
+  def test_paged_matches_dense(self, custom_block_table):
+    dense = gemma_bv.Model(variant="smoke_test", cache_dtype=None)
+    paged = gemma_bv.Model(variant="smoke_test", cache_dtype=None,
+                           cache_page_size=4, cache_num_pages=16)
+    x = jax.random.normal(
+        jax.random.PRNGKey(0), (_BATCH_SIZE, _PROMPT_LEN, dense.embdim))
+    input_mask = jnp.arange(_PROMPT_LEN)[None, :] < jnp.asarray([[6], [3]])
+    params = dense.init(jax.random.PRNGKey(1), x)["params"]
+
+    kwargs = {}
+    if custom_block_table:
+      # Pages of an external allocator, in no particular order.
+      kwargs["block_table"] = jnp.asarray([[5, 2, 9], [7, 1, 3]], jnp.int32)
+
+    np.testing.assert_allclose(
+        _decode(paged, params, x, input_mask, **kwargs),
+        _decode(dense, params, x, input_mask),
+        atol=1e-5, rtol=1e-5)
+
+  def test_paged_needs_num_pages(self):
+    model = gemma_bv.Model(variant="smoke_test", cache_page_size=4)
+    x = jnp.zeros((_BATCH_SIZE, _PROMPT_LEN, model.embdim))
+    params = model.init(jax.random.PRNGKey(0), x)["params"]
+    with self.assertRaises(ValueError):
+      _decode(model, params, x, jnp.ones((_BATCH_SIZE, _PROMPT_LEN), bool))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -15,19 +15,15 @@
 """Inference."""
 import functools
 
-from typing import Any, Callable, Optional, Tuple
+from typing import Callable, Optional, Tuple
 
-import flax
+from big_vision.models import decoding
 from flax import linen as nn
 import jax
-from jax import lax
 from jax import numpy as jnp
 
-import numpy as np
-
 
 EOS_ID = 1
-NEG_INF = np.array(-1.0e7)  # Effective negative infinity.
 
 
 GenerateFn = Callable[...,
@@ -135,10 +131,11 @@ def generate(params, inputs, prompts, seed, *,
         {"params": params["params"], "cache": cache},
         encoded_inputs, prompts)[1]["cache"]
 
+  # Expanded once here rather than in every step of the loop.
+  encoded = decoding.repeat_samples(encoded_inputs, num_samples)
+
   def tokens_to_logits(tokens, cache):
     def decode_step(model, tokens):
-      encoded = expand_samples_dim_and_flatten(
-          encoded_inputs, num_samples)
       return model.decode(encoded, tokens, decode=True, **decode_kwargs)
 
     logits, aux = nn.apply(decode_step, model, mutable=True)(
@@ -157,161 +154,6 @@ def generate(params, inputs, prompts, seed, *,
   return beam_seqs, scores, logprobs
 
 
-def expand_samples_dim(x, num_samples):
-  """Creates new dimension in non-scalar array and tiles into it."""
-  if x.ndim == 0:  # ignore scalars (e.g. cache index)
-    return x
-  x = jnp.expand_dims(x, axis=1)
-  tile_dims = [1] * x.ndim
-  tile_dims[1] = num_samples
-  return jnp.tile(x, tile_dims)
-
-
-def flatten_samples_dim(x):
-  """Flattens samples dim into batch dim."""
-  if x.ndim == 0:  # ignore scalars (e.g. cache index)
-    return x
-  return x.reshape((x.shape[0] * x.shape[1],) + x.shape[2:])
-
-
-def unflatten_samples_dim(x, batch_size, num_samples):
-  """Unflattens first dim into batch and samples dims."""
-  if x.ndim == 0:  # ignore scalars (e.g. cache index)
-    return x
-  assert batch_size * num_samples == x.shape[0]
-  return x.reshape((batch_size, num_samples) + x.shape[1:])
-
-
-def expand_samples_dim_and_flatten(x, num_samples):
-  """Expands the each batch item by num_samples in batch dimension."""
-  return flatten_samples_dim(expand_samples_dim(x, num_samples))
-
-
-def cache_map(fn, cache):
-  """Maps function over caches, even multiple caches in various layers."""
-  frozen = isinstance(cache, flax.core.FrozenDict)
-  if frozen:
-    cache = flax.core.unfreeze(cache)
-  flat_cache = flax.traverse_util.flatten_dict(cache)
-  # Exclude cached relative position bias from beam expansion, etc.
-  keyvals = {k: v for k, v in flat_cache.items() if k[-1] != "cached_bias"}
-  keyvals = jax.tree_map(fn, keyvals)
-  flat_cache.update(keyvals)
-  new_cache = flax.traverse_util.unflatten_dict(flat_cache)
-  if frozen:
-    new_cache = flax.core.freeze(new_cache)
-  return new_cache
-
-
-@flax.struct.dataclass
-class LoopState:
-  """Internal state of the temperature sampling loop."""
-  # Position in the sequence that we are currently looking at.
-  cur_index: int
-  # Cache for fast auto-regressive decoding.
-  cache: Any
-  # Flags indicating whether the sequence reached eos [B*N].
-  flags_finished: jnp.ndarray
-  # Sequences being generated [B*N, L+1]. Note: sequences start with 0 token.
-  sequences: jnp.ndarray
-  scores: jnp.array  # Total sequence scores per batch element [B*N].
-  logprobs: jnp.array  # Logprobs of selected tokens [B*N, L].
-  rng: jnp.ndarray  # PRNGKey of the loop state.
-
-
-def _init_state(prompts, cache, init_rng_key, num_samples):
-  batch_size, max_decode_len_plus_one = prompts.shape
-  # Add extra samples dim to attention cache pytree elements.
-  cache = cache_map(
-      lambda x: expand_samples_dim_and_flatten(x, num_samples), cache)
-  return LoopState(
-      cur_index=0,
-      cache=cache,
-      flags_finished=jnp.zeros((batch_size*num_samples), dtype=jnp.bool_),
-      sequences=expand_samples_dim_and_flatten(prompts, num_samples),
-      scores=jnp.zeros((batch_size*num_samples)),
-      logprobs=jnp.zeros((batch_size*num_samples, max_decode_len_plus_one-1)),
-      rng=init_rng_key)
-
-
-def _should_temperature_sampling_continue(state, max_decode_len):
-  """Check if we should continue or not."""
-
-  max_length_not_reached = state.cur_index < max_decode_len - 1
-  all_seqs_finished = jnp.all(state.flags_finished)
-  return max_length_not_reached & (~all_seqs_finished)
-
-
-def _temperature_sampling_iteration(state, tokens_to_logits, temperature, eos,
-                                    top_k, top_p, mask_token_ids=()):
-  """Temperature sampling step function."""
-
-  rng_sampling, rng = jax.random.split(state.rng)
-
-  # 1. Use the model to generate a distribution over the vocabulary (for the
-  # next token) and sample from it, optionally applying the temperature.
-  # --> [B,].
-  cur_tokens = state.sequences[:, state.cur_index]
-  logits, new_cache = tokens_to_logits(cur_tokens[:, None], state.cache)
-  assert logits.ndim == 2, ("tokens_to_logits expected to return a"
-                            f"2-dimensional array [B, V], got {logits.ndim}"
-                            "dimensions.")
-  logprobs = jax.nn.log_softmax(logits)
-
-  # Do not sample special tokens in with ids in mask_token_ids.
-  if mask_token_ids:
-    probs = jax.nn.softmax(logits)
-    for i in mask_token_ids:
-      probs = probs.at[:, i].set(0.)
-    probs = probs / jnp.sum(probs, -1, keepdims=True)
-    logits = jnp.log(probs)
-
-  if top_p:  # Nucleus sampling.
-    logits_sorted = jnp.sort(logits, axis=-1)[:, ::-1]
-    sorted_cum_probs = jnp.cumsum(
-        jax.nn.softmax(logits_sorted, axis=-1), axis=-1)
-    cutoff_index = jnp.sum(sorted_cum_probs < top_p, axis=-1, keepdims=True)
-    cutoff_logit = jnp.take_along_axis(logits_sorted, cutoff_index, axis=-1)
-    logits = jnp.where(logits < cutoff_logit,
-                       jnp.full_like(logits, NEG_INF), logits)
-  if top_k:
-    topk_logits, topk_indices = jax.lax.top_k(logits, top_k)
-    topk_token = jax.random.categorical(rng_sampling, topk_logits / temperature)
-    sampled_tokens = jnp.squeeze(
-        jnp.take_along_axis(topk_indices, jnp.expand_dims(topk_token, -1),
-                            axis=-1), axis=-1)
-  else:
-    sampled_tokens = jax.random.categorical(rng_sampling, logits / temperature)
-
-  sampled_logprobs = jnp.squeeze(jnp.take_along_axis(
-      logprobs, jnp.expand_dims(sampled_tokens, axis=1), axis=-1), axis=-1)
-
-  # 2. Use the sampled tokens to update the sequences that did not finish yet,
-  # but only if they are out of prompt.
-  next_tokens = state.sequences[:, state.cur_index + 1]
-  next_logprobs = jnp.squeeze(jnp.take_along_axis(
-      logprobs, jnp.expand_dims(next_tokens, axis=1), axis=-1), axis=-1)
-  out_of_prompt = next_tokens == 0
-  update_pos = out_of_prompt * (~state.flags_finished)
-  next_tokens = sampled_tokens * update_pos + next_tokens * (~update_pos)
-  sampled_logprobs = update_pos*sampled_logprobs + ~update_pos*next_logprobs
-  sequences = state.sequences.at[:, state.cur_index + 1].set(next_tokens)
-  scores = state.scores + sampled_logprobs
-  seqs_logprobs = state.logprobs.at[:, state.cur_index].set(sampled_logprobs)
-
-  # 3. Update the finished flags. Only out of prompts seqs can finish.
-  flags_finished = out_of_prompt & (state.flags_finished |
-                                    (sampled_tokens == eos))
-  return LoopState(
-      cur_index=state.cur_index+1,
-      cache=new_cache,
-      flags_finished=flags_finished,
-      sequences=sequences,
-      scores=scores,
-      logprobs=seqs_logprobs,
-      rng=rng)
-
-
 def _temperature_sampling(prompts, cache, tokens_to_logits, num_samples=1,
                           eos_token=EOS_ID, max_decode_len=None,
                           seed=0, temperature=1., top_k=0, top_p=0.0,
@@ -343,42 +185,59 @@ def _temperature_sampling(prompts, cache, tokens_to_logits, num_samples=1,
     top_k: limit sampling to only top-k logits. Zero means no limit.
     top_p: limit sampling to smallest number of top logits with max cumulative
       prob <= top_p. Zero means no limit. Cannot use both top_p and top_k.
+      Unlike `decoding.sample_logits`, the cutoff is computed before applying
+      the temperature.
     mask_token_ids: if set then tokens with given ids are not sampled.
 
   Returns:
     sequences: generated sequences [B, num_samples, L].
-    scores: not implemented in the naive temperature sampling [B, num_samples].
+    scores: sum of the log probabilities of each sequence [B, num_samples].
     logprobs: Log probabilities for the generated tokens [B, num_samples, L].
   """
   if top_k > 0 and top_p > 0.0:
     raise ValueError(f"Cannot use both top_k {top_k} and top_p {top_p}.")
   if max_decode_len is None:
     max_decode_len = prompts.shape[1]
-  # We will start generating sequences from 0 token.
-  prompts = jnp.pad(prompts, ((0, 0), (1, 0)))
-  eos = jnp.array(eos_token)
-  if isinstance(seed, int):
-    seed = jax.random.PRNGKey(seed)
-
-  # Initialize the state.
-  loop_init_state = _init_state(prompts, cache, seed, num_samples)
-  should_temperature_sampling_continue_fn = functools.partial(
-      _should_temperature_sampling_continue,
-      max_decode_len=max_decode_len+1)  # Account for prompt padding with 0's.
-  temperature_sampling_iteration_fn = functools.partial(
-      _temperature_sampling_iteration,
-      tokens_to_logits=tokens_to_logits,
-      temperature=temperature, top_k=top_k, top_p=top_p,
-      eos=eos, mask_token_ids=mask_token_ids)
-
-  # Run the temperature sampling and generate the sequences.
-  final_state = lax.while_loop(
-      should_temperature_sampling_continue_fn,
-      temperature_sampling_iteration_fn,
-      loop_init_state)
-
-  # Return the generated sequences, discarding the 0 token in the beginning.
+  batch_size = prompts.shape[0]
+
+  # Sequences start from the 0 token.
+  cache = decoding.expand_cache(cache, num_samples)
+  start_tokens = jnp.zeros((batch_size * num_samples, 1), jnp.int32)
+  logits, cache = tokens_to_logits(start_tokens, cache)
+
+  sequences, logprobs = decoding.sample(
+      tokens_to_logits, logits, cache, seed,
+      max_decode_len=max_decode_len,
+      eos_token=eos_token,
+      prompts=decoding.repeat_samples(prompts, num_samples),
+      sample_fn=functools.partial(
+          _sample_logits, temperature=temperature, top_k=top_k, top_p=top_p,
+          mask_token_ids=mask_token_ids))
+
   return (
-      final_state.sequences[:, 1:].reshape((-1, num_samples, max_decode_len)),
-      final_state.scores.reshape((-1, num_samples)),
-      final_state.logprobs.reshape((-1, num_samples, max_decode_len)))
+      sequences.reshape((-1, num_samples, max_decode_len)),
+      logprobs.sum(axis=-1).reshape((-1, num_samples)),
+      logprobs.reshape((-1, num_samples, max_decode_len)))
+
+
+def _sample_logits(logits, rng, *, temperature, top_k, top_p, mask_token_ids):
+  """UViM sampler for `decoding.sample`: top-p is cut on the raw logits."""
+  # Do not sample special tokens in with ids in mask_token_ids.
+  for i in mask_token_ids:
+    logits = logits.at[:, i].set(decoding.NEG_INF)
+
+  if top_p:  # Nucleus sampling.
+    logits_sorted = jnp.sort(logits, axis=-1)[:, ::-1]
+    sorted_cum_probs = jnp.cumsum(
+        jax.nn.softmax(logits_sorted, axis=-1), axis=-1)
+    cutoff_index = jnp.sum(sorted_cum_probs < top_p, axis=-1, keepdims=True)
+    cutoff_logit = jnp.take_along_axis(logits_sorted, cutoff_index, axis=-1)
+    logits = jnp.where(logits < cutoff_logit,
+                       jnp.full_like(logits, decoding.NEG_INF), logits)
+  if top_k:
+    topk_logits, topk_indices = jax.lax.top_k(logits, top_k)
+    topk_token = jax.random.categorical(rng, topk_logits / temperature)
+    return jnp.squeeze(
+        jnp.take_along_axis(topk_indices, jnp.expand_dims(topk_token, -1),
+                            axis=-1), axis=-1)
+  return jax.random.categorical(rng, logits / temperature)
@@ -12,14 +12,49 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Preprocessing builder."""
+"""Preprocessing builder.
+
+Pipelines are compiled once per pp string: the parsed ops are memoized, adjacent
+ops with a fused implementation (see `_FUSIONS`) are replaced by it, and the
+instantiated ops are shared by all pipelines built from the same string.
+
+Setting `profile=True` (or the `BV_PP_PROFILE` environment variable) times
+every op of a pipeline; `log_profile` logs and returns the collected timings.
+"""
+
+import collections
+import functools
+import os
+import threading
 
 from absl import logging
 from big_vision.pp import registry
 import tensorflow as tf
 
 
-def get_preprocess_fn(pp_pipeline, log_data=True):
+_Op = collections.namedtuple("_Op", ["name", "args", "kwargs"])
+
+# Adjacent ops replaced by a fused op which computes the same outputs, as
+# (first, second, fused, first's positional args, second's positional args).
+# The fused op takes the (disjoint) keyword arguments of both ops.
+_FUSIONS = (
+    ("decode", "inception_crop", "decode_and_inception_crop",
+     ("channels", "precise"),
+     ("size", "area_min", "area_max", "method", "antialias")),
+    ("resize", "value_range", "resize_and_value_range",
+     ("size", "method", "antialias"),
+     ("vmin", "vmax", "in_min", "in_max", "clip_values")),
+)
+_KEY_ARGS = ("key", "inkey", "outkey")
+
+# Instantiated ops, by pp string and the registered getters they were made by.
+_PIPELINES = {}
+
+_PROFILE = collections.defaultdict(lambda: [0, 0.0])  # Count, total seconds.
+_PROFILE_LOCK = threading.Lock()
+
+
+def get_preprocess_fn(pp_pipeline, log_data=True, fuse=True, profile=None):
   """Transform an input string into the preprocessing function.
 
   The minilanguage is as follows:
@@ -39,6 +74,9 @@ def get_preprocess_fn(pp_pipeline, log_data=True):
       None, no preprocessing will be executed.
     log_data: Whether to log the data before and after preprocessing. Can also
       be a string to show in the log for debugging, for example dataset name.
+    fuse: Whether to replace adjacent ops by their fused implementation.
+    profile: Whether to time each op, see `log_profile`. Defaults to whether
+      the `BV_PP_PROFILE` environment variable is set.
 
   Returns:
     preprocessing function.
@@ -46,16 +84,13 @@ def get_preprocess_fn(pp_pipeline, log_data=True):
   Raises:
     ValueError: if preprocessing function name is unknown
   """
+  if profile is None:
+    profile = bool(os.environ.get("BV_PP_PROFILE"))
 
-  names, ops = [], []
-  if pp_pipeline:
-    for op_spec in pp_pipeline.split("|"):
-      if not op_spec: continue  # Skip empty section instead of error.
-      try:
-        ops.append(registry.Registry.lookup(f"preprocess_ops.{op_spec}")())
-        names.append(registry.parse_name(op_spec)[0])
-      except SyntaxError as err:
-        raise ValueError(f"Syntax error on: {op_spec}") from err
+  names, ops = _compile(pp_pipeline or "", fuse)
+  if profile:
+    ops = [_timed(op, f"{pp_pipeline} [{i}] {name}")
+           for i, (name, op) in enumerate(zip(names, ops))]
 
   def _preprocess_fn(data):
     """The preprocessing function that is returned."""
@@ -79,3 +114,136 @@ def get_preprocess_fn(pp_pipeline, log_data=True):
     return data
 
   return _preprocess_fn
+
+
+def log_profile(reset=False):
+  """Logs and returns the mean time (in seconds) of every profiled op.
+
+  Ops run inside tf.data are timed per example, in parallel with other
+  examples, so the numbers are best compared relative to each other.
+
+  Args:
+    reset: Whether to clear the collected timings afterwards.
+
+  Returns:
+    A dict mapping "<pp string> [<index>] <op name>" to the mean time.
+  """
+  with _PROFILE_LOCK:
+    means = {k: total / count for k, (count, total) in _PROFILE.items()}
+    if reset:
+      _PROFILE.clear()
+  for k, mean in means.items():
+    logging.info("pp profile: %8.3fms %s", mean * 1e3, k)
+  return means
+
+
+def _compile(pp_pipeline, fuse):
+  """The (possibly fused) op names and instantiated ops of `pp_pipeline`."""
+  parsed = _parse(pp_pipeline)
+  if fuse:
+    parsed = _fuse(parsed)
+
+  reg = registry.Registry.global_registry()
+  getters = tuple(reg[f"preprocess_ops.{op.name}"] for op in parsed)
+  key = (pp_pipeline, fuse, getters)
+  if key not in _PIPELINES:
+    _PIPELINES[key] = tuple(
+        getter(*op.args, **op.kwargs) for getter, op in zip(getters, parsed))
+  return [op.name for op in parsed], list(_PIPELINES[key])
+
+
+@functools.lru_cache(maxsize=None)
+def _parse(pp_pipeline):
+  """Parses a pp string into a tuple of `_Op`s."""
+  ops = []
+  for op_spec in pp_pipeline.split("|"):
+    if not op_spec: continue  # Skip empty section instead of error.
+    try:
+      ops.append(_Op(*registry.parse_name(op_spec)))
+    except SyntaxError as err:
+      raise ValueError(f"Syntax error on: {op_spec}") from err
+    except ValueError as err:
+      raise ValueError(f"Error parsing:\n{op_spec}") from err
+  return tuple(ops)
+
+
+def _fuse(ops):
+  """Replaces adjacent ops in `ops` by their fused op, where possible."""
+  fused = []
+  for op in ops:
+    if fused and (fused_op := _fuse_pair(fused[-1], op)):
+      fused[-1] = fused_op
+    else:
+      fused.append(op)
+  return tuple(fused)
+
+
+def _fuse_pair(first, second):
+  """The fused op equivalent to `first|second`, or None."""
+  reg = registry.Registry.global_registry()
+  for name1, name2, fused, args1, args2 in _FUSIONS:
+    if ((first.name, second.name) != (name1, name2) or
+        f"preprocess_ops.{fused}" not in reg):
+      continue
+    kwargs1, kwargs2 = _bind(first, args1), _bind(second, args2)
+    if kwargs1 is None or kwargs2 is None:
+      continue
+    inkey1, outkey1 = _pop_keys(kwargs1)
+    inkey2, outkey2 = _pop_keys(kwargs2)
+    # The intermediate result must be overwritten by the fused op's output.
+    if not outkey1 == inkey2 == outkey2:
+      continue
+    return _Op(fused, (), {**kwargs1, **kwargs2,
+                           "inkey": inkey1, "outkey": outkey2})
+  return None
+
+
+def _bind(op, argnames):
+  """`op`'s arguments as keyword arguments, or None if they don't all bind."""
+  if len(op.args) > len(argnames):
+    return None
+  kwargs = dict(zip(argnames, op.args))
+  if set(kwargs) & set(op.kwargs):
+    return None
+  kwargs.update(op.kwargs)
+  if set(kwargs) - set(argnames) - set(_KEY_ARGS):
+    return None  # Leave errors to the unfused op.
+  return kwargs
+
+
+def _pop_keys(kwargs):
+  """Pops the `InKeyOutKey` arguments, returns the input and output keys."""
+  key = kwargs.pop("key", None)
+  inkey = kwargs.pop("inkey", "image")
+  outkey = kwargs.pop("outkey", "image")
+  return key or inkey, key or outkey
+
+
+def _timed(op, name):
+  """Wraps `op`, adding its run time to the profile under `name`."""
+
+  def _record(seconds):
+    with _PROFILE_LOCK:
+      _PROFILE[name][0] += 1
+      _PROFILE[name][1] += float(seconds)
+    return True
+
+  def _tensors(data):
+    return [x for x in tf.nest.flatten(data, expand_composites=True)
+            if tf.is_tensor(x)]
+
+  def _timed_op(data):
+    # The control dependencies order the timestamps around the op in graphs.
+    with tf.control_dependencies(_tensors(data)):
+      start = tf.timestamp()
+    with tf.control_dependencies([start]):
+      data = op(data)
+    with tf.control_dependencies(_tensors(data)):
+      end = tf.timestamp()
+    recorded = tf.numpy_function(_record, [end - start], tf.bool,
+                                 stateful=True)
+    with tf.control_dependencies([recorded]):
+      return tf.nest.map_structure(
+          lambda x: tf.identity(x) if tf.is_tensor(x) else x, data)
+
+  return _timed_op
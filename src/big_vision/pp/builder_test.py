@@ -21,6 +21,7 @@ from __future__ import print_function
 from big_vision.pp import builder
 from big_vision.pp import ops_general  # pylint: disable=unused-import
 from big_vision.pp import ops_image  # pylint: disable=unused-import
+from big_vision.pp import registry
 import numpy as np
 import tensorflow.compat.v1 as tf
 
@@ -67,6 +68,59 @@ class BuilderTest(tf.test.TestCase):
       with self.assertRaises(BaseException):
         builder.get_preprocess_fn(pp_str)(x)
 
+  def testCachesOps(self):
+    num_instances = 0
+
+    def get_identity():
+      nonlocal num_instances
+      num_instances += 1
+      return lambda data: data
+
+    with registry.temporary_ops(identity=get_identity):
+      builder.get_preprocess_fn("identity|resize(4)")
+      builder.get_preprocess_fn("identity|resize(4)")
+      self.assertEqual(num_instances, 1)
+      builder.get_preprocess_fn("identity|resize(8)")
+      self.assertEqual(num_instances, 2)
+
+  def testFusesAdjacentOps(self):
+    ops = builder._fuse(builder._parse(
+        "decode|inception_crop(64)|resize(32)|value_range(-1, 1)|"
+        "resize(16, inkey='image', outkey='small')|value_range(0, 1)"))
+    self.assertEqual(
+        [op.name for op in ops],
+        ["decode_and_inception_crop", "resize_and_value_range", "resize",
+         "value_range"])
+    self.assertEqual(ops[0].kwargs, {"size": 64, "inkey": "image",
+                                     "outkey": "image"})
+
+  def testFusedDecodeAndInceptionCrop(self):
+    x = np.random.randint(0, 256, [96, 96, 3]).astype(np.uint8)
+    for encoded in [tf.io.encode_jpeg(x), tf.io.encode_png(x)]:
+      # Crops the full image, so that the output is deterministic.
+      pp_str = "decode|inception_crop(48, area_min=100)"
+      fused = builder.get_preprocess_fn(pp_str)({"image": encoded})
+      unfused = builder.get_preprocess_fn(pp_str, fuse=False)(
+          {"image": encoded})
+      self.assertAllEqual(fused["image"], unfused["image"])
+
+  def testFusedResizeAndValueRange(self):
+    x = np.random.randint(0, 256, [64, 48, 3]).astype(np.uint8)
+    for pp_str in ["resize(37)|value_range(-1, 1)",
+                   "resize(80, method='nearest')|value_range(0, 1)"]:
+      fused = builder.get_preprocess_fn(pp_str)({"image": x})
+      unfused = builder.get_preprocess_fn(pp_str, fuse=False)({"image": x})
+      self.assertAllEqual(fused["image"], unfused["image"])
+
+  def testProfile(self):
+    builder.log_profile(reset=True)
+    pp_fn = builder.get_preprocess_fn("resize(32)|flip_lr", profile=True)
+    for _ in range(3):
+      pp_fn({"image": np.random.randint(0, 256, [64, 48, 3])})
+    self.assertEqual(
+        sorted(builder.log_profile()),
+        ["resize(32)|flip_lr [0] resize", "resize(32)|flip_lr [1] flip_lr"])
+
 
 if __name__ == "__main__":
   tf.test.main()
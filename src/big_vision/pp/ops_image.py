@@ -242,6 +242,93 @@ def get_decode_jpeg_and_inception_crop(size=None, area_min=5, area_max=100,
   return _inception_crop
 
 
+@Registry.register("preprocess_ops.decode_and_inception_crop")
+@utils.InKeyOutKey()
+def get_decode_and_inception_crop(size=None, area_min=5, area_max=100,
+                                  method="bilinear", antialias=False,
+                                  channels=3, precise=False):
+  """Fused `decode|inception_crop`, see the two ops for the arguments.
+
+  Unlike `decode_jpeg_and_inception_crop`, this accepts any format `decode`
+  does: JPEGs only get their crop window decoded, other images are decoded
+  fully and then cropped, exactly like the unfused ops.
+
+  Returns:
+    A function, that decodes an image and applies inception crop.
+  """
+
+  def _sample_crop(shape):
+    begin, crop_size, _ = tf.image.sample_distorted_bounding_box(
+        shape,
+        tf.zeros([0, 0, 4], tf.float32),
+        area_range=(area_min / 100, area_max / 100),
+        min_object_covered=0,  # Don't enforce a minimum area.
+        use_image_if_no_bounding_boxes=True)
+    return begin, crop_size
+
+  def _decode_and_inception_crop(image_data):  # pylint: disable=missing-docstring
+
+    def _decode_jpeg_crop():
+      begin, crop_size = _sample_crop(tf.image.extract_jpeg_shape(image_data))
+      crop_window = tf.stack([begin[0], begin[1], crop_size[0], crop_size[1]])
+      return tf.image.decode_and_crop_jpeg(
+          image_data, crop_window, channels=channels,
+          dct_method="INTEGER_ACCURATE" if precise else "")
+
+    def _decode_then_crop():
+      image = get_decode(channels, precise)({"image": image_data})["image"]
+      begin, crop_size = _sample_crop(tf.shape(image))
+      return tf.slice(image, begin, crop_size)
+
+    crop = tf.cond(tf.io.is_jpeg(image_data), _decode_jpeg_crop,
+                   _decode_then_crop)
+    crop.set_shape([None, None, channels or None])
+    if size:
+      crop = get_resize(size, method, antialias)({"image": crop})["image"]
+    return crop
+
+  return _decode_and_inception_crop
+
+
+@Registry.register("preprocess_ops.resize_and_value_range")
+@utils.InKeyOutKey()
+def get_resize_and_value_range(size, method="bilinear", antialias=False,
+                               vmin=-1, vmax=1, in_min=0, in_max=255.0,
+                               clip_values=False):
+  """Fused `resize|value_range`, see the two ops for the arguments.
+
+  For uint8 images, the resized floats are rounded like the cast back to uint8
+  would, but stay in float32 for the rescaling instead of a round trip through
+  uint8. Other inputs simply run the two ops.
+
+  Returns:
+    A function, that resizes an image and rescales its values.
+  """
+  resize = get_resize(size, method, antialias)
+
+  def _resize_and_value_range(image):  # pylint: disable=missing-docstring
+    if tf.as_dtype(image.dtype) == tf.uint8 and method != "nearest":
+      image = tf.image.resize(
+          image, utils.maybe_repeat(size, 2), method=method,
+          antialias=antialias)
+      # Same values as `tf.cast(..., tf.uint8)` in `resize`, which truncates.
+      image = tf.floor(tf.clip_by_value(image, 0, 255))
+    else:
+      image = resize({"image": image})["image"]
+
+    # Same as `value_range` in ops_general.
+    in_min_t = tf.constant(in_min, tf.float32)
+    in_max_t = tf.constant(in_max, tf.float32)
+    image = tf.cast(image, tf.float32)
+    image = (image - in_min_t) / (in_max_t - in_min_t)
+    image = vmin + image * (vmax - vmin)
+    if clip_values:
+      image = tf.clip_by_value(image, vmin, vmax)
+    return image
+
+  return _resize_and_value_range
+
+
 @Registry.register("preprocess_ops.random_crop")
 @utils.InKeyOutKey()
 def get_random_crop(crop_size):
@@ -0,0 +1,163 @@
+# Copyright 2024 Big Vision Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks autoregressive decoding of the sequence models.
+
+Decodes with randomly initialized UViM, GIVT and Gemma (the PaliGemma and
+PaliVLA decoder) models of similar size under identical settings (batch size,
+decode length, samples per example and sampler), and reports tokens/sec:
+
+python -m big_vision.tools.benchmark_decode \
+    --batch_size 8 --decode_len 64 --num_samples 4 --top_p 0.9
+
+GIVT samples continuous tokens from its mixture model, so it ignores the
+sampler flags.
+"""
+
+import functools
+import time
+
+from absl import app
+from absl import flags
+from big_vision.models import decoding
+from big_vision.models.ppp import gemma
+from big_vision.models.proj.givt import decode as givt_decode
+from big_vision.models.proj.givt import givt
+from big_vision.models.proj.paligemma import gemma_bv
+from big_vision.models.proj.uvim import decode as uvim_decode
+from big_vision.models.proj.uvim import vtt
+import jax
+import jax.numpy as jnp
+import ml_collections
+
+
+flags.DEFINE_integer("batch_size", 8, "Number of prompts.")
+flags.DEFINE_integer("decode_len", 64, "Number of tokens decoded per sample.")
+flags.DEFINE_integer("prompt_len", 64, "Length of the Gemma prompts.")
+flags.DEFINE_integer("num_samples", 1, "Samples per prompt.")
+flags.DEFINE_float("temperature", 1.0, "Sampling temperature, 0 for argmax.")
+flags.DEFINE_integer("top_k", 0, "Top-k sampling, 0 to disable.")
+flags.DEFINE_float("top_p", 0.0, "Top-p sampling, 0 to disable.")
+flags.DEFINE_integer("num_runs", 5, "Number of timed decodes per model.")
+flags.DEFINE_string("gemma_variant", "smoke_test", "Gemma variant.")
+flags.DEFINE_list("models", ["uvim", "givt", "gemma"], "Models to benchmark.")
+
+# Roughly the size of the "smoke_test" Gemma variant.
+_WIDTH, _DEPTH, _HEADS, _VOCAB = 256, 4, 4, 1024
+
+
+def _sample_kwargs():
+  return dict(temperature=flags.FLAGS.temperature, top_k=flags.FLAGS.top_k,
+              top_p=flags.FLAGS.top_p)
+
+
+def _uvim(rng, batch_size, decode_len, num_samples):
+  """Returns a function decoding UViM (image to tokens)."""
+  model = vtt.Model(
+      patches=ml_collections.ConfigDict({"size": (16, 16)}),
+      num_heads=_HEADS, num_layers=_DEPTH, mlp_dim=4 * _WIDTH,
+      emb_dim=_WIDTH, vocab_size=_VOCAB, seq_len=decode_len,
+      input_size=(128, 128))
+  images = jnp.zeros((batch_size, 128, 128, 3))
+  prompts = jnp.zeros((batch_size, decode_len), jnp.int32)
+  params = model.init(rng, images[:1], prompts[:1])
+
+  @jax.jit
+  def fn(params, rng):
+    tokens, _, _ = uvim_decode.temperature_sampling(
+        params, images, prompts, rng, model=model, num_samples=num_samples,
+        eos_token=-1, **_sample_kwargs())
+    return tokens
+  return functools.partial(fn, params)
+
+
+def _givt(rng, batch_size, decode_len, num_samples):
+  """Returns a function decoding class-conditional GIVT (continuous tokens)."""
+  model = givt.Model(
+      num_heads=_HEADS, num_decoder_layers=_DEPTH, mlp_dim=4 * _WIDTH,
+      emb_dim=_WIDTH, seq_len=decode_len, out_dim=16, style="ar")
+  labels = jnp.zeros((batch_size * num_samples,), jnp.int32)
+  params = model.init(
+      rng, jnp.zeros((1, decode_len, model.out_dim)), labels[:1], train=False)
+
+  @jax.jit
+  def fn(params, rng):
+    tokens, _ = givt_decode.generate(
+        params, rng, model=model, seq_len=decode_len,
+        feature_dim=model.out_dim, labels=labels)
+    return tokens
+  return functools.partial(fn, params)
+
+
+def _gemma(rng, batch_size, decode_len, num_samples):
+  """Returns a function decoding Gemma from (random) prompt embeddings."""
+  model = gemma_bv.Model(variant=flags.FLAGS.gemma_variant)
+  prompt_len = flags.FLAGS.prompt_len
+  width = gemma.get_config(flags.FLAGS.gemma_variant).width
+  x = jax.random.normal(rng, (batch_size, prompt_len, width))
+  input_mask = jnp.ones((batch_size, prompt_len), jnp.bool_)
+  attn_mask = jnp.tril(jnp.ones((batch_size, prompt_len, prompt_len),
+                                jnp.bool_))
+  params = model.init(rng, x[:1])["params"]
+
+  @jax.jit
+  def fn(params, rng):
+    logits, variables = model.apply(
+        {"params": params}, x, input_mask, attn_mask,
+        cache_size=prompt_len + (decode_len if num_samples == 1 else 0),
+        method=model.prefill_cache, mutable=("cache",))
+
+    def step_fn(tokens, cache):
+      emb = model.apply({"params": params}, tokens, method=model.embed_tokens)
+      logits, variables = model.apply(
+          {"params": params, "cache": cache}, emb,
+          method=model.extend_cache, mutable=("cache",))
+      return logits[:, 0], variables["cache"]
+
+    tokens, _ = decoding.sample(
+        step_fn, logits[:, 0], variables["cache"], rng,
+        max_decode_len=decode_len, num_samples=num_samples,
+        expand_cache_fn=functools.partial(
+            gemma_bv.share_prefix_cache, suffix_len=decode_len),
+        **_sample_kwargs())
+    return tokens
+  return functools.partial(fn, params)
+
+
+_MODELS = {"uvim": _uvim, "givt": _givt, "gemma": _gemma}
+
+
+def main(argv):
+  del argv
+  batch_size, decode_len = flags.FLAGS.batch_size, flags.FLAGS.decode_len
+  num_samples = flags.FLAGS.num_samples
+  num_tokens = batch_size * num_samples * decode_len
+  print(f"Decoding {batch_size} x {num_samples} samples of {decode_len} "
+        f"tokens with {_sample_kwargs()}")
+
+  rng = jax.random.PRNGKey(0)
+  for name in flags.FLAGS.models:
+    decode_fn = _MODELS[name](rng, batch_size, decode_len, num_samples)
+    jax.block_until_ready(decode_fn(rng))  # Compile and warm up.
+    start = time.perf_counter()
+    for i in range(flags.FLAGS.num_runs):
+      tokens = decode_fn(jax.random.fold_in(rng, i))
+    jax.block_until_ready(tokens)
+    elapsed = (time.perf_counter() - start) / flags.FLAGS.num_runs
+    print(f"{name:>6}: {num_tokens / elapsed:10.1f} tokens/s, "
+          f"{1e3 * elapsed / decode_len:7.2f} ms/step")
+
+
+if __name__ == "__main__":
+  app.run(main)
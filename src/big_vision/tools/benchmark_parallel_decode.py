@@ -0,0 +1,123 @@
+# Copyright 2024 Big Vision Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the step time of masked (MaskGIT-style) GIVT decoding.
+
+For token grids of increasing size, times the per-step masking alone and
+`parallel_decode.decode_masked` with a randomly initialized model, once
+selecting the tokens to keep with a full argsort (the previous
+implementation) and once with `parallel_decode._get_bottom_k_mask`:
+
+python -m big_vision.tools.benchmark_parallel_decode \
+    --batch_size 8 --grid_sizes 16,32,64
+"""
+
+# pylint: disable=protected-access
+
+import contextlib
+import time
+
+from absl import app
+from absl import flags
+from big_vision.models.proj.givt import givt
+from big_vision.models.proj.givt import parallel_decode
+import jax
+import jax.numpy as jnp
+
+
+flags.DEFINE_integer("batch_size", 8, "Number of images decoded at once.")
+flags.DEFINE_list("grid_sizes", ["16", "32", "64"],
+                  "Side lengths of the (square) token grids.")
+flags.DEFINE_integer("num_steps", 16, "Number of decoding steps.")
+flags.DEFINE_integer("num_runs", 5, "Number of timed runs per setting.")
+
+_WIDTH, _DEPTH, _HEADS, _OUT_DIM = 256, 2, 4, 16
+
+
+def _argsort_bottom_k_mask(arr, k):
+  """Bottom-k mask from a full argsort of every row."""
+  *leading, d = arr.shape
+  arr = arr.reshape((-1, d))
+  k = jnp.broadcast_to(jnp.reshape(k, (-1, 1)), (arr.shape[0], 1))
+  mask = jax.vmap(
+      lambda a, k: jnp.zeros((d,), jnp.bool_).at[jnp.argsort(a)].set(
+          jnp.arange(d) < k))(arr, k)
+  return mask.reshape(*leading, d)
+
+
+@contextlib.contextmanager
+def _mask_fn(fn):
+  """Makes `decode_masked` (when traced) select tokens with `fn`."""
+  original = parallel_decode._get_bottom_k_mask
+  parallel_decode._get_bottom_k_mask = fn
+  try:
+    yield
+  finally:
+    parallel_decode._get_bottom_k_mask = original
+
+
+def _time(fn, *args):
+  jax.block_until_ready(fn(*args))  # Compile and warm up.
+  start = time.perf_counter()
+  for _ in range(flags.FLAGS.num_runs):
+    out = fn(*args)
+  jax.block_until_ready(out)
+  return (time.perf_counter() - start) / flags.FLAGS.num_runs
+
+
+def _benchmark(grid_size, mask_fn):
+  """Returns seconds per masking and per decoding step."""
+  batch_size, num_steps = flags.FLAGS.batch_size, flags.FLAGS.num_steps
+  seq_len = grid_size ** 2
+  rng = jax.random.PRNGKey(0)
+
+  confidence = jax.random.normal(rng, (batch_size, seq_len))
+  mask_len = jnp.full((batch_size, 1), seq_len // 2)
+  mask_time = _time(jax.jit(mask_fn), confidence, mask_len)
+
+  model = givt.Model(
+      num_heads=_HEADS, num_decoder_layers=_DEPTH, mlp_dim=4 * _WIDTH,
+      emb_dim=_WIDTH, seq_len=seq_len, out_dim=_OUT_DIM, style="masked")
+  labels = jnp.zeros((batch_size,), jnp.int32)
+  variables = model.init(
+      rng, jnp.zeros((1, seq_len, _OUT_DIM)), labels[:1],
+      input_mask=jnp.zeros((1, seq_len), jnp.bool_), train=False)
+  config = parallel_decode.MaskedGenerationConfig(num_steps=num_steps)
+
+  @jax.jit
+  def decode(variables, rng):
+    return parallel_decode.decode_masked(
+        rng, labels, seq_len, _OUT_DIM, model, variables, config).all_inputs_q
+
+  with _mask_fn(mask_fn):
+    decode_time = _time(decode, variables, rng)
+  return mask_time, decode_time / num_steps
+
+
+def main(argv):
+  del argv
+  print(f"Decoding {flags.FLAGS.batch_size} images in "
+        f"{flags.FLAGS.num_steps} steps")
+  for grid_size in map(int, flags.FLAGS.grid_sizes):
+    argsort_mask, argsort_step = _benchmark(grid_size, _argsort_bottom_k_mask)
+    select_mask, select_step = _benchmark(
+        grid_size, parallel_decode._get_bottom_k_mask)
+    print(f"{grid_size:3d}x{grid_size:<3d} ({grid_size ** 2:5d} tokens): "
+          f"mask {1e3 * argsort_mask:7.3f} -> {1e3 * select_mask:7.3f} ms, "
+          f"step {1e3 * argsort_step:7.2f} -> {1e3 * select_step:7.2f} ms "
+          f"({argsort_step / select_step:.2f}x)")
+
+
+if __name__ == "__main__":
+  app.run(main)
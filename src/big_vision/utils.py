@@ -24,8 +24,11 @@ import multiprocessing
 import multiprocessing.pool
 import os
 import re
+import struct
 import sys
+import tempfile
 import time
+import zipfile
 from typing import Mapping
 
 from absl import flags
@@ -147,6 +150,73 @@ def npload(fname):
     return dict(loaded)
 
 
+class NpzMmap(Mapping):
+  """Read-only, lazy view of a .npz file that memory-maps its arrays.
+
+  Unlike `npload`, nothing is read when the file is opened. Uncompressed
+  members (as written by `np.savez`) are memory-mapped, so only the slices
+  that actually get indexed are read from disk. Compressed members are read
+  one at a time on access. Remote files are first copied to a local file
+  (streamed, i.e. without holding them in memory).
+  """
+
+  def __init__(self, fname, local_dir=None):
+    self._tmpfile = None
+    if not os.path.exists(fname):
+      fd, local = tempfile.mkstemp(suffix=".npz", dir=local_dir)
+      os.close(fd)
+      gfile.copy(fname, local, overwrite=True)
+      fname = self._tmpfile = local
+    self.fname = fname
+    self._zip = zipfile.ZipFile(fname)
+    self._members = {
+        info.filename[:-len(".npy")]: info
+        for info in self._zip.infolist() if info.filename.endswith(".npy")
+    }
+
+  def __getitem__(self, key):
+    info = self._members[key]
+    if info.compress_type != zipfile.ZIP_STORED:
+      with self._zip.open(info) as f:
+        return recover_dtype(np.lib.format.read_array(f, allow_pickle=False))
+
+    with open(self.fname, "rb") as f:
+      # Skip the zip local file header, which precedes the raw .npy bytes.
+      f.seek(info.header_offset)
+      header = f.read(30)
+      name_len, extra_len = struct.unpack("<HH", header[26:30])
+      f.seek(info.header_offset + 30 + name_len + extra_len)
+      version = np.lib.format.read_magic(f)
+      shape, fortran_order, dtype = np.lib.format._read_array_header(f, version)  # pylint: disable=protected-access
+      offset = f.tell()
+
+    if dtype.hasobject:
+      raise ValueError(f"Object arrays can't be memory-mapped: {key}")
+    if not np.prod(shape):
+      return recover_dtype(np.empty(shape, dtype))
+    return recover_dtype(np.memmap(
+        self.fname, dtype=dtype, mode="r", offset=offset, shape=shape,
+        order="F" if fortran_order else "C"))
+
+  def __iter__(self):
+    return iter(self._members)
+
+  def __len__(self):
+    return len(self._members)
+
+  def close(self):
+    self._zip.close()
+    if self._tmpfile is not None:
+      os.remove(self._tmpfile)
+      self._tmpfile = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+
 def load_checkpoint_np(npz, tree=None):
   """Loads a jax pytree from a npz file.
 
@@ -353,5 +353,31 @@ class CheckpointTest(tf.test.TestCase):
     self.assertFalse(gfile.exists(f'{save_path}-{100:09d}-tmp'))
 
 
+class NpzMmapTest(tf.test.TestCase):
+
+  def test_matches_npload(self):
+    arrays = {
+        'params/a': np.arange(12, dtype=np.float32).reshape(3, 4),
+        'params/b/c': np.asfortranarray(np.ones((2, 5), np.int32)),
+        'empty': np.zeros((0, 3), np.float32),
+    }
+    for savez in (np.savez, np.savez_compressed):
+      fname = os.path.join(self.create_tempdir(), 'arrays.npz')
+      savez(fname, **arrays)
+      with utils.NpzMmap(fname) as npz:
+        self.assertCountEqual(npz.keys(), arrays.keys())
+        for k, v in arrays.items():
+          self.assertAllEqual(npz[k], v)
+        self.assertAllEqual(npz['params/a'][1:, 2:], arrays['params/a'][1:, 2:])
+
+  def test_recovers_bfloat16(self):
+    fname = os.path.join(self.create_tempdir(), 'arrays.npz')
+    x = np.arange(6, dtype=jnp.bfloat16)
+    np.savez(fname, x=x)
+    with utils.NpzMmap(fname) as npz:
+      self.assertEqual(npz['x'].dtype, jnp.bfloat16)
+      self.assertAllEqual(npz['x'], x)
+
+
 if __name__ == '__main__':
   tf.test.main()
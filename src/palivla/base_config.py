@@ -38,6 +38,8 @@ def get_config(variant_config: str):
         # Training settings
         "batch_size": placeholder(int),
         "eval_batch_size": placeholder(int),
+        # Number of validation batches per evaluation (0 evaluates on the training batch)
+        "eval_num_batches": 0,
         "num_steps": num_train_steps,
         # Checkpoint settings
         "save_path": placeholder(str),
@@ -4,6 +4,7 @@ import logging
 from typing import ClassVar
 
 import cloudpickle
+import jax.numpy as jnp
 import numpy as np
 import tensorflow as tf
 from einops import rearrange, EinopsError
@@ -18,6 +19,7 @@ from transformers import PreTrainedTokenizerFast
 from transformers.processing_utils import ProcessorMixin
 
 from big_vision.utils import Registry
+from palivla.utils import read_staging_directory, write_staging_directory
 
 
 class ActionTokenizer:
@@ -32,7 +34,12 @@ class ActionTokenizer:
     @classmethod
     def load(cls, path: PathLike):
         with tf.io.gfile.GFile(tf.io.gfile.join(path, "action_tokenizer.pkl"), "rb") as f:
-            return cloudpickle.load(f)
+            tokenizer = cloudpickle.load(f)
+        tokenizer.load_extra(path)
+        return tokenizer
+
+    def load_extra(self, path: PathLike):
+        """Restores any state that isn't stored in the pickle."""
 
 
 
@@ -85,6 +92,35 @@ class BinActionTokenizer(ActionTokenizer):
         data = data[:pred_action_dim*action_dim].reshape(-1, action_dim)
         return data
 
+    def tokenize_jax(self, data):
+        """JAX version of `tokenize` that can be used inside jitted functions."""
+        min_value = jnp.asarray(self.min_action_value)
+        max_value = jnp.asarray(self.max_action_value)
+        data = (data - min_value) / (max_value - min_value)
+        data = data.reshape(*data.shape[:-2], -1)
+        return jnp.clip(
+            jnp.round(data * (self.vocab_size - 1)).astype(jnp.int32),
+            0,
+            self.vocab_size - 1,
+        )
+
+    def detokenize_jax(self, tokens, *, action_dim: int):
+        """JAX version of `detokenize` that can be used inside jitted functions.
+
+        Takes a fixed number of tokens [..., n] with n divisible by `action_dim`
+        and returns actions [..., n // action_dim, action_dim] and a validity
+        mask of the same shape. Out-of-range tokens produce zeros and are masked
+        out, rather than NaNs.
+        """
+        min_value = jnp.asarray(self.min_action_value)
+        max_value = jnp.asarray(self.max_action_value)
+        valid = (tokens >= 0) & (tokens < self.vocab_size)
+        values = jnp.where(valid, tokens / (self.vocab_size - 1), 0.0)
+        data = values.reshape(*tokens.shape[:-1], -1, action_dim)
+        data = data * (max_value - min_value) + min_value
+        valid = valid.reshape(data.shape)
+        return jnp.where(valid, data, 0.0), valid
+
 
 @Registry.register("action_tokenizer.dct")
 class DCTActionTokenizer(ActionTokenizer):
@@ -103,6 +139,8 @@ class DCTActionTokenizer(ActionTokenizer):
         save_path: str | None = None,
         pretrained_path: str | None = "physical-intelligence/fast",
         do_fit: bool = False,
+        max_tokens: int = 32,
+        pad_token_id: int = -1,
     ):
         self.action_dim = action_dim
         self.time_horizon = time_horizon
@@ -110,6 +148,8 @@ class DCTActionTokenizer(ActionTokenizer):
         self.save_path = save_path
         self.pretrained_path = pretrained_path
         self.do_fit = do_fit
+        self.max_tokens = max_tokens
+        self.pad_token_id = pad_token_id
 
         if self.pretrained_path:
             self.tokenizer = AutoProcessor.from_pretrained(self.pretrained_path, trust_remote_code=True)
@@ -126,26 +166,86 @@ class DCTActionTokenizer(ActionTokenizer):
             
     @property
     def num_tokens(self):
-        return self.action_horizon * self.action_dim
+        return self.max_tokens
 
-    def tokenize(self, data):
-        return self.tokenizer(data)
+    def tokenize(self, data, obs=None):
+        """Tokenizes a batch of action chunks to a fixed-length [batch, max_tokens] array.
+
+        Padding is marked with `pad_token_id` (negative), which is skipped when
+        building sequences and when detokenizing.
+        """
+        tokens, _ = pad_token_sequences(
+            self.tokenizer(data),
+            max_length=self.max_tokens,
+            pad_token_id=self.pad_token_id,
+        )
+        return tokens
 
-    def detokenize(self, tokens, action_dim: int):
-        return self.tokenizer.decode(tokens, time_horizon=self.time_horizon, action_dim=self.action_dim)
+    def detokenize(self, tokens, *, obs=None, action_dim: int):
+        """Detokenizes one [max_tokens] or a batch of [batch, max_tokens] token sequences.
+
+        Raises a ValueError if a single sequence doesn't decode to valid actions;
+        the actions of invalid sequences of a batch are NaN.
+        """
+        tokens = np.asarray(tokens)
+        if tokens.ndim == 1:
+            actions, valid = self.batch_detokenize(tokens[None], action_dim=action_dim)
+            if not valid[0]:
+                raise ValueError("Action tokens don't decode to valid DCT coefficients")
+            return actions[0]
+        actions, valid = self.batch_detokenize(tokens, action_dim=action_dim)
+        return np.where(valid[:, None, None], actions, np.nan)
+
+    def batch_detokenize(self, tokens, *, obs=None, action_dim: int):
+        """Returns the actions [batch, time_horizon, action_dim] and a [batch] mask
+        of the sequences that decoded to valid actions (the others are zeros)."""
+        tokens = [[t for t in token if t >= 0] for token in np.asarray(tokens).tolist()]
+        if isinstance(self.tokenizer, UniversalActionProcessor):
+            return self.tokenizer.decode(
+                tokens, time_horizon=self.time_horizon, action_dim=action_dim, return_mask=True
+            )
+        # Other processors (e.g. the pretrained FAST one) zero invalid sequences
+        # without reporting them, so check the number of decoded coefficients.
+        actions = self.tokenizer.decode(
+            tokens, time_horizon=self.time_horizon, action_dim=action_dim
+        )
+        num_coeffs = self.tokenizer.time_horizon * self.tokenizer.action_dim
+        decoded_strs = self.tokenizer.bpe_tokenizer.batch_decode(tokens)
+        valid = np.array([len(s) == num_coeffs for s in decoded_strs], dtype=bool)
+        return actions, valid
 
     def fit(self, action_data):
-        self.tokenizer = self.tokenizer.fit(
-            action_data,
+        """Fits a new BPE processor to action chunks [n, time_horizon, action_dim]."""
+        self.tokenizer = UniversalActionProcessor.fit(
+            list(action_data),
+            scale=self.tokenizer.scale,
+            vocab_size=self.vocab_size,
+            time_horizon=self.time_horizon,
+            action_dim=self.action_dim,
         )
+        self.pretrained_path = None
         if self.save_path:
             self.tokenizer.save_pretrained(self.save_path)
     
     def save(self, path):
-        self.tokenizer.save_pretrained(path)
-    
-    def load(self, path):
-        self.tokenizer = AutoProcessor.from_pretrained(path)
+        # Huggingface can't save to GCS, so we need to stage the processor locally
+        with write_staging_directory(tf.io.gfile.join(path, "action_tokenizer")) as temp_dir:
+            self.tokenizer.save_pretrained(temp_dir)
+        super().save(path)
+
+    def load_extra(self, path):
+        with read_staging_directory(tf.io.gfile.join(path, "action_tokenizer")) as temp_dir:
+            if self.pretrained_path:
+                self.tokenizer = AutoProcessor.from_pretrained(temp_dir, trust_remote_code=True)
+            else:
+                # Locally built processors have no auto_map for AutoProcessor
+                self.tokenizer = UniversalActionProcessor.from_pretrained(temp_dir)
+
+    def __getstate__(self):
+        # The processor is saved separately with save_pretrained
+        state = self.__dict__.copy()
+        state["tokenizer"] = None
+        return state
 
 
 class UniversalActionProcessor(ProcessorMixin):
@@ -189,18 +289,33 @@ class UniversalActionProcessor(ProcessorMixin):
 
         dct_coeff = dct(action_chunk, axis=1, norm="ortho")
         dct_coeff = np.around(dct_coeff * self.scale)
-        tokens = []
-        for elem in dct_coeff:
-            token_str = "".join(map(chr, np.maximum(elem.flatten() - self.min_token, 0).astype(int)))
-            tokens.append(self.bpe_tokenizer(token_str)["input_ids"])
-        return tokens
+        codepoints = np.maximum(dct_coeff - self.min_token, 0).astype(np.uint32)
+        token_strs = _codepoints_to_strings(codepoints.reshape(codepoints.shape[0], -1))
+        return self.bpe_tokenizer(token_strs)["input_ids"]
+
+    def batch_encode(
+        self,
+        action_chunk: np.array,
+        *,
+        max_length: int,
+        pad_token_id: int = -1,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Encodes a batch of action chunks into fixed-length token arrays.
+
+        Returns the tokens, padded to `max_length` with `pad_token_id`, and a
+        boolean mask marking the valid tokens.
+        """
+        return pad_token_sequences(
+            self(action_chunk), max_length=max_length, pad_token_id=pad_token_id
+        )
 
     def decode(
         self,
-        tokens: list[list[int]],
+        tokens: list[list[int]] | np.ndarray,
         *,
         time_horizon: int | None = None,
         action_dim: int | None = None,
+        return_mask: bool = False,
     ) -> np.array:
         self.time_horizon = time_horizon or self.time_horizon or self.called_time_horizon
         self.action_dim = action_dim or self.action_dim or self.called_action_dim
@@ -213,25 +328,30 @@ class UniversalActionProcessor(ProcessorMixin):
             self.time_horizon is not None and self.action_dim is not None
         ), "Tokenizer not initialized, call encode() once or pass in time_horizon and action_dim."
 
-        decoded_actions = []
-        for token in tokens:
-            try:
-                decoded_tokens = self.bpe_tokenizer.decode(token)
-                decoded_dct_coeff = np.array(list(map(ord, decoded_tokens))) + self.min_token
-                decoded_dct_coeff = decoded_dct_coeff.reshape(-1, self.action_dim)
-                assert (
-                    decoded_dct_coeff.shape
-                    == (
-                        self.time_horizon,
-                        self.action_dim,
-                    )
-                ), f"Decoded DCT coefficients have shape {decoded_dct_coeff.shape}, expected ({self.time_horizon}, {self.action_dim})"
-            except Exception as e:
-                print(f"Error decoding tokens: {e}")
-                print(f"Tokens: {token}")
-                decoded_dct_coeff = np.zeros((-1, self.action_dim))
-            decoded_actions.append(idct(decoded_dct_coeff / self.scale, axis=0, norm="ortho"))
-        return np.stack(decoded_actions)
+        # Padded arrays (e.g. from batch_encode) mark padding with negative ids
+        tokens = [[int(t) for t in token if t >= 0] for token in tokens]
+        decoded_strs = self.bpe_tokenizer.batch_decode(tokens)
+
+        # Sequences that don't decode to exactly time_horizon * action_dim
+        # coefficients are invalid; their coefficients (and actions) are zeroed.
+        num_coeffs = self.time_horizon * self.action_dim
+        valid = np.array([len(s) == num_coeffs for s in decoded_strs], dtype=bool)
+        decoded_dct_coeff = np.zeros((len(decoded_strs), num_coeffs), dtype=np.float64)
+        if valid.any():
+            decoded_dct_coeff[valid] = _strings_to_codepoints(
+                [s for s, v in zip(decoded_strs, valid) if v], num_coeffs
+            ) + self.min_token
+        if not valid.all():
+            logging.warning(
+                f"Failed to decode {np.sum(~valid)}/{len(valid)} action token sequences, "
+                f"expected {num_coeffs} DCT coefficients"
+            )
+
+        decoded_dct_coeff = decoded_dct_coeff.reshape(-1, self.time_horizon, self.action_dim)
+        decoded_actions = idct(decoded_dct_coeff / self.scale, axis=1, norm="ortho")
+        if return_mask:
+            return decoded_actions, valid
+        return decoded_actions
 
     @classmethod
     def fit(
@@ -293,4 +413,40 @@ class UniversalActionProcessor(ProcessorMixin):
             min_token=min_token,
             time_horizon=time_horizon,
             action_dim=action_dim,
-        )
\ No newline at end of file
+        )
+
+
+def _codepoints_to_strings(codepoints: np.ndarray) -> list[str]:
+    """Converts a [batch, n] array of codepoints to a list of length-n strings."""
+    batch_size, n = codepoints.shape
+    joined = np.ascontiguousarray(codepoints, dtype="<u4").tobytes().decode("utf-32-le")
+    return [joined[i * n : (i + 1) * n] for i in range(batch_size)]
+
+
+def _strings_to_codepoints(strings: list[str], n: int) -> np.ndarray:
+    """Inverse of `_codepoints_to_strings` for strings of length `n`."""
+    joined = "".join(strings).encode("utf-32-le")
+    return np.frombuffer(joined, dtype="<u4").reshape(len(strings), n).astype(np.int64)
+
+
+def pad_token_sequences(
+    tokens: list[list[int]], *, max_length: int, pad_token_id: int = -1
+) -> tuple[np.ndarray, np.ndarray]:
+    """Pads variable-length token sequences to `max_length`.
+
+    Raises a ValueError if any sequence is longer than `max_length`, rather than
+    truncating it to tokens that decode to different actions.
+    """
+    lengths = np.array([len(t) for t in tokens], dtype=np.int64)
+    num_too_long = int(np.sum(lengths > max_length))
+    if num_too_long:
+        raise ValueError(
+            f"{num_too_long}/{len(tokens)} token sequences are longer than "
+            f"{max_length} tokens (up to {lengths.max()}), increase max_tokens"
+        )
+    mask = np.arange(max_length)[None, :] < lengths[:, None]
+    padded = np.full((len(tokens), max_length), pad_token_id, dtype=np.int32)
+    padded[mask] = np.concatenate(
+        [np.asarray(t, dtype=np.int32) for t in tokens] + [np.zeros((0,), dtype=np.int32)]
+    )
+    return padded, mask
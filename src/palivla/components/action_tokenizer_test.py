@@ -0,0 +1,63 @@
+"""Tests for the JAX versions of the action tokenizers."""
+
+from absl.testing import absltest
+import jax.numpy as jnp
+import numpy as np
+
+from palivla.components.action_tokenizer import BinActionTokenizer
+from palivla.components.sequence_builder import SequenceBuilder
+
+
+class BinActionTokenizerTest(absltest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tokenizer = BinActionTokenizer(
+            min_action_value=-2.0,
+            max_action_value=2.0,
+            action_vocab_size=256,
+            action_horizon=4,
+            action_dim=3,
+        )
+
+    def test_tokenize_matches_numpy(self):
+        # Includes values outside [min, max] that get clipped
+        actions = np.random.RandomState(0).uniform(-3, 3, (5, 4, 3))
+        actions = actions.astype(np.float32)
+        np.testing.assert_array_equal(
+            np.asarray(self.tokenizer.tokenize_jax(jnp.asarray(actions))),
+            self.tokenizer.tokenize(actions),
+        )
+
+    def test_detokenize_matches_numpy(self):
+        tokens = np.array(
+            [
+                [0, 17, 255, 128, 3, 200, 64, 1, 254, 90, 12, 7],
+                [-1, 17, 256, 128, 3, 1000, 64, -5, 254, 90, 12, 7],
+            ]
+        )
+        actions, valid = self.tokenizer.detokenize_jax(
+            jnp.asarray(tokens), action_dim=3
+        )
+        for row, row_actions, row_valid in zip(tokens, actions, valid):
+            expected = self.tokenizer.detokenize(row, action_dim=3)
+            # NumPy marks out-of-range tokens with NaN, JAX with the mask
+            np.testing.assert_array_equal(row_valid, ~np.isnan(expected))
+            np.testing.assert_allclose(
+                row_actions, np.nan_to_num(expected, nan=0.0), atol=1e-5
+            )
+
+    def test_build_gen_jax(self):
+        builder = SequenceBuilder(prompt_pad_length=8, gen_pad_length=16)
+        tokens = self.tokenizer.tokenize_jax(jnp.zeros((2, 4, 3)))
+        gen = builder.build_gen_jax(tokens, boa_id=1, eos_id=2, act0_id=1000)
+        np.testing.assert_array_equal(gen["tokens"][:, 0], [1, 1])
+        np.testing.assert_array_equal(gen["tokens"][:, 1:13], tokens + 1000)
+        np.testing.assert_array_equal(gen["tokens"][:, 13], [2, 2])
+        np.testing.assert_array_equal(gen["tokens"][:, 14:], 0)
+        np.testing.assert_array_equal(gen["mask"][0], np.arange(16) < 14)
+        np.testing.assert_array_equal(gen["mask_loss"], gen["mask"])
+        self.assertTrue(np.all(gen["mask_ar"]))
+
+
+if __name__ == "__main__":
+    absltest.main()
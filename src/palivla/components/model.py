@@ -31,6 +31,7 @@ def get_default_config():
         "modality_mappings": {"image_primary": "img"},
         "prompt_autoregressive": False,
         "target_key_order": ("image_primary",),
+        "param_dtype": "float32",
     }
 
 def get_pg2_config():
@@ -47,6 +48,7 @@ def get_pg2_config():
         "modality_mappings": {"image_primary": "img"},
         "prompt_autoregressive": False,
         "target_key_order": ("image_primary",),
+        "param_dtype": "float32",
     }
 
 def collect_embeddings(
@@ -69,6 +71,37 @@ def collect_embeddings(
     return values, masks
 
 
+def make_packed_attn_mask(segment_ids, mask_ar, num_segments: int):
+    """
+    Like `make_attn_mask`, but for sequences packing several examples.
+
+    Tokens only attend to tokens of their own segment (`segment_ids` > 0), and
+    `mask_ar` is accumulated per segment, so each example gets exactly the
+    attention it would get on its own, wherever its tokens are in the sequence.
+    """
+    segments = jax.nn.one_hot(segment_ids, num_segments + 1, dtype=jnp.int32)
+    cumsum = jnp.cumsum(segments * mask_ar[..., None].astype(jnp.int32), axis=1)
+    cumsum = jnp.sum(cumsum * segments, axis=-1)
+    attn_mask = cumsum[:, None, :] <= cumsum[:, :, None]
+    same_segment = segment_ids[:, None, :] == segment_ids[:, :, None]
+    valid = (segment_ids > 0)[:, None, :]
+    return attn_mask & same_segment & valid
+
+
+def _stack_image_embeds(embeds: jax.Array, mask: jax.Array):
+    """
+    Flattens the image tokens [b, (k,) t, d] of a stack of `k` frames into one
+    sequence [b, k * t, d], along with their mask.
+    """
+    num_batch_dims = embeds.ndim - 2
+    mask = jnp.any(mask, axis=tuple(range(num_batch_dims, mask.ndim)))
+    mask = einops.repeat(mask, "... -> ... t", t=embeds.shape[-2])
+    if num_batch_dims == 2:
+        embeds = einops.rearrange(embeds, "b k t d -> b (k t) d")
+        mask = einops.rearrange(mask, "b k t -> b (k t)")
+    return embeds, mask
+
+
 class PaliVLAModel(nn.Module):
     # Specifications for the basic modules
     llm_spec: ModuleSpec
@@ -84,6 +117,15 @@ class PaliVLAModel(nn.Module):
     prompt_autoregressive: bool
     target_key_order: Sequence[str]
 
+    # Storage dtype of the (floating point) params, e.g. "bfloat16" to halve
+    # param memory. Pair with `master_weights_dtype` in the optimizer.
+    param_dtype: str = "float32"
+
+    # Average-pools each view's grid of image tokens over windows of
+    # `image_token_pool` x `image_token_pool` tokens, e.g. 2 reduces the 16x16
+    # tokens of So400m/14 at 224px to 8x8.
+    image_token_pool: int = 1
+
     def setup(self):
         self.llm: GemmaModel = ModuleSpec.from_dict(self.llm_spec).instantiate(
             name="llm"
@@ -93,27 +135,8 @@ class PaliVLAModel(nn.Module):
         )
 
         def _encode_image(data, mask, *, train: bool = False):
-            # Normalize the image to be in the range [-1, 1]
-            data = data / 127.5 - 1
-
-            # Shim to process the stack dimension as a batch dimension
-            orig_shape = data.shape
-            num_batch_dims = len(orig_shape) - 3
-            mask = jnp.any(mask, axis=tuple(range(num_batch_dims, mask.ndim)))
-
-            if len(orig_shape) == 5:
-                data = einops.rearrange(data, "... h w c -> (...) h w c")
-                mask = einops.rearrange(mask, "... -> (...)")
-
-            result, info = self.image(data, train=train)
-            mask = einops.repeat(mask, "... -> ... k", k=result.shape[1])
-            if len(orig_shape) == 5:
-                result = einops.rearrange(
-                    result, "(b k) t d -> b (k t) d", b=orig_shape[0]
-                )
-                mask = einops.rearrange(mask, "(b k) t -> b (k t)", b=orig_shape[0])
-
-            return result, mask, info
+            result, info = self.encode_images(data, train=train)
+            return (*_stack_image_embeds(result, mask), info)
 
         self.encoders = {
             "img": _encode_image,
@@ -134,11 +157,37 @@ class PaliVLAModel(nn.Module):
             for modality in self.modality_mappings.keys()
         }
 
+    def encode_images(self, images: jax.Array, *, train: bool = False):
+        """
+        Encodes images [..., h, w, c] (in [0, 255]) into image tokens [..., t, d],
+        each frame on its own.
+        """
+        # Normalize the image to be in the range [-1, 1]
+        images = images / 127.5 - 1
+
+        # Shim to process the stack dimension as a batch dimension
+        batch_shape = images.shape[:-3]
+        images = images.reshape((-1, *images.shape[-3:]))
+        result, info = self.image(images, train=train)
+
+        if self.image_token_pool > 1:
+            grid = int(round(result.shape[1] ** 0.5))
+            result = einops.rearrange(result, "n (h w) d -> n h w d", h=grid)
+            pool = (self.image_token_pool, self.image_token_pool)
+            result = nn.avg_pool(result, pool, strides=pool)
+            result = einops.rearrange(result, "n h w d -> n (h w) d")
+
+        return result.reshape((*batch_shape, *result.shape[1:])), info
+
     def embed_modalities(
         self, data: Data, masks: Dict[str, jax.Array], *, train: bool = False
     ) -> Tuple[Data, Data, Info]:
         """
         Get embeddings for all modalities.
+
+        Images of a modality which are already encoded (with `encode_images`,
+        e.g. by an `ImageEmbeddingCache`) are passed as `<modality>_embeds`
+        instead of the pixels, and are not encoded again.
         """
 
         embeds = {}
@@ -147,9 +196,16 @@ class PaliVLAModel(nn.Module):
 
         for modality, encoder_name in self.modality_mappings.items():
             # Embed the data
-            encoder = self.encoders[encoder_name]
-
-            embed, mask, m_info = encoder(data[modality], masks[modality], train=train)
+            if f"{modality}_embeds" in data:
+                embed, mask = _stack_image_embeds(
+                    data[f"{modality}_embeds"], masks[modality]
+                )
+                m_info = {}
+            else:
+                encoder = self.encoders[encoder_name]
+                embed, mask, m_info = encoder(
+                    data[modality], masks[modality], train=train
+                )
             m_info["embed"] = embed
 
             # If only one embedding was produced, expand it to match the sequence length
@@ -160,7 +216,7 @@ class PaliVLAModel(nn.Module):
             start_token = einops.repeat(
                 self.modality_start_tokens[modality],
                 "1 e -> b 1 e",
-                b=data[modality].shape[0],
+                b=embed.shape[0],
             )
             embed = jnp.concatenate([start_token, embed], axis=1)
 
@@ -215,7 +271,15 @@ class PaliVLAModel(nn.Module):
         gen_seq: Data | None,
         *,
         train: bool = False,
+        sensors_repeat: int = 1,
     ):
+        """
+        Embeds the sensors and the prompt/gen text into a single sequence.
+
+        With `sensors_repeat > 1`, the text batch is `sensors_repeat` times
+        larger than the sensor batch, laid out as `(n b)`. The sensors are then
+        encoded once and their embeddings shared across all `n` groups.
+        """
         sequence = prompt_seq
         if gen_seq is None:
             sequence = prompt_seq
@@ -233,6 +297,11 @@ class PaliVLAModel(nn.Module):
         sensors_embeds, sensors_masks, sensors_info = self.embed_sensors(
             sensors, sensors_mask, train=train
         )
+        if sensors_repeat > 1:
+            sensors_embeds, sensors_masks = jax.tree.map(
+                lambda x: repeat(x, "b ... -> (n b) ...", n=sensors_repeat),
+                (sensors_embeds, sensors_masks),
+            )
         text_embeds, text_info = self.embed_text(sequence["tokens"], train=train)
 
         all_embeds = jnp.concatenate([sensors_embeds, text_embeds], axis=1)
@@ -253,10 +322,16 @@ class PaliVLAModel(nn.Module):
         gen_seq: Data,
         *,
         train: bool = False,
+        sensors_repeat: int = 1,
     ):
         # Concatenate the prompt/gen sequences
         embeds, masks, masks_ar, info, prompt_end = self.embed_sensors_and_text(
-            sensors, sensors_mask, prompt_seq, gen_seq, train=train
+            sensors,
+            sensors_mask,
+            prompt_seq,
+            gen_seq,
+            train=train,
+            sensors_repeat=sensors_repeat,
         )
 
         positions = jnp.cumsum(masks, axis=1) - 1
@@ -277,6 +352,76 @@ class PaliVLAModel(nn.Module):
 
         return logits, info
 
+    def call_packed(
+        self,
+        sensors: Data,
+        sensors_mask: Data,
+        packed: Data,
+        *,
+        train: bool = False,
+    ):
+        """
+        Forward pass over packed sequences (see `SequenceBuilder.build_packed_sequence`).
+
+        The sensor batch is `k` times the packed batch: row `b` holds the
+        sensors of examples `b * k ... b * k + k - 1` in segments `1 ... k`,
+        followed by their packed text. Returns the logits of the text.
+        """
+        batch_size, text_length = packed["tokens"].shape
+        sensors_embeds, sensors_masks, sensors_info = self.embed_sensors(
+            sensors, sensors_mask, train=train
+        )
+        num_slots = sensors_embeds.shape[0] // batch_size
+        slots = jnp.arange(1, num_slots + 1)
+
+        # Sensors of slots without any text (dropped examples) are masked out.
+        slot_valid = jnp.any(
+            packed["segment_ids"][:, None, :] == slots[None, :, None], axis=-1
+        )
+        sensors_masks = (
+            einops.rearrange(sensors_masks, "(b k) t -> b k t", b=batch_size)
+            & slot_valid[..., None]
+        )
+        sensors_positions = jnp.cumsum(sensors_masks, axis=-1) - 1
+        sensors_segments = jnp.where(sensors_masks, slots[None, :, None], 0)
+
+        # Text positions continue after the example's own sensor tokens.
+        num_sensor_tokens = jnp.sum(sensors_masks, axis=-1)
+        text_positions = packed["positions"] + jnp.take_along_axis(
+            num_sensor_tokens, jnp.maximum(packed["segment_ids"] - 1, 0), axis=1
+        )
+        text_embeds, text_info = self.embed_text(packed["tokens"], train=train)
+
+        flat = partial(einops.rearrange, pattern="b k t ... -> b (k t) ...")
+        embeds = jnp.concatenate(
+            [
+                einops.rearrange(
+                    sensors_embeds, "(b k) t d -> b (k t) d", b=batch_size
+                ),
+                text_embeds,
+            ],
+            axis=1,
+        )
+        segment_ids = jnp.concatenate(
+            [flat(sensors_segments), packed["segment_ids"]], axis=1
+        )
+        positions = jnp.concatenate([flat(sensors_positions), text_positions], axis=1)
+        mask_ar = jnp.concatenate(
+            [jnp.zeros_like(flat(sensors_masks)), packed["mask_ar"]], axis=1
+        )
+
+        attn_mask = make_packed_attn_mask(segment_ids, mask_ar, num_slots)
+        _, llm_info = self.llm(embeds, mask=attn_mask, train=train, positions=positions)
+
+        info = llm_info | {
+            f"{modality}_info": m_info
+            for modality, m_info in (sensors_info | text_info).items()
+        }
+        pre_logits = llm_info["pre_logits"][:, -text_length:, :]
+        logits = self.llm.compute_logits(pre_logits, train=train)
+        info["text_logits"] = logits
+        return logits, info
+
     def embed_text(self, tokens, train=False):
         out = {}
         ztxt = out["llm/ztxt"] = self.llm.embed_tokens(tokens, train=train)
@@ -3,6 +3,7 @@ from os import PathLike
 
 import cloudpickle
 import einops
+import jax.numpy as jnp
 import numpy as np
 import tensorflow as tf
 from transformers import AutoTokenizer
@@ -16,6 +17,10 @@ from palivla.components.action_tokenizer import ActionTokenizer
 class SequenceBuilder:
     prompt_pad_length: int
     gen_pad_length: int
+    # Packed training: number of examples sharing one LLM sequence (0 or 1 to
+    # disable) and the length of their packed text (prompts + actions).
+    pack_examples: int = 0
+    packed_text_length: int | None = None
 
     def __post_init__(self):
         self.prompt_pad_length = self.prompt_pad_length
@@ -42,7 +47,8 @@ class SequenceBuilder:
             return "<bos>" + str("")
 
     def prepare_gen(self, action_tokens):
-        return "".join([f"<act{i}>" for i in action_tokens]) + "<eos>"
+        # Negative ids mark padding from fixed-length action tokenizers
+        return "".join([f"<act{i}>" for i in action_tokens if i >= 0]) + "<eos>"
 
     def build_sequence(
         self,
@@ -121,6 +127,131 @@ class SequenceBuilder:
             },
         }
 
+    def build_gen_jax(
+        self,
+        action_tokens,
+        *,
+        boa_id: int,
+        eos_id: int,
+        act0_id: int,
+    ):
+        """
+        On-device version of the "gen" sequences of `build_sequence` (with
+        `boa_is_prompt=False`), for fixed-length action tokens [batch, n] such
+        as those from `BinActionTokenizer.tokenize_jax`.
+        """
+        batch_size = action_tokens.shape[0]
+        tokens = jnp.concatenate(
+            [
+                jnp.full((batch_size, 1), boa_id, dtype=jnp.int32),
+                action_tokens.astype(jnp.int32) + act0_id,
+                jnp.full((batch_size, 1), eos_id, dtype=jnp.int32),
+            ],
+            axis=-1,
+        )
+        length = min(tokens.shape[-1], self.gen_pad_length)
+        tokens = jnp.pad(
+            tokens[:, :length], ((0, 0), (0, self.gen_pad_length - length))
+        )
+        mask = jnp.broadcast_to(
+            jnp.arange(self.gen_pad_length) < length, tokens.shape
+        )
+        return {
+            "tokens": tokens,
+            "mask": mask,
+            "mask_ar": jnp.ones_like(mask),
+            "mask_loss": mask,
+        }
+
+    def build_packed_sequence(
+        self,
+        batch,
+        language_tokenizer: AutoTokenizer,
+        action_tokenizer: ActionTokenizer,
+    ):
+        """
+        Packs the text of `pack_examples` examples into each training sequence.
+
+        Each packed row holds the sensors of exactly `pack_examples` examples
+        (slots) followed by their unpadded prompt and action tokens, packed
+        into `packed_text_length` tokens. Examples are balanced across rows
+        longest-first; an example whose text doesn't fit in any row keeps its
+        slot but is dropped from the row (its segment is empty).
+
+        Returns the packed text (each `[rows, packed_text_length]`) with the
+        next-token `targets`/`mask_loss`, the permutation to apply to the
+        batch's sensors so they line up with the slots, and packing stats.
+        """
+        sequences = self.build_sequence(batch, language_tokenizer, action_tokenizer)
+        prompt, gen = sequences["prompt"], sequences["gen"]
+        tokens = np.concatenate([prompt["tokens"], gen["tokens"]], axis=1)
+        mask = np.concatenate([prompt["mask"], gen["mask"]], axis=1)
+        mask_ar = np.concatenate([prompt["mask_ar"], gen["mask_ar"]], axis=1)
+        # Token t predicts token t + 1; as in the padded loss, only action
+        # tokens are predicted, and only from the previous action token.
+        targets = np.zeros_like(tokens)
+        targets[:, :-1] = tokens[:, 1:]
+        mask_loss = np.zeros_like(mask)
+        mask_loss[:, self.prompt_pad_length : -1] = gen["mask_loss"][:, 1:]
+
+        batch_size, num_slots = len(tokens), self.pack_examples
+        text_length = self.packed_text_length
+        if batch_size % num_slots != 0:
+            raise ValueError(
+                f"Batch size {batch_size} is not divisible by pack_examples={num_slots}"
+            )
+        num_rows = batch_size // num_slots
+        lengths = mask.sum(axis=1)
+
+        # Longest first into the least loaded row that has room for it.
+        load = np.zeros(num_rows, dtype=np.int64)
+        count = np.zeros(num_rows, dtype=np.int64)
+        perm = np.zeros(batch_size, dtype=np.int64)
+        fits = np.zeros(batch_size, dtype=bool)
+        for i in np.argsort(-lengths, kind="stable"):
+            has_slot = count < num_slots
+            fits[i] = np.any(has_slot & (load + lengths[i] <= text_length))
+            candidates = has_slot & ((load + lengths[i] <= text_length) | ~fits[i])
+            row = np.flatnonzero(candidates)[np.argmin(load[candidates])]
+            perm[row * num_slots + count[row]] = i
+            if fits[i]:
+                load[row] += lengths[i]
+            count[row] += 1
+
+        packed = {
+            key: np.zeros((num_rows, text_length), dtype=dtype)
+            for key, dtype in [
+                ("tokens", tokens.dtype),
+                ("mask_ar", bool),
+                ("positions", np.int32),
+                ("segment_ids", np.int32),
+                ("targets", tokens.dtype),
+                ("mask_loss", bool),
+            ]
+        }
+        for row in range(num_rows):
+            offset = 0
+            for slot in range(num_slots):
+                i = perm[row * num_slots + slot]
+                if not fits[i]:
+                    continue
+                valid = mask[i]
+                n = lengths[i]
+                dest = (row, slice(offset, offset + n))
+                packed["tokens"][dest] = tokens[i][valid]
+                packed["mask_ar"][dest] = mask_ar[i][valid]
+                packed["positions"][dest] = np.arange(n)
+                packed["segment_ids"][dest] = slot + 1
+                packed["targets"][dest] = targets[i][valid]
+                packed["mask_loss"][dest] = mask_loss[i][valid]
+                offset += n
+
+        stats = {
+            "packing_dropped": np.mean(~fits),
+            "packing_text_efficiency": lengths[fits].sum() / (num_rows * text_length),
+        }
+        return packed, perm, stats
+
     def get_actions(
         self,
         tokens: np.ndarray,
@@ -210,3 +341,37 @@ class SequenceBuilder:
         ) & ~np.isnan(actions)
 
         return actions, actions_mask
+
+    def batch_get_actions_jax(
+        self,
+        tokens,
+        action_tokenizer: ActionTokenizer,
+        *,
+        eos_id: int,
+        act0_id: int,
+        action_dim: int,
+        action_horizon: int,
+    ):
+        """
+        On-device version of `batch_get_actions` (with `boa_is_prompt=True`).
+
+        Requires an action tokenizer with a `detokenize_jax` method. Tokens
+        after the first EOS are masked out, as are all actions of sequences
+        without an EOS.
+        """
+        num_tokens = action_horizon * action_dim
+        has_eos = jnp.any(tokens == eos_id, axis=-1)
+        if tokens.shape[-1] < num_tokens:
+            tokens = jnp.pad(
+                tokens,
+                ((0, 0), (0, num_tokens - tokens.shape[-1])),
+                constant_values=eos_id,
+            )
+        tokens = tokens[:, :num_tokens]
+        before_eos = jnp.cumsum(tokens == eos_id, axis=-1) == 0
+
+        actions, actions_mask = action_tokenizer.detokenize_jax(
+            jnp.where(before_eos, tokens - act0_id, -1), action_dim=action_dim
+        )
+        actions_mask = actions_mask & has_eos[:, None, None]
+        return jnp.where(actions_mask, actions, 0.0), actions_mask
@@ -29,6 +29,16 @@ class ShardingMetadata:
         self.model_sharding_rule = model_sharding_rule
 
 
+def cast_params(params, dtype: str | None):
+    """Casts floating point params to `dtype`, leaving other leaves unchanged."""
+    if dtype is None:
+        return params
+    return jax.tree.map(
+        lambda x: x.astype(dtype) if jnp.issubdtype(x.dtype, jnp.floating) else x,
+        params,
+    )
+
+
 def initialize_train_state_fn(
     example_batch: Any,
     model_spec: ModuleSpec,
@@ -45,6 +55,7 @@ def initialize_train_state_fn(
             *example_batch,
             train=False,
         )["params"]
+        params = cast_params(params, getattr(model, "param_dtype", None))
 
         return TrainState.create(
             apply_fn=model.apply,
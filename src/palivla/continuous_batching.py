@@ -0,0 +1,280 @@
+"""
+Continuous batching for serving action generation to many clients.
+
+`ContinuousBatchingEngine` decodes a fixed number of sequences ("slots") at a
+time from one KV cache. New requests are prefilled on their own and inserted
+into free slots between decode steps, and each sequence is returned as soon as
+it emits EOS, instead of the whole batch waiting for its slowest sequence.
+"""
+
+import concurrent.futures
+import dataclasses
+import queue
+import threading
+
+import flax.linen as nn
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from big_vision.models.proj.paligemma.gemma_bv import insert_prefilled, shift_cache
+from palivla.model_components import ModelComponents
+from palivla.predict_fns import _extend_cache, _prefill_cache, _sample_logits
+
+
+@dataclasses.dataclass
+class _Request:
+    inputs: dict
+    future: concurrent.futures.Future
+    tokens: list = dataclasses.field(default_factory=list)
+
+
+def _admit(cache, logits, prefilled, new_logits, slots, end):
+    cache = insert_prefilled(cache, prefilled, slots, end)
+    return cache, logits.at[slots].set(new_logits)
+
+
+def _step(params, cache, logits, rng, *, model, sampler, temperature):
+    tokens, _ = _sample_logits(logits, sampler=sampler, temperature=temperature, rng=rng)
+    logits, cache = _extend_cache(params, cache, tokens, model=model)
+    return tokens[:, 0], logits, cache
+
+
+class ContinuousBatchingEngine:
+    """
+    Decodes actions for requests arriving at different times.
+
+    All slots share the KV cache row written at each step, so a request is
+    admitted by writing its prefilled prompt to end at that row. Once the last
+    row is reached, the cache is shifted back over the rows no running sequence
+    uses anymore; with the default `cache_size` of twice the longest sequence
+    this happens at most every `prompt + max_decode_len` steps.
+
+    Use `submit` and `step` from a single thread, or `start` a background loop
+    and only `submit`. The futures resolve to `(actions, actions_mask)`. If the
+    background loop fails, all queued and running requests fail with its error
+    and later calls to `submit` raise.
+    """
+
+    def __init__(
+        self,
+        model: ModelComponents,
+        *,
+        action_dim: int,
+        action_horizon: int,
+        num_slots: int = 8,
+        max_decode_len: int = None,
+        cache_size: int = None,
+        use_ema_params: bool = False,
+        sampler: str = "greedy",
+        temperature: float = None,
+        rng: jax.Array = None,
+        image_cache=None,
+    ):
+        self.model = model
+        self.image_cache = image_cache
+        self.action_dim = action_dim
+        self.action_horizon = action_horizon
+        self.num_slots = num_slots
+        self.max_decode_len = max_decode_len or model.sequence_builder.gen_pad_length
+        self.cache_size = cache_size
+        self.params = model.train_state.get_params(use_ema_params=use_ema_params)
+        self.rng = jax.random.PRNGKey(0) if rng is None else rng
+        self.eos_token = model.language_tokenizer.eos_token_id
+
+        self.pending = queue.Queue()
+        self.slots: list[_Request | None] = [None] * num_slots
+        self.slot_begin = np.zeros((num_slots,), np.int64)
+        self.cache = None
+        self.logits = None
+        self.prompt_len = None
+        self.end = None  # Next cache row to write, the same for all slots.
+
+        self._prefill = jax.jit(
+            _prefill_cache, static_argnames=("model", "max_decode_len")
+        )
+        self._admit = jax.jit(_admit, donate_argnums=(0, 1))
+        self._shift = jax.jit(shift_cache, donate_argnums=0)
+        self._step = jax.jit(
+            _step,
+            donate_argnums=(1, 2),
+            static_argnames=("model", "sampler", "temperature"),
+        )
+        self._step_kwargs = dict(
+            model=model.train_state.model, sampler=sampler, temperature=temperature
+        )
+        self._thread = None
+        self._stop = threading.Event()
+        # Set (under the lock) once the background loop failed.
+        self._lock = threading.Lock()
+        self._error = None
+
+    def submit(self, batch, frame_ids=None) -> list[concurrent.futures.Future]:
+        """
+        Queues each example of a `ModelComponents.predict` batch as a request.
+        With an `image_cache`, the observation's frames with `frame_ids` are
+        only encoded once across requests.
+        """
+        inputs, _ = self.model._build_predict_inputs(
+            batch,
+            include_action_tokens=False,
+            image_cache=self.image_cache,
+            frame_ids=frame_ids,
+        )
+        batch_size = len(jax.tree.leaves(inputs)[0])
+        requests = [
+            _Request(
+                jax.tree.map(lambda x: np.asarray(x)[i : i + 1], inputs),
+                concurrent.futures.Future(),
+            )
+            for i in range(batch_size)
+        ]
+        with self._lock:
+            if self._error is not None:
+                raise RuntimeError("The decoding loop failed.") from self._error
+            for request in requests:
+                self.pending.put(request)
+        return [request.future for request in requests]
+
+    @property
+    def num_active(self) -> int:
+        return sum(r is not None for r in self.slots)
+
+    def step(self) -> int:
+        """
+        Admits pending requests into free slots and decodes one token for every
+        slot. Returns the number of requests finished by this step.
+        """
+        with self.model.sharding.mesh.mesh, nn.logical_axis_rules([("act_batch", "fsdp")]):
+            self._admit_pending()
+            if self.num_active == 0:
+                return 0
+            if self.end == self.cache_size:
+                self._compact()
+
+            self.rng, step_rng = jax.random.split(self.rng)
+            tokens, self.logits, self.cache = self._step(
+                self.params, self.cache, self.logits, step_rng, **self._step_kwargs
+            )
+            self.end += 1
+
+        tokens = jax.device_get(tokens)
+        finished = 0
+        for slot, request in enumerate(self.slots):
+            if request is None:
+                continue
+            request.tokens.append(int(tokens[slot]))
+            if request.tokens[-1] == self.eos_token or len(request.tokens) == self.max_decode_len:
+                self.slots[slot] = None
+                self._finish(request)
+                finished += 1
+        return finished
+
+    def start(self):
+        """Runs `step` in a background thread until `stop` is called."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if self.num_active == 0 and self.pending.empty():
+                self._stop.wait(0.001)
+                continue
+            try:
+                self.step()
+            except Exception as e:
+                self._fail(e)
+                raise
+
+    def _fail(self, error: Exception):
+        """Fails the running and queued requests, and any later `submit`."""
+        with self._lock:
+            self._error = error
+            requests = [r for r in self.slots if r is not None]
+            self.slots = [None] * self.num_slots
+            while True:
+                try:
+                    requests.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+        for request in requests:
+            request.future.set_exception(error)
+
+    def _admit_pending(self):
+        free = [slot for slot, r in enumerate(self.slots) if r is None]
+        requests = []
+        while len(requests) < len(free):
+            try:
+                requests.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        if not requests:
+            return
+
+        inputs = jax.tree.map(lambda *xs: np.concatenate(xs), *[r.inputs for r in requests])
+        new_logits, prefilled = self._prefill(
+            self.params, inputs, model=self._step_kwargs["model"], max_decode_len=0
+        )
+        if self.cache is None:
+            self._init_cache(requests[0].inputs, prefilled)
+
+        slots = np.asarray(free[: len(requests)], np.int32)
+        self.cache, self.logits = self._admit(
+            self.cache, self.logits, prefilled, new_logits, slots, self.end
+        )
+        prompt_lens = jax.device_get(prefilled["llm"]["seq_len"])
+        for slot, request, prompt_len in zip(slots, requests, prompt_lens):
+            self.slots[slot] = request
+            self.slot_begin[slot] = self.end - prompt_len
+
+    def _init_cache(self, inputs, prefilled):
+        self.prompt_len = int(jax.device_get(prefilled["llm"]["cache_end"][0]))
+        longest = self.prompt_len + self.max_decode_len
+        self.cache_size = self.cache_size or 2 * longest
+        if self.cache_size <= longest:
+            raise ValueError(
+                f"cache_size={self.cache_size} must exceed the prompt plus decode "
+                f"length ({longest})."
+            )
+
+        inputs = jax.tree.map(lambda x: np.repeat(x, self.num_slots, axis=0), inputs)
+        logits, cache = jax.eval_shape(
+            lambda: _prefill_cache(
+                self.params,
+                inputs,
+                model=self._step_kwargs["model"],
+                max_decode_len=self.cache_size - self.prompt_len,
+            )
+        )
+        zeros = lambda x: jnp.zeros(x.shape, x.dtype)
+        self.logits = zeros(logits)
+        # Start writing after the rows needed to admit the first prompts.
+        self.cache = self._shift(jax.tree.map(zeros, cache), -self.prompt_len)
+        self.end = self.prompt_len
+
+    def _compact(self):
+        active = [self.slot_begin[s] for s, r in enumerate(self.slots) if r is not None]
+        shift = int(min(active + [self.end - self.prompt_len]))
+        self.cache = self._shift(self.cache, shift)
+        self.slot_begin -= shift
+        self.end -= shift
+
+    def _finish(self, request: _Request):
+        tokens = np.zeros((1, self.max_decode_len), np.int32)
+        tokens[0, : len(request.tokens)] = request.tokens
+        actions, actions_mask = self.model.sequence_builder.batch_get_actions(
+            tokens,
+            self.model.language_tokenizer,
+            self.model.action_tokenizer,
+            boa_is_prompt=True,
+            action_dim=self.action_dim,
+            action_horizon=self.action_horizon,
+        )
+        request.future.set_result((actions[0], actions_mask[0]))
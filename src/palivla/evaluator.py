@@ -0,0 +1,143 @@
+import multiprocessing.pool
+import os
+from typing import Any, Callable, Iterator
+
+import jax
+import numpy as np
+from matplotlib.figure import Figure
+
+from big_vision.evaluators.common import process_sum
+from palivla.model_components import (
+    ModelComponents,
+    add_diff_stats,
+    finalize_gen_stats,
+)
+
+
+class Evaluator:
+    """
+    Generation metrics on a held-out dataset.
+
+    Each run streams `num_batches` batches from `data_iter` (e.g. a
+    `make_base_dataset(train=False)` iterator), accumulates metric sums on
+    device without blocking, and only transfers and reduces them across hosts
+    once all batches have been decoded. Visualizations of the first batch are
+    written on a background thread so they don't stall training. The shuffled
+    language instructions are drawn from `seed` and the step, so every run is
+    reproducible.
+    """
+
+    def __init__(
+        self,
+        data_iter: Iterator[Any] | None,
+        num_batches: int,
+        *,
+        num_visualizations: int = 0,
+        visualization_dir: str = "images",
+        seed: int = 0,
+    ):
+        self.data_iter = data_iter
+        self.num_batches = num_batches
+        self.num_visualizations = num_visualizations
+        self.visualization_dir = visualization_dir
+        self.seed = seed
+        self.pool = multiprocessing.pool.ThreadPool(1)  # 1 keeps writes ordered.
+        self.pending = None
+
+    def run(
+        self,
+        model: ModelComponents,
+        step: int,
+        *,
+        on_visualize: Callable[[tuple[int, list[str]]], None] | None = None,
+    ) -> dict[str, float]:
+        """
+        Computes metrics for the next `num_batches` batches.
+
+        If visualizations are enabled, `on_visualize` is called from the
+        background thread with the eval step and the paths of the written
+        images.
+        """
+        sums, sums_random = None, None
+        rng = jax.random.fold_in(jax.random.PRNGKey(self.seed), step)
+        for i in range(self.num_batches):
+            batch = next(self.data_iter)
+            batch_sums, batch_sums_random, predicted_actions = model.eval_sums(
+                batch, rng=jax.random.fold_in(rng, i)
+            )
+
+            # Accumulate on device; nothing is transferred until the end.
+            if sums is None:
+                sums, sums_random = batch_sums, batch_sums_random
+            else:
+                sums, sums_random = jax.tree.map(
+                    lambda a, b: a + b,
+                    (sums, sums_random),
+                    (batch_sums, batch_sums_random),
+                )
+
+            if i == 0 and self.num_visualizations > 0 and jax.process_index() == 0:
+                self.visualize(model, batch, predicted_actions, step, on_visualize)
+
+        sums, sums_random = process_sum(jax.device_get((sums, sums_random)))
+        return add_diff_stats(
+            finalize_gen_stats(sums) | finalize_gen_stats(sums_random, suffix="_random")
+        )
+
+    def visualize(self, model, batch, predicted_actions, step, on_visualize=None):
+        """Writes visualizations for a few examples of `batch` on a background thread."""
+        # Don't queue up work if the previous visualization is still running.
+        if self.pending is not None and not self.pending.ready():
+            return
+
+        batch_size = len(batch["action"])
+        idxs = np.random.choice(
+            batch_size, min(self.num_visualizations, batch_size), replace=False
+        )
+        # Gather everything the visualization needs now, so the batch can be freed.
+        gt_actions = batch["action"][idxs, -1]
+        pred_actions = np.asarray(jax.device_get(predicted_actions))[idxs]
+        images = batch["observation"]["image_primary"][idxs]
+        prompts = [
+            model.sequence_builder.prepare_prompt(p)
+            for p in batch["task"]["language_instruction"][idxs]
+        ]
+        self.pending = self.pool.apply_async(
+            _write_visualizations,
+            (gt_actions, pred_actions, images, prompts, step, self.visualization_dir),
+            callback=on_visualize,
+        )
+
+    def wait_until_finished(self):
+        if self.pending is not None:
+            self.pending.get()
+
+
+def _write_visualizations(gt_actions, pred_actions, images, prompts, step, out_dir):
+    """
+    Plots cumulative gt/predicted trajectories next to the observation.
+    Returns the step along with the image paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    gt_viz = np.cumsum(gt_actions, axis=1)
+    gt_viz = gt_viz - gt_viz[:, :1]
+    pred_viz = np.cumsum(pred_actions, axis=1)
+    pred_viz = pred_viz - pred_viz[:, :1]
+
+    paths = []
+    for j in range(len(gt_viz)):
+        # Use the object-oriented API, pyplot is not thread-safe.
+        fig = Figure()
+        ax = fig.subplots(1, 2)
+        ax[0].plot(gt_viz[j, :, 0], gt_viz[j, :, 1], "r", label="gt")
+        ax[0].plot(gt_viz[j, -1, 0], gt_viz[j, -1, 1], "ro")
+        ax[0].plot(pred_viz[j, :, 0], pred_viz[j, :, 1], "b", label="pred")
+        ax[0].plot(pred_viz[j, -1, 0], pred_viz[j, -1, 1], "bo")
+        ax[0].legend()
+        ax[1].imshow(images[j].reshape(-1, *images[j].shape[-3:])[-1])
+        ax[1].set_title(prompts[j])
+        path = os.path.join(out_dir, f"eval_{step}_{j}.png")
+        fig.savefig(path)
+        paths.append(path)
+    return step, paths
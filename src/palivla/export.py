@@ -0,0 +1,267 @@
+"""
+Inference-only export of a PaliVLA model.
+
+`export_for_inference` writes everything the action server needs into a single
+local directory:
+
+    language_tokenizer/        HF tokenizer (save_pretrained)
+    action_tokenizer.pkl       action tokenizer (+ any files it saves)
+    sequence_builder.pkl       sequence builder
+    model_spec.json            model spec
+    params.npz                 params only (optionally bfloat16 or int8)
+    inference.json             export settings (param format, sampler, ...)
+    warmup_batch.pkl           a batch used to trace the decode functions
+    xla_cache/                 serialized compiled decode executables
+
+`load_for_inference` memory-maps the params straight onto their shards, skips
+the optimizer and the abstract train state entirely, and warms up decoding from
+the persistent compilation cache, so a server comes up without recompiling.
+"""
+
+import json
+import os
+import zipfile
+from typing import Any, Literal
+
+import cloudpickle
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+from scalax.sharding import PartitionSpec
+from transformers import AutoTokenizer
+
+from big_vision.utils import NpzMmap
+from palivla.components.action_tokenizer import ActionTokenizer
+from palivla.components.sequence_builder import SequenceBuilder
+from palivla.components.train_state import ShardingMetadata, TrainState
+from palivla.model_components import ModelComponents
+from palivla.spec import ModuleSpec, OptimizerSpec
+from palivla.utils import key_string
+
+ParamFormat = Literal["float32", "bfloat16", "int8"]
+
+
+def enable_compilation_cache(path: str):
+    """Persists every compiled executable under `path`/xla_cache."""
+    jax.config.update("jax_compilation_cache_dir", os.path.join(path, "xla_cache"))
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    jax.config.update("jax_persistent_cache_min_entry_size_bytes", -1)
+
+
+def export_for_inference(
+    model: ModelComponents,
+    path: str,
+    warmup_batch: Any,
+    *,
+    param_format: ParamFormat | None = None,
+    use_ema_params: bool = False,
+    sampler: str = "greedy",
+    temperature: float | None = None,
+):
+    """
+    Writes an inference-only artifact for `model` to the local directory `path`.
+
+    `warmup_batch` is a batch as passed to `ModelComponents.predict` with the
+    batch size the server will use; decoding it once here populates the
+    artifact's compilation cache. `param_format` defaults to the params' own
+    dtypes; with "int8", matrices are stored with a symmetric per-channel
+    (last axis) scale and dequantized to bfloat16 on load. Only host 0 writes
+    the artifact.
+    """
+    os.makedirs(path, exist_ok=True)
+    enable_compilation_cache(path)
+
+    params = model.train_state.get_params(use_ema_params=use_ema_params)
+    _write_params(model, params, os.path.join(path, "params.npz"), param_format)
+
+    if jax.process_index() == 0:
+        model.language_tokenizer.save_pretrained(
+            os.path.join(path, "language_tokenizer")
+        )
+        model.action_tokenizer.save(path)
+        model.sequence_builder.save(path)
+        with open(os.path.join(path, "model_spec.json"), "w") as f:
+            f.write(model.train_state.model_spec.to_json())
+        with open(os.path.join(path, "inference.json"), "w") as f:
+            json.dump(
+                {
+                    "param_format": param_format,
+                    "sampler": sampler,
+                    "temperature": temperature,
+                },
+                f,
+            )
+        with open(os.path.join(path, "warmup_batch.pkl"), "wb") as f:
+            cloudpickle.dump(warmup_batch, f)
+
+    # Compile the decode functions with params of the exported dtypes, so the
+    # cached executables match what the loader will run.
+    exported = ModelComponents(
+        language_tokenizer=model.language_tokenizer,
+        action_tokenizer=model.action_tokenizer,
+        sequence_builder=model.sequence_builder,
+        train_state=_inference_train_state(
+            model.train_state.model_spec,
+            jax.tree.map(lambda x: x.astype(_export_dtype(x, param_format)), params),
+        ),
+        sharding=model.sharding,
+        rng=model.rng,
+        example_batch=None,
+    )
+    _warmup(exported, warmup_batch, sampler=sampler, temperature=temperature)
+
+
+def load_for_inference(
+    path: str,
+    sharding: ShardingMetadata,
+    *,
+    warmup: bool = True,
+) -> ModelComponents:
+    """Loads an artifact written by `export_for_inference`, ready to serve."""
+    enable_compilation_cache(path)
+
+    with open(os.path.join(path, "model_spec.json"), "r") as f:
+        model_spec = ModuleSpec.from_json(f.read())
+    with open(os.path.join(path, "inference.json"), "r") as f:
+        inference_config = json.load(f)
+
+    params = _restore_params(os.path.join(path, "params.npz"), sharding)
+    model = ModelComponents(
+        language_tokenizer=AutoTokenizer.from_pretrained(
+            os.path.join(path, "language_tokenizer")
+        ),
+        action_tokenizer=ActionTokenizer.load(path),
+        sequence_builder=SequenceBuilder.load(path),
+        train_state=_inference_train_state(model_spec, params),
+        sharding=sharding,
+        rng=jax.random.PRNGKey(0),
+        example_batch=None,
+    )
+
+    if warmup:
+        with open(os.path.join(path, "warmup_batch.pkl"), "rb") as f:
+            warmup_batch = cloudpickle.load(f)
+        _warmup(
+            model,
+            warmup_batch,
+            sampler=inference_config["sampler"],
+            temperature=inference_config["temperature"],
+        )
+    return model
+
+
+def _inference_train_state(model_spec: ModuleSpec, params):
+    model = model_spec.instantiate()
+    return TrainState.create(
+        apply_fn=model.apply,
+        model_spec=model_spec,
+        optimizer_spec=OptimizerSpec(optax.set_to_zero, {}),
+        model=model,
+        tx=optax.set_to_zero(),
+        params=params,
+    )
+
+
+def _warmup(model: ModelComponents, batch, *, sampler: str, temperature: float | None):
+    tokens, _ = model.predict_tokens(
+        batch,
+        include_action_tokens=False,
+        sampler=sampler,
+        temperature=temperature,
+    )
+    jax.block_until_ready(tokens)
+
+
+def _export_dtype(x, param_format: ParamFormat | None):
+    """The dtype `x` is served in."""
+    if param_format is None or not jnp.issubdtype(x.dtype, jnp.floating):
+        return x.dtype
+    if param_format == "int8":
+        return jnp.bfloat16
+    return jnp.dtype(param_format)
+
+
+def _quantize_int8(x: np.ndarray):
+    reduce_axes = tuple(range(x.ndim - 1))
+    scale = np.max(np.abs(x), axis=reduce_axes, keepdims=True) / 127.0
+    scale = np.where(scale == 0, 1.0, scale).astype(np.float32)
+    return np.round(x / scale).astype(np.int8), scale
+
+
+def _write_params(model: ModelComponents, params, path: str, param_format):
+    """Writes params to an uncompressed .npz, one (gathered) leaf at a time."""
+    is_writer = jax.process_index() == 0
+    zf = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True) if is_writer else None
+
+    def _write(name, x):
+        with zf.open(name + ".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, np.ascontiguousarray(x), allow_pickle=False)
+
+    for key_path, param in jax.tree_util.tree_flatten_with_path(params)[0]:
+        name = key_string(key_path)
+        # The gather is collective, so every host runs it; only host 0 writes.
+        x = model.data_gather_fn(param)
+        if not is_writer:
+            continue
+
+        if param_format == "int8" and jnp.issubdtype(x.dtype, jnp.floating) and x.ndim >= 2:
+            q, scale = _quantize_int8(np.asarray(x, np.float32))
+            _write(f"int8/{name}", q)
+            _write(f"scale/{name}", scale)
+        else:
+            _write(f"params/{name}", x.astype(_export_dtype(x, param_format)))
+
+    if is_writer:
+        zf.close()
+
+
+def _restore_params(path: str, sharding: ShardingMetadata):
+    """Places the params in `path` directly onto their shards."""
+    with NpzMmap(path) as npz:
+        arrays = {}
+        for key in npz:
+            kind, name = key.split("/", 1)
+            if kind == "params":
+                arrays[name] = (npz[key], None)
+            elif kind == "int8":
+                arrays[name] = (npz[key], np.asarray(npz[f"scale/{name}"]))
+
+        abstract_params = _unflatten(
+            {
+                name: jax.ShapeDtypeStruct(
+                    array.shape, array.dtype if scale is None else jnp.bfloat16
+                )
+                for name, (array, scale) in arrays.items()
+            }
+        )
+        if isinstance(sharding.model_sharding_rule, PartitionSpec):
+            specs = jax.tree.map(lambda _: sharding.model_sharding_rule, abstract_params)
+        else:
+            specs = sharding.model_sharding_rule.apply(abstract_params)
+
+        def _restore(key_path, x, spec):
+            array, scale = arrays[key_string(key_path)]
+
+            def _read(index):
+                if scale is None:
+                    return np.asarray(array[index])
+                channels = (slice(None),) * (array.ndim - 1) + (index[-1],)
+                return (array[index] * scale[channels]).astype(x.dtype)
+
+            return jax.make_array_from_callback(
+                x.shape, jax.sharding.NamedSharding(sharding.mesh.mesh, spec), _read
+            )
+
+        return jax.tree_util.tree_map_with_path(_restore, abstract_params, specs)
+
+
+def _unflatten(flat: dict[str, Any]) -> dict[str, Any]:
+    tree = {}
+    for name, value in flat.items():
+        *parents, leaf = name.split("/")
+        node = tree
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = value
+    return tree
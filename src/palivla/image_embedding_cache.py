@@ -0,0 +1,124 @@
+"""
+Caching of image embeddings across inference calls.
+
+With `window_size > 1`, each observation holds the last `k` frames of an
+episode, so consecutive inference calls share `k - 1` frames which would
+otherwise all be encoded again by the ViT.
+"""
+
+import collections
+import threading
+from typing import Sequence
+
+import flax.linen as nn
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from palivla.model_components import ModelComponents
+
+
+def _encode_images(params, images, *, model):
+    embeds, _ = model.apply({"params": params}, images, method=model.encode_images)
+    return embeds
+
+
+class ImageEmbeddingCache:
+    """
+    Encodes each frame once, looking up frames by id.
+
+    `embed_observation` encodes only the frames whose id it has not seen
+    before (and each id of a batch once), and replaces the pixels of each
+    image modality with the frame embeddings, as `<modality>_embeds`. The model
+    uses these instead of encoding the images. The least recently used
+    embeddings are evicted beyond `max_frames`.
+
+    The embeddings are dropped whenever the model's params change (e.g. after
+    `load_state` or a train step), so they always match the current params.
+    """
+
+    def __init__(
+        self,
+        model: ModelComponents,
+        *,
+        modalities: Sequence[str] | None = None,
+        max_frames: int = 4096,
+        use_ema_params: bool = False,
+    ):
+        self.model = model
+        if modalities is None:
+            modalities = [
+                modality
+                for modality, encoder in model.train_state.model.modality_mappings.items()
+                if encoder == "img"
+            ]
+        self.modalities = list(modalities)
+        self.max_frames = max_frames
+        self.use_ema_params = use_ema_params
+        self.params = model.train_state.get_params(use_ema_params=use_ema_params)
+        self.embeds = collections.OrderedDict()
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+        self._encode = jax.jit(_encode_images, static_argnames="model")
+
+    def embed_observation(self, observation, frame_ids):
+        """
+        Returns `observation` with embeddings instead of images.
+
+        Args:
+            observation: observation of a `ModelComponents.predict` batch, with
+                images [b, k, h, w, c] (or [b, h, w, c]).
+            frame_ids: ids [b, k] (or [b]) of the frames, e.g. (episode, timestep)
+                pairs as an array [b, k, 2]. Frames with the same id must be the
+                same image.
+        """
+        with self._lock:
+            return self._embed_observation(observation, frame_ids)
+
+    def _embed_observation(self, observation, frame_ids):
+        params = self.model.train_state.get_params(use_ema_params=self.use_ema_params)
+        if params is not self.params:
+            # Embeddings of other params
+            self.params = params
+            self.embeds.clear()
+
+        observation = dict(observation)
+        for modality in self.modalities:
+            images = np.asarray(observation.pop(modality))
+            frames_shape = images.shape[:-3]
+            images = images.reshape((-1, *images.shape[-3:]))
+            ids = np.asarray(frame_ids).reshape(len(images), -1).tolist()
+            keys = [(modality, *frame_id) for frame_id in ids]
+
+            # Index of the (last) frame of each id which is not cached yet.
+            missing = {key: i for i, key in enumerate(keys) if key not in self.embeds}
+            self.misses += len(missing)
+            self.hits += len(keys) - len(missing)
+            if missing:
+                self._add(list(missing), images[list(missing.values())])
+
+            embeds = []
+            for key in keys:
+                self.embeds.move_to_end(key)
+                embeds.append(self.embeds[key])
+            observation[f"{modality}_embeds"] = jnp.stack(embeds).reshape(
+                (*frames_shape, *embeds[0].shape)
+            )
+            while len(self.embeds) > self.max_frames:
+                self.embeds.popitem(last=False)
+        return observation
+
+    def _add(self, keys, images):
+        # Pad to a power of two, so that only few batch sizes are compiled.
+        num_images = len(images)
+        padded = 1 << (num_images - 1).bit_length()
+        images = np.concatenate(
+            [images, np.zeros((padded - num_images, *images.shape[1:]), images.dtype)]
+        )
+        with self.model.sharding.mesh.mesh, nn.logical_axis_rules([("act_batch", "fsdp")]):
+            embeds = self._encode(
+                self.params, images, model=self.model.train_state.model
+            )
+        for i, key in enumerate(keys):
+            self.embeds[key] = embeds[i]
@@ -207,36 +207,49 @@ def make_sharding(config: ConfigDict):
     )
     return sharding_metadata
 
-def run_inference(model, prompt, image, config, inference_device="gpu"):
+def make_inference_batch(prompt, image, config, inference_device="gpu"):
+    """
+    Builds a `ModelComponents.predict` batch from a prompt and a PIL image, or
+    a list of PIL images (a history of frames, oldest first).
+    """
+    def _resize(image):
+        image = tf.convert_to_tensor(np.asarray(image.convert("RGB")))
+        return np.array(dl.transforms.resize_image(image, size=config["dataset_kwargs"]["frame_transform_kwargs"]["resize_size"]["primary"]))
+
+    if isinstance(image, (list, tuple)):
+        image = np.stack([_resize(frame) for frame in image])
+        image_mask = np.ones(len(image), dtype=bool)
+    else:
+        image = _resize(image)
+        image_mask = np.array(True)
+
+    # TPU inference runs 4 copies of the request
+    batch_size = 4 if inference_device == "tpu" else 1
+    batch = {"task" : 
+                {"language_instruction" : np.array([prompt.encode("utf-8")]*batch_size), 
+                "pad_mask_dict": {"language_instruction": np.array([1]*batch_size)}},
+            "observation": 
+                {"image_primary": np.repeat(image[None], batch_size, axis=0), 
+                "pad_mask_dict": {"image_primary": np.repeat(image_mask[None], batch_size, axis=0)}},
+            "action": np.random.randn(batch_size, 1, 2).astype(np.float64),    
+            }
+    return batch
+
+def run_inference(model, prompt, image, config, inference_device="gpu", *, image_cache=None, frame_ids=None):
+    """
+    Predicts the actions for a prompt and an image (or a history of images, see
+    `make_inference_batch`). With an `ImageEmbeddingCache`, the `frame_ids` of
+    the images (e.g. (episode, timestep) pairs) skip encoding frames again.
+    """
 
     if config.get("inference_device") is not None:
         inference_device = config["inference_device"]
 
     os.makedirs("~/temp_viz", exist_ok=True)
     action_horizon = config["dataset_kwargs"]["traj_transform_kwargs"]["action_horizon"]
-    image = tf.convert_to_tensor(np.asarray(image.convert("RGB")))
-    image = dl.transforms.resize_image(image, size=config["dataset_kwargs"]["frame_transform_kwargs"]["resize_size"]["primary"])
-    if inference_device == "tpu":
-        image = np.expand_dims(np.array(image), 0).repeat(4, axis=0)
-        batch = {"task" : 
-                    {"language_instruction" : np.array([prompt.encode("utf-8")]*4), 
-                    "pad_mask_dict": {"language_instruction": np.array([1]*4)}},
-                "observation": 
-                    {"image_primary": image, 
-                    "pad_mask_dict": {"image_primary": np.array([1]*4, dtype=bool)}},
-                "action": np.random.randn(4, 1, 2).astype(np.float64),    
-                }
-    else:
-        image = np.expand_dims(np.array(image), 0)
-
-        batch = {"task" : 
-                    {"language_instruction" : np.array([prompt.encode("utf-8")]), 
-                    "pad_mask_dict": {"language_instruction": np.array([1])}},
-                "observation": 
-                    {"image_primary": image, 
-                    "pad_mask_dict": {"image_primary": np.array([1], dtype=bool)}},
-                "action": np.random.randn(1, 1, 2).astype(np.float64),    
-                }
+    batch = make_inference_batch(prompt, image, config, inference_device)
+    if frame_ids is not None:
+        frame_ids = np.broadcast_to(frame_ids, (len(batch["action"]), *np.shape(frame_ids)))
 
     # Predict the output 
     if config.get("sampler") is not None:
@@ -248,7 +261,7 @@ def run_inference(model, prompt, image, config, inference_device="gpu"):
     else:
         sampler = "greedy"
         temperature = None
-    predicted_actions, actions_mask, tokens = model.predict(batch, action_dim=2, action_horizon=action_horizon, return_tokens=True, include_action_tokens=False, sampler=sampler, temperature=temperature)
+    predicted_actions, actions_mask, tokens = model.predict(batch, action_dim=2, action_horizon=action_horizon, return_tokens=True, include_action_tokens=False, sampler=sampler, temperature=temperature, image_cache=image_cache, frame_ids=frame_ids)
     predicted_actions = predicted_actions[0].squeeze()
     summed_actions = np.cumsum(predicted_actions, axis=0)
     summed_actions -= summed_actions[0]
@@ -1,13 +1,21 @@
+import logging
 from typing import Literal
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 
-from big_vision.utils import Registry
+from big_vision.utils import NpzMmap, Registry
 from palivla.model_components import ModelComponents
 from palivla.palivla_typing import Params
+from palivla.utils import key_string
 from ml_collections import FrozenConfigDict
 
+# Params whose leading (vocab) axis may be larger in the model than in the
+# checkpoint. Rows beyond the checkpoint's are set to the mean embedding, so the
+# new vocab doesn't drown out signal from the existing vocab.
+_SUBARRAY_PARAMS = ("llm/embedder/input_embedding",)
+
 
 @Registry.register("load.paligemma_weights")
 def load_paligemma_weights(
@@ -15,8 +23,18 @@ def load_paligemma_weights(
     *,
     hf_repo: str | None,
     path: str | None,
-    param_dtype: jnp.dtype = jnp.float32,
+    param_dtype: jnp.dtype | None = None,
+    streaming: bool = False,
 ):
+    """
+    Loads PaliGemma base weights into the model's params.
+
+    By default, the whole checkpoint is first loaded on host with big_vision's
+    loader, which also handles .ts checkpoints and converts old/non-scan
+    layouts. With `streaming`, .npz checkpoints already in the model's layout
+    are memory-mapped and every param is built directly on its shards, reading
+    only the slices each host needs (see `stream_npz_params`).
+    """
     from big_vision.models.proj.paligemma.paligemma import load as load_paligemma
 
     if hf_repo is not None:
@@ -27,6 +45,10 @@ def load_paligemma_weights(
             path,
         )
 
+    if streaming and path is not None and ".npz" in path:
+        stream_npz_params(model, path, param_dtype=param_dtype)
+        return
+
     # TODO(Kyle): Allow loading other variants of PaliGemma
     base_model_cfg = FrozenConfigDict(
         {
@@ -64,8 +86,8 @@ def load_paligemma_weights(
             return param
         elif mismatch_strategy == "subarray":
             return jax.lax.dynamic_update_slice(
-                param.astype(param_dtype),
-                load_param.astype(param_dtype),
+                param.astype(param_dtype or param.dtype),
+                load_param.astype(param_dtype or param.dtype),
                 (0,) * param.ndim,
             )
         elif mismatch_strategy == "error":
@@ -113,9 +135,12 @@ def load_paligemma_weights(
             raise ValueError(f"Error replacing param {path_str}: {e}")
 
     def _replace_params(params: Params, param_replacements: Params):
+        # Keep the dtypes of the model's params (e.g. bfloat16 under a mixed
+        # precision policy) unless a dtype is given explicitly.
         return jax.tree.map(
-            lambda x: x.astype(param_dtype),
+            lambda x, p: x.astype(param_dtype or p.dtype),
             _replace_params_fn(params, param_replacements, ""),
+            params,
         )
 
     replace_params_fn = model.sharding.mesh.sjit(
@@ -128,3 +153,92 @@ def load_paligemma_weights(
     model.train_state = model.train_state.replace(
         params=replace_params_fn(model.train_state.params, base_params)
     )
+
+
+def stream_npz_params(
+    model: ModelComponents,
+    path: str,
+    *,
+    prefix: str = "params/",
+    param_dtype: jnp.dtype | None = None,
+    required: tuple[str, ...] = ("img/", "llm/"),
+):
+    """
+    Loads a .npz checkpoint leaf by leaf, straight onto each param's sharding.
+
+    The checkpoint must already be in the model's layout (as the released
+    PaliGemma .npz files are): raises a ValueError if any model param under
+    `required` is missing from it, e.g. for an old or non-scan layout. Other
+    params missing from the checkpoint keep their current values. Peak host
+    memory is roughly the size of one host's shards of a single param.
+    """
+    params = model.train_state.params
+    new_params = {}
+    missing = []
+
+    with NpzMmap(path) as npz:
+        used = set()
+        for key_path, param in jax.tree_util.tree_flatten_with_path(params)[0]:
+            name = key_string(key_path)
+            dtype = param_dtype or param.dtype
+            load_param = npz.get(prefix + name)
+            if load_param is None:
+                if name.startswith(required):
+                    missing.append(name)
+                new_params[name] = param.astype(dtype)
+                continue
+            used.add(prefix + name)
+
+            try:
+                new_params[name] = _stream_param(param, load_param, name, dtype)
+            except ValueError as e:
+                raise ValueError(f"Error replacing param {name}: {e}")
+
+        unused = [k for k in npz if k.startswith(prefix) and k not in used]
+        if missing:
+            raise ValueError(
+                f"{len(missing)} model params are missing from the checkpoint {path}, "
+                f"which may not be in the model's layout (load it with streaming=False): "
+                f"{missing}. Checkpoint params not in the model: {unused}"
+            )
+        if unused:
+            logging.warning(f"Ignoring checkpoint params not in the model: {unused}")
+
+    params = jax.tree_util.tree_map_with_path(
+        lambda key_path, _: new_params[key_string(key_path)], params
+    )
+    model.train_state = model.train_state.replace(params=params)
+
+
+def _stream_param(param: jax.Array, load_param: np.ndarray, name: str, dtype):
+    """Builds a copy of `param` from `load_param`, one addressable shard at a time."""
+    if load_param.shape == param.shape:
+
+        def _read(index):
+            return np.asarray(load_param[index]).astype(dtype)
+
+    elif name in _SUBARRAY_PARAMS and (
+        load_param.shape[1:] == param.shape[1:]
+        and load_param.shape[0] <= param.shape[0]
+    ):
+        logging.info(f"Replacing param {name} with subarray strategy")
+        num_loaded = load_param.shape[0]
+        fill = np.asarray(jax.device_get(jnp.mean(param, axis=0))).astype(dtype)
+
+        def _read(index):
+            rows, rest = index[0], index[1:]
+            start, stop, _ = rows.indices(param.shape[0])
+            block = np.empty((stop - start, *fill[rest].shape), dtype=dtype)
+            block[:] = fill[rest]
+            if start < num_loaded:
+                block[: min(stop, num_loaded) - start] = load_param[
+                    (slice(start, min(stop, num_loaded)), *rest)
+                ]
+            return block
+
+    else:
+        raise ValueError(
+            f"Mismatch in shape between param {param.shape} and load_param {load_param.shape}"
+        )
+
+    return jax.make_array_from_callback(param.shape, param.sharding, _read)
@@ -7,6 +7,7 @@ import cloudpickle
 import pickle as pkl
 import flax.linen as nn
 import jax
+import jax.numpy as jnp
 import orbax.checkpoint as ocp
 from jax.sharding import PartitionSpec
 from transformers import AutoTokenizer
@@ -16,13 +17,13 @@ from palivla.components.action_tokenizer import ActionTokenizer
 from palivla.components.sequence_builder import SequenceBuilder
 from palivla.components.train_state import ShardingMetadata, TrainState
 from palivla.spec import ModuleSpec, OptimizerSpec
-from palivla.train_step import step_fn
+from palivla.train_step import eval_fn, step_fn
 from palivla.utils import read_staging_directory, write_staging_directory
 
 
-def make_step_fn(sharding: ShardingMetadata):
+def make_step_fn(sharding: ShardingMetadata, build_gen=None):
     return sharding.mesh.sjit(
-        partial(step_fn, train=True),
+        partial(step_fn, train=True, build_gen=build_gen),
         in_shardings=(sharding.model_sharding_rule, PartitionSpec("fsdp"), None),
         out_shardings=(sharding.model_sharding_rule, None, None),
         args_sharding_constraint=(
@@ -33,6 +34,115 @@ def make_step_fn(sharding: ShardingMetadata):
         donate_argnums=(0,),
     )
 
+
+def make_eval_fn(sharding: ShardingMetadata, sensors_repeat: int):
+    return sharding.mesh.sjit(
+        partial(eval_fn, sensors_repeat=sensors_repeat),
+        in_shardings=(sharding.model_sharding_rule, PartitionSpec("fsdp")),
+        out_shardings=None,
+    )
+
+
+def make_build_gen_fn(
+    sequence_builder: SequenceBuilder,
+    language_tokenizer: AutoTokenizer,
+    action_tokenizer: ActionTokenizer,
+):
+    """
+    Makes a function building the "gen" sequences from raw actions on device,
+    for use inside the compiled train step.
+
+    Returns None if the action tokenizer has no JAX implementation, in which
+    case the actions are tokenized on host.
+    """
+    if not hasattr(action_tokenizer, "tokenize_jax"):
+        return None
+
+    boa_id = language_tokenizer.encode("<begin_of_action>")[0]
+    eos_id = language_tokenizer.encode("<eos>")[0]
+    act0_id = language_tokenizer.encode("<act0>")[0]
+
+    def _build_gen(actions):
+        return sequence_builder.build_gen_jax(
+            action_tokenizer.tokenize_jax(actions),
+            boa_id=boa_id,
+            eos_id=eos_id,
+            act0_id=act0_id,
+        )
+
+    return _build_gen
+
+
+def make_gen_stats_fn(
+    sequence_builder: SequenceBuilder,
+    language_tokenizer: AutoTokenizer,
+    action_tokenizer: ActionTokenizer,
+):
+    """
+    Makes a jitted function computing generation metric sums on device.
+
+    Returns None if the action tokenizer has no JAX implementation, in which
+    case the metrics are computed on host.
+    """
+    if not hasattr(action_tokenizer, "detokenize_jax"):
+        return None
+
+    eos_id = language_tokenizer.encode("<eos>")[0]
+    act0_id = language_tokenizer.encode("<act0>")[0]
+
+    def _gen_stats(pred_tokens, target_tokens, target_mask, gt_actions):
+        actions, actions_mask = sequence_builder.batch_get_actions_jax(
+            pred_tokens,
+            action_tokenizer,
+            eos_id=eos_id,
+            act0_id=act0_id,
+            action_dim=gt_actions.shape[-1],
+            action_horizon=gt_actions.shape[-2],
+        )
+        return compute_gen_sums(
+            actions, actions_mask, gt_actions, pred_tokens, target_tokens, target_mask
+        ), actions
+
+    return jax.jit(_gen_stats)
+
+
+def compute_gen_sums(
+    actions, actions_mask, gt_actions, pred_tokens, target_tokens, target_mask
+):
+    """
+    Sums of generation metrics, to be reduced with `finalize_gen_stats`.
+    Sums can be accumulated across batches and processes. Works on both NumPy
+    and JAX arrays.
+    """
+    return {
+        "num_actions": jnp.asarray(actions_mask.size, dtype=jnp.float32),
+        "num_valid": actions_mask.sum(),
+        "l2": (jnp.square(actions - gt_actions) * actions_mask).sum(),
+        "l1": (jnp.abs(actions - gt_actions) * actions_mask).sum(),
+        "num_tokens": target_mask.sum(),
+        "num_correct": ((pred_tokens == target_tokens) * target_mask).sum(),
+    }
+
+
+def finalize_gen_stats(sums, suffix: str = ""):
+    """Turns (host) sums from `compute_gen_sums` into generation metrics."""
+    return {
+        f"gen_valid_pct{suffix}": sums["num_valid"] / sums["num_actions"],
+        f"gen_l2{suffix}": sums["l2"] / sums["num_valid"],
+        f"gen_l1{suffix}": sums["l1"] / sums["num_valid"],
+        f"gen_acc{suffix}": sums["num_correct"] / sums["num_tokens"],
+    }
+
+
+def add_diff_stats(eval_info):
+    """Relative change in generation metrics from shuffling the language instructions."""
+    return eval_info | {
+        "diff_l2": (eval_info["gen_l2_random"] - eval_info["gen_l2"]) / eval_info["gen_l2_random"],
+        "diff_l1": (eval_info["gen_l1_random"] - eval_info["gen_l1"]) / eval_info["gen_l1_random"],
+        "diff_acc": (eval_info["gen_acc"] - eval_info["gen_acc_random"]) / eval_info["gen_acc_random"],
+    }
+
+
 def make_gather_fn(mesh):
     jax_gather_fn = jax.jit(
         lambda x: x,
@@ -50,7 +160,10 @@ class ModelComponents:
         "sharding",
         "rng",
         "step_fn",
+        "tokenize_on_device",
+        "eval_fn",
         "data_gather_fn",
+        "gen_stats_fn",
         "example_batch",
     ]
 
@@ -70,9 +183,18 @@ class ModelComponents:
         self.train_state = train_state
         self.sharding = sharding
         self.rng = rng
-        self.step_fn = make_step_fn(sharding)
+        build_gen = make_build_gen_fn(
+            sequence_builder, language_tokenizer, action_tokenizer
+        )
+        self.step_fn = make_step_fn(sharding, build_gen=build_gen)
+        self.tokenize_on_device = build_gen is not None
+        self.eval_fn = make_eval_fn(sharding, sensors_repeat=2)
         self.data_gather_fn = make_gather_fn(sharding.mesh.mesh)
+        self.gen_stats_fn = make_gen_stats_fn(
+            sequence_builder, language_tokenizer, action_tokenizer
+        )
         self.example_batch = example_batch
+
     @classmethod
     def initialize(
         cls,
@@ -177,18 +299,44 @@ class ModelComponents:
         )
 
     def train_step(self, batch: Any):
-        # Tokenize the batch and build sequences
-        sequences = self.sequence_builder.build_sequence(
-            batch, self.language_tokenizer, self.action_tokenizer, include_action_tokens = True
-        )
+        packing_stats = {}
+        if self.sequence_builder.pack_examples > 1:
+            # Pack several examples per sequence, reordering the sensors to
+            # match the packed slots.
+            packed, perm, packing_stats = self.sequence_builder.build_packed_sequence(
+                batch, self.language_tokenizer, self.action_tokenizer
+            )
+            sensors = jax.tree.map(lambda x: x[perm], batch["observation"])
+            batch = {
+                "sensors": sensors,
+                "sensors_mask": sensors["pad_mask_dict"],
+                "packed": packed,
+            }
+        elif self.tokenize_on_device:
+            # Only the prompts are tokenized here, the actions are tokenized
+            # inside the compiled train step
+            sequences = self.sequence_builder.build_sequence(
+                batch, self.language_tokenizer, self.action_tokenizer, include_action_tokens=False
+            )
+            batch = {
+                "sensors": batch["observation"],
+                "sensors_mask": batch["observation"]["pad_mask_dict"],
+                "prompt": sequences["prompt"],
+                "actions": batch["action"][..., -1, :, :],
+            }
+        else:
+            # Tokenize the batch and build sequences
+            sequences = self.sequence_builder.build_sequence(
+                batch, self.language_tokenizer, self.action_tokenizer, include_action_tokens = True
+            )
+            batch = {
+                "sensors": batch["observation"],
+                "sensors_mask": batch["observation"]["pad_mask_dict"],
+                "prompt": sequences["prompt"],
+                "gen": sequences["gen"],
+            }
 
         # Shard the batch to devices
-        batch = {
-            "sensors": batch["observation"],
-            "sensors_mask": batch["observation"]["pad_mask_dict"],
-            "prompt": sequences["prompt"],
-            "gen": sequences["gen"],
-        }
         batch = self.sharding.mesh.local_data_to_global_array(batch)
         # Log the batch to wandb just before step 
 
@@ -198,72 +346,276 @@ class ModelComponents:
                 self.train_state, batch, self.rng
             )
 
-        return info
+        return info | packing_stats
 
-    def eval_step(self, batch):
-        gt_actions = batch["action"][:, -1, :, :]
+    def _gen_eval(self, tokens, sequences, gt_actions):
+        target_tokens = sequences["gen"]["tokens"]
+        target_mask = sequences["gen"]["mask"]
 
-        # Predicted actions with language conditioning
-        predicted_actions, actions_mask, tokens = self.predict(
-            batch, action_dim=gt_actions.shape[-1], action_horizon=gt_actions.shape[1], return_tokens=True
+        if self.gen_stats_fn is not None:
+            # Detokenize and reduce on device, leaving only scalars to transfer
+            return self.gen_stats_fn(tokens, target_tokens, target_mask, gt_actions)
+
+        tokens = jax.device_get(tokens)
+        predicted_actions, actions_mask = self.sequence_builder.batch_get_actions(
+            tokens,
+            self.language_tokenizer,
+            self.action_tokenizer,
+            boa_is_prompt=True,
+            action_dim=gt_actions.shape[-1],
+            action_horizon=gt_actions.shape[1],
         )
         predicted_actions = np.nan_to_num(predicted_actions)
+        eval_sums = compute_gen_sums(
+            predicted_actions,
+            actions_mask,
+            gt_actions,
+            tokens,
+            target_tokens,
+            target_mask,
+        )
+        return eval_sums, predicted_actions
 
-        # Create a batch where the language conditioning is random
-        batch_random = batch.copy()
-        perm = jax.random.permutation(self.rng, batch["task"]["language_instruction"].shape[0])
-        random_language_instruction = batch["task"]["language_instruction"][perm]
-        batch_random["task"]["language_instruction"] = random_language_instruction
-        batch_random["task"]["pad_mask_dict"]["language_instruction"] = batch["task"]["pad_mask_dict"]["language_instruction"][perm]
-        
-        # Predicted actions with random language conditioning
-        predicted_actions_random, actions_mask_random, tokens_random = self.predict(batch_random, action_dim=gt_actions.shape[-1], action_horizon=gt_actions.shape[1], return_tokens=True)
-        predicted_actions_random = np.nan_to_num(predicted_actions_random)
-        
-        gen_valid_pct = actions_mask.mean()
-        gen_l2 = np.mean(np.square(predicted_actions - gt_actions) * actions_mask) / actions_mask.mean()
-        gen_l1 = np.mean(np.abs(predicted_actions - gt_actions) * actions_mask) / actions_mask.mean()
-        gen_acc = np.mean((tokens["predicted"] == tokens["target"]) * tokens["mask"]) / tokens["mask"].mean()
-        
-        gen_valid_pct_random = actions_mask_random.mean()
-        gen_l2_random = np.mean(np.square(predicted_actions_random - gt_actions) * actions_mask_random) / actions_mask_random.mean()
-        gen_l1_random = np.mean(np.abs(predicted_actions_random - gt_actions) * actions_mask_random) / actions_mask_random.mean()
-        gen_acc_random = np.mean((tokens_random["predicted"] == tokens_random["target"]) * tokens_random["mask"]) / tokens_random["mask"].mean()
-        
-        # Compare the two predicted actions 
-        diff_l2 = (gen_l2_random - gen_l2) / gen_l2_random
-        diff_l1 = (gen_l1_random - gen_l1) / gen_l1_random
-        diff_acc = (gen_acc - gen_acc_random) / gen_acc_random 
-        
-        return {"eval_info":{
-            "gen_valid_pct": gen_valid_pct,
-            "gen_l2": gen_l2,
-            "gen_l1": gen_l1,
-            "gen_acc": gen_acc,
-            "gen_valid_pct_random": gen_valid_pct_random,
-            "gen_l2_random": gen_l2_random,
-            "gen_l1_random": gen_l1_random,
-            "gen_acc_random": gen_acc_random,
-            "diff_l2": diff_l2,
-            "diff_l1": diff_l1,
-            "diff_acc": diff_acc,
-            },
+    def _shuffle_language(self, batch, rng):
+        """Returns a copy of the batch with language instructions permuted across examples."""
+        perm = jax.random.permutation(rng, batch["task"]["language_instruction"].shape[0])
+        task = batch["task"]
+        return batch | {
+            "task": task
+            | {
+                "language_instruction": task["language_instruction"][perm],
+                "pad_mask_dict": task["pad_mask_dict"]
+                | {
+                    "language_instruction": task["pad_mask_dict"][
+                        "language_instruction"
+                    ][perm]
+                },
+            }
+        }
+
+    def _build_eval_inputs(self, batch, rng):
+        # Build sequences with the true and with random language conditioning
+        sequences = jax.tree.map(
+            lambda *xs: np.concatenate(xs, axis=0),
+            *[
+                self.sequence_builder.build_sequence(
+                    b,
+                    self.language_tokenizer,
+                    self.action_tokenizer,
+                    boa_is_prompt=True,
+                    include_action_tokens=True,
+                )
+                for b in (batch, self._shuffle_language(batch, rng))
+            ],
+        )
+        inputs = {
+            "sensors": batch["observation"],
+            "sensors_mask": batch["observation"]["pad_mask_dict"],
+            "prompt": sequences["prompt"],
+            "gen": sequences["gen"],
+        }
+        return inputs, sequences
+
+    def _repeated_to_global_array(self, inputs, *, sensors_repeat: int):
+        """
+        Shards inputs whose text holds `sensors_repeat` groups of the local batch.
+
+        The model repeats the global sensors as `(n b)`, so each group is sharded
+        on its own before concatenating: sharding the local `[true; shuffled]`
+        text directly would interleave the groups of the hosts.
+        """
+        local_batch_size = jax.tree.leaves(inputs["sensors"])[0].shape[0]
+        if inputs["gen"]["tokens"].shape[0] != sensors_repeat * local_batch_size:
+            raise ValueError(
+                f"Each host's text batch must hold sensors_repeat={sensors_repeat} groups "
+                f"of its {local_batch_size} examples, got {inputs['gen']['tokens'].shape[0]}"
+            )
+        mesh = self.sharding.mesh
+        sensors = mesh.local_data_to_global_array(
+            {"sensors": inputs["sensors"], "sensors_mask": inputs["sensors_mask"]}
+        )
+        text = {"prompt": inputs["prompt"], "gen": inputs["gen"]}
+        groups = [
+            mesh.local_data_to_global_array(
+                jax.tree.map(lambda x: np.split(x, sensors_repeat)[i], text)
+            )
+            for i in range(sensors_repeat)
+        ]
+        return sensors | jax.tree.map(lambda *xs: jnp.concatenate(xs), *groups)
+
+    def eval_step(self, batch, *, teacher_forced: bool = False, rng: jax.Array = None):
+        """
+        Evaluates the model with the true and with shuffled language instructions.
+
+        Both conditions are run as a single doubled batch, so the images are
+        only encoded once. With `teacher_forced=True`, only token accuracy and
+        loss under teacher forcing are computed, skipping autoregressive
+        decoding entirely. `rng` permutes the instructions (default: the
+        model's current rng).
+        """
+        gt_actions = batch["action"][:, -1, :, :]
+        inputs, sequences = self._build_eval_inputs(batch, self.rng if rng is None else rng)
+
+        if teacher_forced:
+            inputs = self._repeated_to_global_array(inputs, sensors_repeat=2)
+            with self.sharding.mesh.mesh, nn.logical_axis_rules([("act_batch", "fsdp")]):
+                info = jax.device_get(self.eval_fn(self.train_state, inputs))
+            eval_info = {f"tf_{k}": v[0] for k, v in info.items()} | {
+                f"tf_{k}_random": v[1] for k, v in info.items()
+            }
+            eval_info["diff_acc"] = (eval_info["tf_accuracy"] - eval_info["tf_accuracy_random"]) / eval_info["tf_accuracy_random"]
+            return {"eval_info": eval_info, "eval_data": {"gt_actions": gt_actions}}
+
+        eval_sums, eval_sums_random, predicted_actions = self._decode_and_eval(
+            inputs, sequences, gt_actions
+        )
+        eval_info = finalize_gen_stats(jax.device_get(eval_sums)) | finalize_gen_stats(
+            jax.device_get(eval_sums_random), suffix="_random"
+        )
+
+        return {"eval_info": add_diff_stats(eval_info),
             "eval_data":{
             "pred_actions": predicted_actions,
             "gt_actions": gt_actions,}}
 
-    def predict(
+    def eval_sums(self, batch, *, rng: jax.Array = None):
+        """
+        Like `eval_step`, but returns on-device metric sums for the true and the
+        shuffled language instructions (see `compute_gen_sums`) so they can be
+        accumulated over many batches before transferring.
+        """
+        gt_actions = batch["action"][:, -1, :, :]
+        inputs, sequences = self._build_eval_inputs(batch, self.rng if rng is None else rng)
+        return self._decode_and_eval(inputs, sequences, gt_actions)
+
+    def _decode_and_eval(self, inputs, sequences, gt_actions):
+        batch_size = gt_actions.shape[0]
+        tokens = self._decode_sequences(inputs, sensors_repeat=2)
+        split = lambda x: (x[:batch_size], x[batch_size:])
+        tokens, tokens_random = split(tokens)
+        sequences, sequences_random = (
+            jax.tree.map(lambda x: split(x)[i], sequences) for i in range(2)
+        )
+
+        # Predicted actions with language conditioning
+        eval_sums, predicted_actions = self._gen_eval(tokens, sequences, gt_actions)
+
+        # Predicted actions with random language conditioning
+        eval_sums_random, _ = self._gen_eval(tokens_random, sequences_random, gt_actions)
+
+        return eval_sums, eval_sums_random, predicted_actions
+
+    def _decode_sequences(
+        self,
+        inputs,
+        *,
+        use_ema_params: bool = False,
+        sampler: str = "greedy",
+        temperature: float = None,
+        sensors_repeat: int = 1,
+        beam_size: int = 4,
+        rng: jax.Array = None,
+    ):
+        with self.sharding.mesh.mesh, nn.logical_axis_rules([("act_batch", "fsdp")]):
+            from palivla.predict_fns import _beam_search, _decode
+            params = self.train_state.get_params(use_ema_params=use_ema_params)
+            decode_kwargs = dict(
+                model=self.train_state.model,
+                mesh=self.sharding.mesh.mesh,
+                out_sharding=PartitionSpec("fsdp"),
+                max_decode_len=inputs["gen"]["tokens"].shape[1],
+                eos_token=self.language_tokenizer.eos_token_id,
+                sensors_repeat=sensors_repeat,
+            )
+            if sampler == "beam":
+                tokens, _ = _beam_search(params, inputs, beam_size=beam_size, **decode_kwargs)
+            else:
+                tokens = _decode(
+                    params,
+                    inputs,
+                    temperature=temperature,
+                    sampler=sampler,
+                    rng=rng,
+                    **decode_kwargs,
+                )
+            return jax.lax.stop_gradient(tokens)
+
+    def predict_tokens(
         self,
         batch,
-        action_dim: int,
-        action_horizon: int,
         *,
         use_ema_params: bool = False,
-        return_tokens: bool = False,
         include_action_tokens: bool = True,
-        sampler: str = "greedy", 
+        sampler: str = "greedy",
         temperature: float = None,
+        beam_size: int = 4,
+        rng: jax.Array = None,
+        image_cache=None,
+        frame_ids=None,
+    ):
+        """
+        Decodes action tokens, leaving them on device. Returns the tokens and the built sequences. `sampler`
+        is "greedy", "temperature", "nucleus(p)" or "beam" (beam search with `beam_size` beams). Stochastic
+        samplers draw from `rng`, so the same key reproduces the same samples. With an `ImageEmbeddingCache`
+        and the `frame_ids` of the observation's images (see `ImageEmbeddingCache.embed_observation`), frames
+        encoded by earlier calls are not encoded again.
+        """
+        inputs, sequences = self._build_predict_inputs(
+            batch, include_action_tokens, image_cache=image_cache, frame_ids=frame_ids
+        )
+        tokens = self._decode_sequences(
+            inputs,
+            use_ema_params=use_ema_params,
+            sampler=sampler,
+            temperature=temperature,
+            beam_size=beam_size,
+            rng=rng,
+        )
+        return tokens, sequences
+
+    def sample_candidates(
+        self,
+        batch,
+        num_samples: int,
+        *,
+        use_ema_params: bool = False,
+        include_action_tokens: bool = True,
+        sampler: str = "temperature",
+        temperature: float = 1.0,
+        rng: jax.Array = None,
+    ):
+        """
+        Samples `num_samples` token sequences per example, e.g. candidate action chunks to rerank with a critic.
+        The prompt's KV cache is shared by all samples of an example. Returns the tokens and their log-probs,
+        both [batch, num_samples, gen_length] and on device, and the built sequences.
+        """
+        inputs, sequences = self._build_predict_inputs(batch, include_action_tokens)
+        with self.sharding.mesh.mesh, nn.logical_axis_rules([("act_batch", "fsdp")]):
+            from palivla.predict_fns import _sample
+            tokens, logp = _sample(
+                self.train_state.get_params(use_ema_params=use_ema_params),
+                inputs,
+                model=self.train_state.model,
+                mesh=self.sharding.mesh.mesh,
+                out_sharding=PartitionSpec("fsdp"),
+                max_decode_len=inputs["gen"]["tokens"].shape[1],
+                eos_token=self.language_tokenizer.eos_token_id,
+                num_samples=num_samples,
+                sampler=sampler,
+                temperature=temperature,
+                rng=rng,
+            )
+        return tokens, logp, sequences
+
+    def _build_predict_inputs(
+        self, batch, include_action_tokens: bool, *, image_cache=None, frame_ids=None
     ):
+        if image_cache is not None and frame_ids is not None:
+            # Frames seen by earlier calls are looked up instead of encoded again
+            batch = batch | {
+                "observation": image_cache.embed_observation(batch["observation"], frame_ids)
+            }
+
         # Tokenize the batch and build sequences
         sequences = self.sequence_builder.build_sequence(
             batch,
@@ -280,42 +632,54 @@ class ModelComponents:
             "prompt": sequences["prompt"],
             "gen": sequences["gen"],
         }
-        
-        # Run the train step
-        with self.sharding.mesh.mesh, nn.logical_axis_rules([("act_batch", "fsdp")]):
-            from palivla.predict_fns import _decode
-            params = self.train_state.get_params(use_ema_params=use_ema_params)
-            tokens = _decode(
-                params,
-                inputs,
-                model=self.train_state.model,
-                mesh=self.sharding.mesh.mesh,
-                out_sharding=PartitionSpec("fsdp"),
-                temperature=temperature,
-                sampler=sampler,
-                max_decode_len=sequences["gen"]["tokens"].shape[1],
-                eos_token=self.language_tokenizer.eos_token_id,
-            )
-            tokens = jax.lax.stop_gradient(tokens)
-
-            actions, actions_mask = self.sequence_builder.batch_get_actions(
-                tokens,
-                self.language_tokenizer,
-                self.action_tokenizer,
-                boa_is_prompt=True,
-                action_dim=action_dim,
-                action_horizon=action_horizon,
-            )
+        return inputs, sequences
 
-            if return_tokens:
-                return (
-                    actions,
-                    actions_mask,
-                    {
-                        "predicted": tokens,
-                        "target": sequences["gen"]["tokens"],
-                        "mask": sequences["gen"]["mask"],
-                    },
-                )
-            else:
-                return actions, actions_mask
\ No newline at end of file
+    def predict(
+        self,
+        batch,
+        action_dim: int,
+        action_horizon: int,
+        *,
+        use_ema_params: bool = False,
+        return_tokens: bool = False,
+        include_action_tokens: bool = True,
+        sampler: str = "greedy", 
+        temperature: float = None,
+        beam_size: int = 4,
+        rng: jax.Array = None,
+        image_cache=None,
+        frame_ids=None,
+    ):
+        tokens, sequences = self.predict_tokens(
+            batch,
+            use_ema_params=use_ema_params,
+            include_action_tokens=include_action_tokens,
+            sampler=sampler,
+            temperature=temperature,
+            beam_size=beam_size,
+            rng=rng,
+            image_cache=image_cache,
+            frame_ids=frame_ids,
+        )
+
+        actions, actions_mask = self.sequence_builder.batch_get_actions(
+            jax.device_get(tokens),
+            self.language_tokenizer,
+            self.action_tokenizer,
+            boa_is_prompt=True,
+            action_dim=action_dim,
+            action_horizon=action_horizon,
+        )
+
+        if return_tokens:
+            return (
+                actions,
+                actions_mask,
+                {
+                    "predicted": tokens,
+                    "target": sequences["gen"]["tokens"],
+                    "mask": sequences["gen"]["mask"],
+                },
+            )
+        else:
+            return actions, actions_mask
@@ -1,6 +1,10 @@
+import bisect
+from collections import OrderedDict, defaultdict
 from functools import partial
 import json
-from typing import Callable, Mapping, Optional, Sequence, Tuple, Union
+import threading
+import time
+from typing import Callable, Dict, Mapping, Optional, Sequence, Tuple, Union
 
 from absl import logging
 import dlimp as dl
@@ -8,7 +12,7 @@ import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
 
-from octo.data import obs_transforms, traj_transforms
+from octo.data import obs_transforms
 from octo.data.utils import goal_relabeling, task_augmentation
 from octo.data.utils.data_utils import (
     allocate_threads,
@@ -20,6 +24,243 @@ from octo.data.utils.data_utils import (
     tree_map,
 )
 from octo.utils.spec import ModuleSpec
+from palivla.octo import traj_transforms
+
+
+class PipelineMonitor:
+    """Counts the frames passing each stage of each dataset in `make_interleaved_dataset`, and periodically
+    logs per-dataset, per-stage throughput (frames/sec) and buffer occupancy.
+
+    Stages, in pipeline order:
+
+    - "read": trajectories out of `make_dataset_from_rlds` (RLDS read, restructure, normalization).
+    - "traj_transforms": trajectories out of `apply_trajectory_transforms`.
+    - "flatten": frames out of `flatten`.
+    - "shuffle": frames out of the interleave + shuffle, attributed by their "dataset_name".
+    - "frame_transforms": frames out of `apply_frame_transforms`.
+
+    Trajectory stages count the frames of each trajectory, so all rates are in frames/sec. The occupancy of
+    a frame-level stage is the number of frames produced by the previous stage that it has not emitted yet,
+    i.e. the frames sitting in its (and the interleave/shuffle) buffers. It is not reported for the
+    trajectory stages, where filtered out trajectories would count as buffered forever.
+    """
+
+    STAGES = ("read", "traj_transforms", "flatten", "shuffle", "frame_transforms")
+
+    def __init__(self, dataset_names: Sequence[str], report_interval: float = 60.0):
+        self.dataset_names = list(dataset_names)
+        self.report_interval = report_interval
+        self._counts = {
+            (name, stage): 0 for name in self.dataset_names for stage in self.STAGES
+        }
+        self._lock = threading.Lock()
+        self._last_report = (time.monotonic(), dict(self._counts))
+        self._thread = None
+
+    def tap(self, dataset: dl.DLataset, stage: str, name: Optional[str] = None) -> dl.DLataset:
+        """Counts the elements of `dataset` under `stage`. Trajectory-level datasets must pass their `name`;
+        frame-level datasets are attributed by their "dataset_name" key."""
+
+        def count(x):
+            if name is None:
+                dataset_name, num_frames = x["dataset_name"], 1
+            else:
+                dataset_name, num_frames = name, tf.shape(x["action"])[0]
+            return tf.numpy_function(
+                partial(self._record, stage),
+                [dataset_name, num_frames],
+                tf.bool,
+                stateful=True,
+            )
+
+        return dataset.filter(count)
+
+    def _record(self, stage: str, dataset_name, num_frames) -> bool:
+        if isinstance(dataset_name, bytes):
+            dataset_name = dataset_name.decode()
+        with self._lock:
+            self._counts[dataset_name, stage] += int(num_frames)
+            if self._thread is None:
+                self._last_report = (time.monotonic(), dict(self._counts))
+                self._thread = threading.Thread(target=self._report_loop, daemon=True)
+                self._thread.start()
+        return True
+
+    def _report_loop(self):
+        while True:
+            time.sleep(self.report_interval)
+            self.report()
+
+    def report(self) -> Dict[str, Dict[str, dict]]:
+        """Logs and returns {dataset: {stage: {"frames_per_sec", "buffered"}}} since the last report."""
+        now = time.monotonic()
+        with self._lock:
+            counts = dict(self._counts)
+            (last_time, last_counts), self._last_report = self._last_report, (now, counts)
+        elapsed = max(now - last_time, 1e-9)
+
+        stats = {}
+        for name in self.dataset_names:
+            stats[name] = {}
+            for i, stage in enumerate(self.STAGES):
+                rate = (counts[name, stage] - last_counts[name, stage]) / elapsed
+                buffered = None
+                if i >= self.STAGES.index("flatten"):
+                    buffered = counts[name, self.STAGES[i - 1]] - counts[name, stage]
+                stats[name][stage] = {"frames_per_sec": rate, "buffered": buffered}
+
+        lines = [f"{'dataset':<40}" + "".join(f"{stage:>24}" for stage in self.STAGES)]
+        for name, stages in stats.items():
+            cells = []
+            for stage in self.STAGES:
+                cell = f"{stages[stage]['frames_per_sec']:.1f}/s"
+                if stages[stage]["buffered"] is not None:
+                    cell += f" ({stages[stage]['buffered']} buf)"
+                cells.append(f"{cell:>24}")
+            lines.append(f"{name[:40]:<40}" + "".join(cells))
+        logging.info("Data pipeline throughput:\n%s", "\n".join(lines))
+        return stats
+
+
+class ImageStore:
+    """Holds the encoded images of the trajectories in flight exactly once, so that the trajectories (and
+    the frame shuffle buffer) only carry int64 ids in place of the "image_*"/"depth_*" observations.
+
+    Chunking observations into windows and adding "next_observation" otherwise copy every encoded image
+    2 * window_size times, and all copies sit in the shuffle buffer until the frame is decoded. Here, each
+    image is reference counted: `register` stores a trajectory's images, `retain` counts the references
+    left after all trajectory transforms (and frees unreferenced images, e.g. of subsampled frames), and
+    `resolve` swaps a shuffled frame's ids back for the encoded bytes, releasing them.
+
+    Id 0 always resolves to the empty (padding) image, so that numeric padding of the ids (e.g. by task
+    augmentation) keeps working. A trajectory's images are never freed before it reaches `retain`, so the
+    transforms between `register` and `retain` must not drop trajectories: their images would stay in the
+    store. A warning is logged if more than `warn_pending` trajectories of a dataset are pending.
+
+    The store lives as long as the dataset, not its iterators: the images of frames still buffered (e.g. in
+    the shuffle buffer) by an iterator that is dropped or recreated are not released. Call `clear` once no
+    iterator of the dataset is left, or build a new dataset (and store) per iterator.
+    """
+
+    def __init__(self, warn_pending: int = 1000):
+        self.warn_pending = warn_pending
+        self._images = {}
+        self._refs = {}
+        self._pending = defaultdict(OrderedDict)  # dataset name -> {first id: end id}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _image_keys(obs: dict) -> list:
+        return [k for k in obs if k.startswith(("image_", "depth_"))]
+
+    def register(self, traj: dict) -> dict:
+        """Replaces the encoded images of `traj["observation"]` by ids."""
+        keys = self._image_keys(traj["observation"])
+        if not keys:
+            return traj
+        images = tf.stack([traj["observation"][k] for k in keys])  # [num_keys, traj_len]
+        ids = tf.numpy_function(
+            self._put, [traj["dataset_name"][0], images], tf.int64, stateful=True
+        )
+        ids.set_shape(images.shape)
+        for i, k in enumerate(keys):
+            traj["observation"][k] = ids[i]
+        return traj
+
+    def retain(self, traj: dict) -> dict:
+        """Counts the references to the images of `traj` after all trajectory transforms."""
+        ids = [
+            tf.reshape(d[k], [-1])
+            for d in (traj["observation"], traj["task"], traj.get("next_observation", {}))
+            for k in self._image_keys(d)
+            if d[k].dtype == tf.int64
+        ]
+        if not ids:
+            return traj
+        retained = tf.numpy_function(
+            self._retain, [traj["dataset_name"][0], tf.concat(ids, 0)], tf.bool, stateful=True
+        )
+        with tf.control_dependencies([retained]):
+            traj["action"] = tf.identity(traj["action"])
+        return traj
+
+    def resolve(self, frame: dict) -> dict:
+        """Replaces the image ids of a (flattened) frame by the encoded images."""
+        for key in ("observation", "task", "next_observation"):
+            if key not in frame:
+                continue
+            for k in self._image_keys(frame[key]):
+                ids = frame[key][k]
+                if ids.dtype != tf.int64:
+                    continue
+                images = tf.numpy_function(self._take, [ids], tf.string, stateful=True)
+                images.set_shape(ids.shape)
+                frame[key][k] = images
+        return frame
+
+    def num_bytes(self) -> int:
+        with self._lock:
+            return sum(len(image) for image in self._images.values())
+
+    def clear(self):
+        """Frees all images, e.g. after dropping an iterator. Frames still in flight fail to resolve."""
+        with self._lock:
+            self._images.clear()
+            self._refs.clear()
+            self._pending.clear()
+
+    def _put(self, dataset_name, images: np.ndarray) -> np.ndarray:
+        with self._lock:
+            start = self._next_id
+            self._next_id += images.size
+            ids = np.arange(start, self._next_id, dtype=np.int64)
+            self._images.update(zip(ids.tolist(), images.flat))
+            pending = self._pending[dataset_name]
+            pending[start] = self._next_id
+            if len(pending) == self.warn_pending + 1:
+                logging.warning(
+                    "%d trajectories of %s are registered in the image store but not retained yet, "
+                    "are trajectories dropped between register and retain?",
+                    len(pending),
+                    dataset_name.decode() if isinstance(dataset_name, bytes) else dataset_name,
+                )
+        return ids.reshape(images.shape)
+
+    def _retain(self, dataset_name, ids: np.ndarray) -> bool:
+        ids = ids[ids > 0]
+        if not ids.size:
+            return True
+        with self._lock:
+            pending = self._pending[dataset_name]
+            starts = list(pending)
+            i = bisect.bisect_right(starts, ids.min()) - 1
+            if i < 0 or pending[starts[i]] <= ids.min():
+                raise ValueError("Retaining a trajectory which is not registered in the image store")
+            start, end = starts[i], pending.pop(starts[i])
+            for id_, count in zip(*np.unique(ids, return_counts=True)):
+                self._refs[int(id_)] = int(count)
+            self._free_unreferenced(start, end)
+        return True
+
+    def _free_unreferenced(self, start: int, end: int):
+        for id_ in range(start, end):
+            if id_ not in self._refs:
+                self._images.pop(id_, None)
+
+    def _take(self, ids: np.ndarray) -> np.ndarray:
+        images = np.empty(ids.shape, dtype=object)
+        with self._lock:
+            for index, id_ in np.ndenumerate(ids):
+                id_ = int(id_)
+                if id_ == 0:
+                    images[index] = b""
+                    continue
+                images[index] = self._images[id_]
+                self._refs[id_] -= 1
+                if self._refs[id_] == 0:
+                    del self._refs[id_], self._images[id_]
+        return images
 
 
 def apply_trajectory_transforms(
@@ -40,6 +281,7 @@ def apply_trajectory_transforms(
     max_proprio_dim: Optional[int] = None,
     post_chunk_transforms: Sequence[ModuleSpec] = (),
     num_parallel_calls: int = tf.data.AUTOTUNE,
+    image_store: Optional[ImageStore] = None,
 ) -> dl.DLataset:
     """Applies common transforms that happen at a trajectory level. Such transforms are usually some sort of
     "relabeling" (e.g. filtering, chunking, adding goals, dropping keys). Transforms that happen in this
@@ -76,6 +318,8 @@ def apply_trajectory_transforms(
         post_chunk_transforms (Sequence[ModuleSpec]): ModuleSpecs of trajectory transforms applied after
             chunking.
         num_parallel_calls (int, optional): number of parallel calls for map operations. Default to AUTOTUNE.
+        image_store (ImageStore, optional): If provided, the encoded images are moved into the store and
+            replaced by ids, which `image_store.resolve` turns back into images at the frame level.
     """
     if skip_unlabeled:
         if "language_instruction" not in dataset.element_spec["task"]:
@@ -101,6 +345,10 @@ def apply_trajectory_transforms(
     # marks which entires of the observation and task dicts are padding
     dataset = dataset.traj_map(traj_transforms.add_pad_mask_dict, num_parallel_calls)
 
+    # from here on, images are only referenced by id
+    if image_store is not None:
+        dataset = dataset.traj_map(image_store.register, num_parallel_calls)
+
     # optionally pads actions and proprio to a consistent number of dimensions
     dataset = dataset.traj_map(
         partial(
@@ -167,6 +415,9 @@ def apply_trajectory_transforms(
 
     dataset = dataset.traj_map(add_next_act_obs, num_parallel_calls)
 
+    if image_store is not None:
+        dataset = dataset.traj_map(image_store.retain, num_parallel_calls)
+
     return dataset
 
 
@@ -551,6 +802,11 @@ def make_interleaved_dataset(
     balance_weights: bool = False,
     traj_transform_threads: Optional[int] = None,
     traj_read_threads: Optional[int] = None,
+    instrument: bool = False,
+    instrument_interval: float = 60.0,
+    autotune_threads: bool = False,
+    autotune_frames: int = 1000,
+    shuffle_image_refs: bool = False,
 ) -> dl.DLataset:
     """Creates an interleaved dataset from list of dataset kwargs. Returns a dataset of batched frames.
 
@@ -573,7 +829,24 @@ def make_interleaved_dataset(
             datasets according to their sampling weights. If None, defaults to AUTOTUNE for every dataset.
         traj_read_threads: total number of parallel read workers for trajectory transforms, distributed across
             datasets according to their sampling weights. If None, defaults to AUTOTUNE for every dataset.
+        instrument: if True, counts the frames passing each stage of each dataset and periodically logs
+            per-dataset, per-stage frames/sec and buffer occupancy (see `PipelineMonitor`). The monitor is
+            available as `dataset.monitor`. Adds a small per-element overhead.
+        instrument_interval: seconds between two throughput reports when `instrument` is True.
+        autotune_threads: if True, first times `autotune_frames` frames of every dataset on its own, and
+            distributes `traj_transform_threads` and `traj_read_threads` according to sample weight times
+            measured cost per frame, rather than sample weight alone. Requires both thread budgets.
+        autotune_frames: number of frames per dataset timed when `autotune_threads` is True.
+        shuffle_image_refs: if True, the shuffle buffer holds int64 image ids instead of encoded images,
+            which live once in an `ImageStore` (available as `dataset.image_store`) until their frames are
+            shuffled out, instead of once per observation window and next observation that contains them.
+            The store is shared by all iterators of the dataset (see `ImageStore` on dropping iterators).
     """
+    if autotune_threads and (traj_transform_threads is None or traj_read_threads is None):
+        raise ValueError(
+            "autotune_threads requires traj_transform_threads and traj_read_threads to be set."
+        )
+
     # default to uniform sampling
     if not sample_weights:
         sample_weights = [1.0] * len(dataset_kwargs_list)
@@ -599,42 +872,93 @@ def make_interleaved_dataset(
     sample_weights = np.array(sample_weights) / np.sum(sample_weights)
     pprint_data_mixture(dataset_kwargs_list, sample_weights)
 
-    # allocate threads based on weights
-    threads_per_dataset = allocate_threads(traj_transform_threads, sample_weights)
-    reads_per_dataset = allocate_threads(traj_read_threads, sample_weights)
-
-    logging.info("Threads per dataset: %s", threads_per_dataset)
-    logging.info("Reads per dataset: %s", reads_per_dataset)
+    image_store = ImageStore() if shuffle_image_refs else None
+    monitor = None
+    if instrument:
+        monitor = PipelineMonitor(
+            [kwargs["name"] for kwargs in dataset_kwargs_list], instrument_interval
+        )
 
-    # construct datasets
-    datasets = []
-    for dataset_kwargs, threads, reads in zip(
-        dataset_kwargs_list,
-        threads_per_dataset,
-        reads_per_dataset,
-    ):
+    def make_frame_dataset(dataset_kwargs, threads, reads, monitor=None, image_store=None):
+        name = dataset_kwargs["name"]
         dataset, _ = make_dataset_from_rlds(
             **dataset_kwargs,
             train=train,
             num_parallel_calls=threads,
             num_parallel_reads=reads,
-            dataset_statistics=all_dataset_statistics[dataset_kwargs["name"]],
+            dataset_statistics=all_dataset_statistics[name],
         )
+        dataset = dataset.repeat()
+        if monitor is not None:
+            dataset = monitor.tap(dataset, "read", name)
         dataset = apply_trajectory_transforms(
-            dataset.repeat(),
+            dataset,
             **traj_transform_kwargs,
             num_parallel_calls=threads,
             train=train,
-        ).flatten(num_parallel_calls=threads)
-        datasets.append(dataset)
+            image_store=image_store,
+        )
+        if monitor is not None:
+            dataset = monitor.tap(dataset, "traj_transforms", name)
+        dataset = dataset.flatten(num_parallel_calls=threads)
+        if monitor is not None:
+            dataset = monitor.tap(dataset, "flatten")
+        return dataset
+
+    # allocate threads based on weights, and optionally the measured cost per frame of each dataset
+    thread_weights = sample_weights
+    if autotune_threads:
+        costs = np.array(
+            [
+                _measure_frame_cost(
+                    make_frame_dataset(dataset_kwargs, threads, reads),
+                    threads,
+                    autotune_frames,
+                )
+                for dataset_kwargs, threads, reads in zip(
+                    dataset_kwargs_list,
+                    allocate_threads(traj_transform_threads, sample_weights),
+                    allocate_threads(traj_read_threads, sample_weights),
+                )
+            ]
+        )
+        for dataset_kwargs, cost in zip(dataset_kwargs_list, costs):
+            logging.info(
+                "Measured %.2f thread-ms per frame for %s", cost * 1e3, dataset_kwargs["name"]
+            )
+        thread_weights = sample_weights * costs
+    threads_per_dataset = allocate_threads(traj_transform_threads, thread_weights)
+    reads_per_dataset = allocate_threads(traj_read_threads, thread_weights)
+
+    logging.info("Threads per dataset: %s", threads_per_dataset)
+    logging.info("Reads per dataset: %s", reads_per_dataset)
+
+    # construct datasets
+    datasets = [
+        make_frame_dataset(dataset_kwargs, threads, reads, monitor, image_store)
+        for dataset_kwargs, threads, reads in zip(
+            dataset_kwargs_list,
+            threads_per_dataset,
+            reads_per_dataset,
+        )
+    ]
 
     # interleave at the frame level and then shuffle
     dataset: dl.DLataset = dl.DLataset.sample_from_datasets(
         datasets, sample_weights
     ).shuffle(shuffle_buffer_size)
+    if monitor is not None:
+        dataset = monitor.tap(dataset, "shuffle")
+    if image_store is not None:
+        dataset = dataset.frame_map(
+            image_store.resolve,
+            frame_transform_kwargs.get("num_parallel_calls", tf.data.AUTOTUNE),
+        )
 
     # apply frame transforms
     dataset = apply_frame_transforms(dataset, **frame_transform_kwargs, train=train)
+    if monitor is not None:
+        dataset = monitor.tap(dataset, "frame_transforms")
 
     # sequential batch (parallel batch seems to use much more memory)
     if batch_size is not None:
@@ -648,4 +972,16 @@ def make_interleaved_dataset(
     # save for later
     dataset.dataset_statistics = all_dataset_statistics
     dataset.sample_weights = sample_weights
+    dataset.monitor = monitor
+    dataset.image_store = image_store
     return dataset
+
+
+def _measure_frame_cost(dataset: dl.DLataset, threads: int, num_frames: int) -> float:
+    """Thread-seconds spent per frame of `dataset` (wall time per frame times its thread budget), after
+    the first frame, which includes opening the files."""
+    iterator = dataset.take(num_frames + 1).as_numpy_iterator()
+    next(iterator)
+    start = time.perf_counter()
+    num_timed = sum(1 for _ in iterator)
+    return (time.perf_counter() - start) * threads / max(num_timed, 1)
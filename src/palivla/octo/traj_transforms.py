@@ -27,20 +27,27 @@ def chunk_act_obs(
     [traj_len, N, action_dim] instead of [traj_len, action_dim]. In this case, `N` must be larger than or
     equal to `action_horizon`, and only one axis will be added (the history axis). This is useful for
     custom chunking schemes where an action may differ depending on which observation it is paired with.
+
+    With `window_size == 1` (no history), the history axis is a reshape, so observations (including full
+    images) are not copied.
     """
     traj_len = tf.shape(traj["action"])[0]
 
-    # chunk observations into histories
-    history_indices = tf.range(traj_len)[:, None] + tf.range(
-        -window_size + 1, 1
-    )  # [traj_len, window_size]
-    # indicates which observations at the beginning of the trajectory are padding
-    timestep_pad_mask = history_indices >= 0
-    # repeat the first observation at the beginning of the trajectory rather than going out of bounds
-    history_indices = tf.maximum(history_indices, 0)
-    # gather
+    if window_size == 1:
+        add_history = lambda x: x[:, None]
+        timestep_pad_mask = tf.ones([traj_len, 1], dtype=tf.bool)
+    else:
+        # chunk observations into histories
+        history_indices = tf.range(traj_len)[:, None] + tf.range(
+            -window_size + 1, 1
+        )  # [traj_len, window_size]
+        # indicates which observations at the beginning of the trajectory are padding
+        timestep_pad_mask = history_indices >= 0
+        # repeat the first observation at the beginning of the trajectory rather than going out of bounds
+        history_indices = tf.maximum(history_indices, 0)
+        add_history = lambda x: tf.gather(x, history_indices)
     traj["observation"] = tf.nest.map_structure(
-        lambda x: tf.gather(x, history_indices), traj["observation"]
+        add_history, traj["observation"]
     )  # [traj_len, window_size, ...]
     traj["observation"]["timestep_pad_mask"] = timestep_pad_mask
 
@@ -65,26 +72,21 @@ def chunk_act_obs(
         traj["action"] = traj["action"][:, :action_horizon]
 
     # then, add the history axis to actions
-    traj["action"] = tf.gather(
-        traj["action"], history_indices
+    traj["action"] = add_history(
+        traj["action"]
     )  # [traj_len, window_size, action_horizon, action_dim]
     # finally, we deal with marking which actions are past the goal timestep (or final timestep if no goal)
     if "timestep" in traj["task"]:
         goal_timestep = traj["task"]["timestep"]
     else:
         goal_timestep = tf.fill([traj_len], traj_len - 1)
-    # computes the number of timesteps away the goal is relative to a particular action
-    t, w, h = tf.meshgrid(
-        tf.range(traj_len),
-        tf.range(window_size),
-        tf.range(action_horizon),
-        indexing="ij",
-    )
-    relative_goal_timestep = goal_timestep[:, None, None] - (
-        t - (window_size + 1) + w + h
+    # the number of timesteps away the goal is relative to action `h` of history entry `w` at timestep `t`
+    # is `goal_timestep[t] - (t - (window_size + 1) + w + h)`, computed by broadcasting instead of a meshgrid
+    goal_offset = goal_timestep - tf.range(traj_len) + window_size + 1  # [traj_len]
+    chunk_offset = tf.range(window_size)[:, None] + tf.range(action_horizon)  # [window_size, action_horizon]
+    traj["observation"]["task_completed"] = (
+        goal_offset[:, None, None] <= chunk_offset
     )  # [traj_len, window_size, action_horizon]
-    traj["observation"]["task_completed"] = relative_goal_timestep <= 0
-    print("ACTION: ", traj["action"].shape)
     # broadcast "action_pad_mask" to the new chunked shape, and mark actions past the goal timestep as padding
     traj["action_pad_mask"] = tf.logical_and(
         # [traj_len, 1, 1, action_dim]
@@ -1,6 +1,8 @@
 import fnmatch
+from typing import Any, NamedTuple
 
 import jax
+import jax.numpy as jnp
 import optax
 
 from big_vision.utils import Registry
@@ -51,6 +53,129 @@ def ema_params(rate: float):
     )
 
 
+class QuantizedArray(NamedTuple):
+    """Int8 values with a per-row absmax scale."""
+
+    values: jax.Array
+    scale: jax.Array
+
+
+def _is_quantized(x):
+    return isinstance(x, QuantizedArray)
+
+
+def _store(x, dtype: str):
+    if dtype != "int8":
+        return x.astype(dtype)
+    axis = -1 if x.ndim > 0 else None
+    scale = jnp.max(jnp.abs(x), axis=axis, keepdims=True) / 127.0
+    scale = jnp.where(scale == 0, 1.0, scale)
+    return QuantizedArray(jnp.round(x / scale).astype(jnp.int8), scale)
+
+
+def _load(x):
+    if _is_quantized(x):
+        return x.values.astype(jnp.float32) * x.scale
+    return x.astype(jnp.float32)
+
+
+class ScaleByAdamLowPrecisionState(NamedTuple):
+    count: jax.Array
+    mu: Any
+    nu: Any
+
+
+def scale_by_adam_low_precision(
+    b1: float = 0.9,
+    b2: float = 0.999,
+    eps: float = 1e-8,
+    moment_dtype: str = "bfloat16",
+):
+    """
+    Like `optax.scale_by_adam`, but stores both moments in `moment_dtype`
+    ("bfloat16", "float16" or "int8"). Updates are computed in float32.
+
+    For int8, the second moment is stored as its square root to make better use
+    of the quantization range.
+    """
+
+    def init_fn(params):
+        zeros = lambda p: _store(jnp.zeros_like(p, dtype=jnp.float32), moment_dtype)
+        return ScaleByAdamLowPrecisionState(
+            count=jnp.zeros([], jnp.int32),
+            mu=jax.tree.map(zeros, params),
+            nu=jax.tree.map(zeros, params),
+        )
+
+    def update_fn(updates, state, params=None):
+        del params
+        count = optax.safe_int32_increment(state.count)
+        # Keep the representation's own storage (sqrt for int8) consistent
+        load_nu = (lambda x: jnp.square(_load(x))) if moment_dtype == "int8" else _load
+        store_nu = (
+            (lambda x: _store(jnp.sqrt(x), moment_dtype))
+            if moment_dtype == "int8"
+            else (lambda x: _store(x, moment_dtype))
+        )
+
+        def _update(g, mu, nu):
+            g = g.astype(jnp.float32)
+            mu = b1 * _load(mu) + (1 - b1) * g
+            nu = b2 * load_nu(nu) + (1 - b2) * jnp.square(g)
+            mu_hat = mu / (1 - b1 ** count.astype(jnp.float32))
+            nu_hat = nu / (1 - b2 ** count.astype(jnp.float32))
+            update = mu_hat / (jnp.sqrt(nu_hat) + eps)
+            return update, _store(mu, moment_dtype), store_nu(nu)
+
+        out = jax.tree.map(_update, updates, state.mu, state.nu, is_leaf=_is_quantized)
+        is_out = lambda x: type(x) is tuple
+        updates = jax.tree.map(lambda x: x[0], out, is_leaf=is_out)
+        mu = jax.tree.map(lambda x: x[1], out, is_leaf=is_out)
+        nu = jax.tree.map(lambda x: x[2], out, is_leaf=is_out)
+        return updates, ScaleByAdamLowPrecisionState(count=count, mu=mu, nu=nu)
+
+    return optax.GradientTransformation(init_fn, update_fn)
+
+
+class MasterWeightsState(NamedTuple):
+    master_params: Any
+    inner_state: Any
+
+
+def with_master_weights(inner: optax.GradientTransformation, dtype=jnp.float32):
+    """
+    Keeps a full-precision copy of the (low-precision) params in the optimizer
+    state. Gradients are upcast, `inner` runs on the master copy, and the
+    emitted updates move the params onto the rounded master weights.
+    """
+
+    def init_fn(params):
+        master_params = jax.tree.map(lambda p: p.astype(dtype), params)
+        return MasterWeightsState(master_params, inner.init(master_params))
+
+    def update_fn(updates, state, params=None):
+        updates = jax.tree.map(lambda u: u.astype(dtype), updates)
+        updates, inner_state = inner.update(
+            updates, state.inner_state, state.master_params
+        )
+        master_params = optax.apply_updates(state.master_params, updates)
+        # `optax.apply_updates` adds in float32 and casts back to the param
+        # dtype, so the params end up exactly at the rounded master weights.
+        updates = jax.tree.map(
+            lambda m, p: m - p.astype(dtype), master_params, params
+        )
+        return updates, MasterWeightsState(master_params, inner_state)
+
+    return optax.GradientTransformation(init_fn, update_fn)
+
+
+def get_loss_scale(optimizer_spec) -> float | None:
+    """Static loss scale from the optimizer spec, applied by `step_fn`."""
+    if optimizer_spec is None:
+        return None
+    return optimizer_spec.config.get("loss_scale", None)
+
+
 @Registry.register("optimizer.default_optimizer")
 def make_optimizer(
     optimizer: str,
@@ -60,25 +185,51 @@ def make_optimizer(
     embed_optimizer_kwargs: dict = {},
     llm_optimizer_kwargs: dict = {},
     ema_rate: float | None = None,
+    master_weights_dtype: str | None = None,
+    moment_dtype: str | None = None,
+    loss_scale: float | None = None,
 ):
+    """
+    Mixed precision options:
+      master_weights_dtype: keep a copy of the params in this dtype (e.g.
+        "float32") in the optimizer state, for models with bfloat16 params
+        (see `param_dtype` in the model config).
+      moment_dtype: storage dtype of the Adam moments ("bfloat16", "float16"
+        or "int8"). Defaults to the param dtype.
+      loss_scale: static loss scale. Only read by `step_fn`, which scales the
+        loss and unscales the gradients before they reach the optimizer.
+    """
+    del loss_scale
+
     @optax.inject_hyperparams
     def _make_optimizer(llm_learning_rate, img_learning_rate, embed_learning_rate):
         def _make_opt(
             lr, weight_decay=1e-4, grad_norm_clip=1.0, b1=0.9, b2=0.999, **kwargs
         ):
-            if optimizer == "adamw":
-                return optax.chain(
+            if optimizer == "adamw" and moment_dtype is not None:
+                opt = optax.chain(
+                    optax.clip_by_global_norm(grad_norm_clip),
+                    scale_by_adam_low_precision(b1=b1, b2=b2, moment_dtype=moment_dtype),
+                    optax.add_decayed_weights(weight_decay),
+                    optax.scale_by_learning_rate(lr),
+                )
+            elif optimizer == "adamw":
+                opt = optax.chain(
                     optax.clip_by_global_norm(grad_norm_clip),
                     optax.adamw(lr, weight_decay=weight_decay, b1=b1, b2=b2),
                 )
             elif optimizer == "sgd":
-                return optax.chain(
+                opt = optax.chain(
                     optax.clip_by_global_norm(grad_norm_clip),
                     optax.sgd(lr),
                 )
             else:
                 raise ValueError(f"Unknown optimizer: {optimizer}")
 
+            if master_weights_dtype is not None:
+                opt = with_master_weights(opt, dtype=master_weights_dtype)
+            return opt
+
         img_optimizer = _make_opt(
             img_learning_rate,
             **img_optimizer_kwargs,
@@ -19,9 +19,11 @@ Modified from PaliGemma in big_vision: https://github.com/google-research/big_vi
 """
 
 import collections
+from collections.abc import Mapping
 import functools
 
 import einops
+import flax
 import jax
 import jax.experimental
 import jax.experimental.multihost_utils
@@ -29,6 +31,8 @@ import jax.numpy as jnp
 import numpy as np
 
 import big_vision.utils as u
+from big_vision.models import decoding
+from big_vision.models.proj.paligemma.gemma_bv import share_prefix_cache
 from big_vision.pp import registry
 from palivla.components.model import PaliVLAModel
 from palivla.palivla_typing import Data, Params, Variables
@@ -45,7 +49,9 @@ def get_all(model):
         "image_avg_repr": _image_avg_repr,
         "decode": _decode,
         "decode_with_logp": _decode_with_logp,
+        "sample": _sample,
         "beam_decode": _beam_decode,
+        "beam_search": _beam_search,
     }
     return {name: functools.partial(fn, model=model) for name, fn in fns.items()}
 
@@ -91,21 +97,41 @@ def _decode_with_logp(
     sampler: str = "greedy",
     temperature: float = None,
     eos_look_behind: int = 0,
+    sensors_repeat: int = 1,
+    select_best: bool = True,
+    rng: jax.Array = None,
 ):
-    """Sample token continuations to the input sequences."""
+    """Sample token continuations to the input sequences.
+
+    `sampler` is e.g. "greedy", "temperature" or "nucleus(0.9)". Stochastic
+    samplers draw from `rng` (default: `PRNGKey(0)`), split once per step.
+
+    With `sensors_repeat > 1` the prompt batch is `sensors_repeat` times the
+    sensor batch, and each image is encoded once for all of its prompts.
+
+    With `best_of_n > 1`, `best_of_n` continuations are sampled per prompt. The
+    prompt's KV cache is stored once and shared by them (see
+    `share_prefix_cache`), only the decoded tokens are cached per sample. The
+    most likely sample is returned, or all of them as [B, best_of_n, L] with
+    `select_best=False` (e.g. to rerank candidate actions with a critic).
+    """
     replicate_sharding = jax.sharding.NamedSharding(mesh, P())
     out_sharding = jax.sharding.NamedSharding(mesh, out_sharding)
+    if rng is None:
+        rng = jax.random.PRNGKey(0)
 
-    # Prefill the model cache and generate logits for first token.
+    # Prefill the model cache and generate logits for first token. Samples
+    # sharing the prompt get their own cache for the decoded tokens below.
     logits, cache = jax.jit(
         _prefill_cache,
         out_shardings=out_sharding,
-        static_argnames=("model", "max_decode_len"),
+        static_argnames=("model", "max_decode_len", "sensors_repeat"),
     )(
         params,
         data,
         model=model,
-        max_decode_len=max_decode_len,
+        max_decode_len=max_decode_len if best_of_n == 1 else 0,
+        sensors_repeat=sensors_repeat,
     )
     logits, cache = jax.block_until_ready((logits, cache))
     # Mask indicating real examples. False if example is used to pad the batch.
@@ -115,23 +141,19 @@ def _decode_with_logp(
         mask = jnp.ones_like(data["prompt"]["tokens"][:, 0], dtype=jnp.bool_)
 
     # Repeat example in case we are picking the best of n.
-    logits, cache, mask = jax.jit(_bon_repeat, static_argnames=("n",))(
-        (logits, cache, mask), n=best_of_n
-    )
-    if sampler == "greedy":
-        decode_sample_output = jax.jit(
-            _decode_sample_output,
-            static_argnames=("max_decode_len", "sampler"),
-        )
-    elif sampler == "temperature":
-        decode_sample_output = jax.jit(
-            _decode_sample_output,
-            static_argnames=("max_decode_len", "sampler", "temperature"),
-        )
-    else:
-        raise NotImplementedError(
-            f"Sampler {sampler} not implemented. Use 'greedy' or 'temperature'."
+    if best_of_n > 1:
+        logits, mask = jax.jit(_bon_repeat, static_argnames=("n",))(
+            (logits, mask), n=best_of_n
         )
+        cache = jax.jit(
+            share_prefix_cache,
+            static_argnames=("n", "suffix_len"),
+            donate_argnums=0,
+        )(cache, n=best_of_n, suffix_len=max_decode_len)
+    decode_sample_output = jax.jit(
+        _decode_sample_output,
+        static_argnames=("max_decode_len", "sampler", "temperature"),
+    )
 
     decode_early_stop = jax.jit(
         _decode_early_stop,
@@ -149,8 +171,14 @@ def _decode_with_logp(
     # Setting `eos_look_behind>0` removes blocking transfer with small batches.
     stops = collections.deque(maxlen=1 + eos_look_behind)
     for idx in range(max_decode_len):
+        rng, step_rng = jax.random.split(rng)
         tokens, state = decode_sample_output(
-            state, logits, max_decode_len=max_decode_len, sampler=sampler, temperature=temperature
+            state,
+            logits,
+            step_rng,
+            max_decode_len=max_decode_len,
+            sampler=sampler,
+            temperature=temperature,
         )
 
         if idx + 1 >= max_decode_len:
@@ -164,6 +192,12 @@ def _decode_with_logp(
         logits, cache = extend_cache(params, cache, tokens, model=model)
         logits, cache = jax.block_until_ready((logits, cache))
 
+    if not select_best:
+        _, tokens, logp = jax.tree.map(
+            lambda x: einops.rearrange(x, "(b n) l -> b n l", n=best_of_n), state
+        )
+        return tokens, logp
+
     # Select the best of n sample for each example.
     _, tokens, logp = jax.jit(
         _bon_select,
@@ -179,6 +213,98 @@ def _decode(params, data, **kwargs):
     return tokens
 
 
+def _sample(
+    params,
+    data: Data,
+    *,
+    model: PaliVLAModel,
+    mesh: jax.sharding.Mesh,
+    out_sharding: P,
+    max_decode_len: int,
+    eos_token: int,
+    num_samples: int = 1,
+    sampler: str = "greedy",
+    temperature: float = None,
+    sensors_repeat: int = 1,
+    rng: jax.Array = None,
+):
+    """Sample token continuations in a single compiled loop.
+
+    Uses the decoding loop shared with the other sequence models (see
+    `big_vision.models.decoding.sample`), so unlike `_decode_with_logp` there
+    is no host sync per token. With `num_samples > 1` the samples of a prompt
+    share its KV cache. Returns tokens and their logp, both
+    [B, num_samples, max_decode_len].
+    """
+    replicate_sharding = jax.sharding.NamedSharding(mesh, P())
+    out_sharding = jax.sharding.NamedSharding(mesh, out_sharding)
+    if rng is None:
+        rng = jax.random.PRNGKey(0)
+
+    logits, cache = jax.jit(
+        _prefill_cache,
+        out_shardings=out_sharding,
+        static_argnames=("model", "max_decode_len", "sensors_repeat"),
+    )(
+        params,
+        data,
+        model=model,
+        max_decode_len=max_decode_len if num_samples == 1 else 0,
+        sensors_repeat=sensors_repeat,
+    )
+    return jax.jit(
+        _sample_loop,
+        out_shardings=replicate_sharding,
+        donate_argnums=2,
+        static_argnames=(
+            "model",
+            "max_decode_len",
+            "eos_token",
+            "num_samples",
+            "sampler",
+            "temperature",
+        ),
+    )(
+        params,
+        logits,
+        cache,
+        rng,
+        model=model,
+        max_decode_len=max_decode_len,
+        eos_token=eos_token,
+        num_samples=num_samples,
+        sampler=sampler,
+        temperature=temperature,
+    )
+
+
+def _sample_loop(
+    params, logits, cache, rng, *, model, max_decode_len, eos_token, num_samples, sampler, temperature
+):
+    def step_fn(tokens, cache):
+        logits, cache = _extend_cache(params, cache, tokens, model=model)
+        return logits[:, 0], cache
+
+    def sample_fn(logits, rng):
+        tokens, _ = _sample_logits(logits, sampler, temperature, rng=rng)
+        return tokens
+
+    tokens, logp = decoding.sample(
+        step_fn,
+        logits[:, 0],
+        flax.core.unfreeze(cache),
+        rng,
+        max_decode_len=max_decode_len,
+        eos_token=eos_token,
+        num_samples=num_samples,
+        expand_cache_fn=functools.partial(share_prefix_cache, suffix_len=max_decode_len),
+        sample_fn=sample_fn,
+    )
+    return jax.tree.map(
+        lambda x: einops.rearrange(x, "(b n) l -> b n l", n=num_samples), (tokens, logp)
+    )
+
+
 def _bon_repeat(tree, *, n):
     return jax.tree.map(lambda x: jnp.repeat(x, n, axis=0), tree)
 
@@ -208,7 +334,9 @@ def _bon_select(state, *, n, eos_token):
     return state
 
 
-def _decode_sample_output(state, logits, *, max_decode_len, sampler, temperature):
+def _decode_sample_output(
+    state, logits, rng, *, max_decode_len, sampler, temperature
+):
     if state is None:
         # Decode state keeps track of sampled tokens and their logp.
         bs = logits.shape[0]
@@ -219,10 +347,9 @@ def _decode_sample_output(state, logits, *, max_decode_len, sampler, temperature
         (seqlen, tokens, logp) = state
 
     # Sample tokens.
-    if sampler == "greedy":
-        sampled_tokens, sampled_logp = _sample_logits(logits, sampler=sampler)
-    else:
-        sampled_tokens, sampled_logp = _sample_logits(logits, sampler=sampler, temperature=temperature)
+    sampled_tokens, sampled_logp = _sample_logits(
+        logits, sampler=sampler, temperature=temperature, rng=rng
+    )
 
     # Update state with sampled outputs.
     new_len = seqlen + 1
@@ -260,6 +387,7 @@ def _prefill_cache(
     *,
     model: PaliVLAModel,
     max_decode_len: int,
+    sensors_repeat: int = 1,
 ):
     """Initialize the model cache for decoding with the prompts."""
     variables = {"params": params}
@@ -269,6 +397,7 @@ def _prefill_cache(
         data["sensors_mask"],
         data["prompt"],
         None,
+        sensors_repeat=sensors_repeat,
         method=model.embed_sensors_and_text,
     )
     last_logits, variables = model.apply(
@@ -295,17 +424,15 @@ def _extend_cache(
     return last_logits, variables["cache"]
 
 
-def _sample_logits(logits: jnp.ndarray, sampler: str, temperature: float = None):
+def _sample_logits(
+    logits: jnp.ndarray, sampler: str, temperature: float = None, *, rng: jax.Array
+):
     """Returns a sampled token and its logp from logits."""
-    # Note: Consider making it possible for evaluators to pass rng seed to
-    # decode functions. For now generate it from jax.lax and avoid evaluators
-    # having to deal with it.
-    rng = jax.random.PRNGKey(jax.lax.rng_uniform(0, np.iinfo(np.int32).max, tuple()))
-
     # Use Registry to support specifying things like:
-    #  "greedy", "nucleus(0.2)", "temperature(t=1.0)"
+    #  "greedy", "nucleus(0.2)", "nucleus(0.9, k=128)", "temperature(t=1.0)"
+    kwargs = {} if temperature is None else {"t": temperature}
     sampled_tokens = registry.Registry.lookup("palivla_sampler." + sampler)(
-        t=temperature, logits=logits, rng=rng
+        logits=logits, rng=rng, **kwargs
     )
 
     # Find the log probability (normalized logits) of selected tokens.
@@ -320,28 +447,40 @@ registry.Registry.global_registry().clear()
 
 
 @registry.Registry.register("palivla_sampler.greedy")
-def _greedy_sampling(t: float, *, logits: jnp.ndarray, rng: jnp.ndarray):
-    del rng
-    return jnp.argmax(logits, axis=-1)
+def _greedy_sampling(t: float = None, *, logits: jnp.ndarray, rng: jnp.ndarray):
+    del t
+    return decoding.sample_logits(logits, rng, temperature=0.0)
 
 
 @registry.Registry.register("palivla_sampler.temperature")
-def _temperature_sampling(t: float, *, logits: jnp.ndarray, rng: jnp.ndarray):
-    return jax.random.categorical(rng, logits / t)
+def _temperature_sampling(t: float = 1.0, *, logits: jnp.ndarray, rng: jnp.ndarray):
+    return decoding.sample_logits(logits, rng, temperature=t)
 
 
 @registry.Registry.register("palivla_sampler.nucleus")
 def _nucleus_sampling(
-    p: float, t: float = 1.0, *, logits: jnp.ndarray, rng: jnp.ndarray
+    p: float,
+    t: float = 1.0,
+    k: int = 256,
+    *,
+    logits: jnp.ndarray,
+    rng: jnp.ndarray,
+):
+    """Samples from the smallest set of top tokens with probability mass >= p.
+
+    Only the (approximate) top `k` tokens are candidates, so the vocabulary is
+    never sorted. If they hold less than `p` of the mass, all `k` are kept.
+    """
+    return decoding.sample_logits(
+        logits, rng, temperature=t, top_p=p, top_p_candidates=k
+    )
+
+
+@registry.Registry.register("palivla_sampler.top_k")
+def _top_k_sampling(
+    k: int, t: float = 1.0, *, logits: jnp.ndarray, rng: jnp.ndarray
 ):
-    logits = logits / t
-    neg_inf = np.array(-1.0e7)  # Effective negative infinity.
-    logits_sorted = jnp.sort(logits, axis=-1, descending=True)
-    sorted_cum_probs = jnp.cumsum(jax.nn.softmax(logits_sorted, axis=-1), axis=-1)
-    cutoff_index = jnp.sum(sorted_cum_probs < p, axis=-1, keepdims=True)
-    cutoff_logit = jnp.take_along_axis(logits_sorted, cutoff_index, axis=-1)
-    logits = jnp.where(logits < cutoff_logit, jnp.full_like(logits, neg_inf), logits)
-    return jax.random.categorical(rng, logits)
+    return decoding.sample_logits(logits, rng, temperature=t, top_k=k)
 
 
 def _beam_decode(
@@ -522,4 +661,137 @@ def _beam_sample_output(state, logits, cache, *, beam_size, max_decode_len, eos_
         lambda x: einops.rearrange(x, "b n ... -> (b n) ..."), (sampled_tokens, cache)
     )
 
-    return sampled_tokens, state, cache
\ No newline at end of file
+    return sampled_tokens, state, cache
+
+
+def _beam_search(
+    params,
+    data: Data,
+    *,
+    model: PaliVLAModel,
+    mesh: jax.sharding.Mesh,
+    out_sharding: P,
+    max_decode_len: int,
+    eos_token: int,
+    beam_size: int,
+    sensors_repeat: int = 1,
+):
+    """Beam search, compiled as a single loop without host syncs.
+
+    Same search as `_beam_decode`, but the beams of an example share its
+    prompt's KV cache (see `share_prefix_cache`), and are reordered after each
+    step by gathering the cache rows of their decoded tokens, instead of a
+    one-hot contraction over the whole cache. Returns the best sequences
+    [B, max_decode_len] (ending with EOS) and their log-probabilities.
+    """
+    replicate_sharding = jax.sharding.NamedSharding(mesh, P())
+    out_sharding = jax.sharding.NamedSharding(mesh, out_sharding)
+
+    logits, cache = jax.jit(
+        _prefill_cache,
+        out_shardings=out_sharding,
+        static_argnames=("model", "max_decode_len", "sensors_repeat"),
+    )(params, data, model=model, max_decode_len=0, sensors_repeat=sensors_repeat)
+    if "_mask" in data:
+        mask = data["_mask"]
+    else:
+        mask = jnp.ones_like(data["prompt"]["tokens"][:, 0], dtype=jnp.bool_)
+
+    return jax.jit(
+        _beam_search_loop,
+        out_shardings=replicate_sharding,
+        donate_argnums=2,
+        static_argnames=("model", "max_decode_len", "eos_token", "beam_size"),
+    )(
+        params,
+        logits,
+        cache,
+        mask,
+        model=model,
+        max_decode_len=max_decode_len,
+        eos_token=eos_token,
+        beam_size=beam_size,
+    )
+
+
+def _beam_search_loop(
+    params, logits, cache, mask, *, model, max_decode_len, eos_token, beam_size
+):
+    bs, k = logits.shape[0], beam_size
+    neg_inf = jnp.finfo(jnp.float32).min
+
+    # All beams start as copies of the prompt; only the first one is live, so
+    # that the first step expands it into `beam_size` distinct beams.
+    state = {
+        "step": jnp.zeros((), jnp.int32),
+        "logits": jnp.repeat(logits[:, 0], k, axis=0),  # [(b k), vocab]
+        "cache": flax.core.unfreeze(
+            share_prefix_cache(cache, n=k, suffix_len=max_decode_len)
+        ),
+        "tokens": jnp.zeros((bs, k, max_decode_len), jnp.int32),
+        "scores": jnp.full((bs, k), neg_inf).at[:, 0].set(0.0),
+        "best_tokens": jnp.zeros((bs, max_decode_len), jnp.int32),
+        "best_scores": jnp.full((bs,), neg_inf),
+    }
+
+    def cond_fn(state):
+        # Scores only decrease, so no live beam can beat a finished sequence
+        # once its score is below it.
+        done = jnp.max(state["scores"], axis=-1) < state["best_scores"]
+        done = jnp.logical_or(done, jnp.logical_not(mask))
+        return jnp.logical_and(state["step"] < max_decode_len, jnp.logical_not(jnp.all(done)))
+
+    def body_fn(state):
+        step, tokens, scores = state["step"], state["tokens"], state["scores"]
+        logp = jax.nn.log_softmax(state["logits"].astype(jnp.float32), axis=-1)
+        logp = einops.rearrange(logp, "(b k) v -> b k v", k=k)
+
+        # Consider every live beam ending now and keep the best finished one.
+        eos_scores = scores + logp[:, :, eos_token]
+        eos_beam = jnp.argmax(eos_scores, axis=-1)[:, None]
+        eos_score = jnp.take_along_axis(eos_scores, eos_beam, axis=1)[:, 0]
+        eos_tokens = jnp.take_along_axis(tokens, eos_beam[..., None], axis=1)[:, 0]
+        eos_tokens = eos_tokens.at[:, step].set(eos_token)
+        improved = eos_score > state["best_scores"]
+        best_tokens = jnp.where(improved[:, None], eos_tokens, state["best_tokens"])
+        best_scores = jnp.maximum(eos_score, state["best_scores"])
+
+        # The top `k` non-EOS continuations are among the top `k` of each beam.
+        logp = logp.at[:, :, eos_token].set(neg_inf)
+        topk_logp, topk_tokens = jax.lax.top_k(logp, k)  # [b, k, k]
+        candidate_scores = einops.rearrange(scores[..., None] + topk_logp, "b k c -> b (k c)")
+        scores, indices = jax.lax.top_k(candidate_scores, k)
+        parents = indices // k
+        new_tokens = jnp.take_along_axis(
+            einops.rearrange(topk_tokens, "b k c -> b (k c)"), indices, axis=-1
+        )
+        tokens = jnp.take_along_axis(tokens, parents[..., None], axis=1)
+        tokens = tokens.at[:, :, step].set(new_tokens)
+
+        flat_parents = (jnp.arange(bs)[:, None] * k + parents).reshape(-1)
+        cache = _reorder_beams(state["cache"], flat_parents)
+        logits, cache = _extend_cache(params, cache, new_tokens.reshape(-1, 1), model=model)
+        return {
+            "step": step + 1,
+            "logits": logits[:, 0],
+            "cache": flax.core.unfreeze(cache),
+            "tokens": tokens,
+            "scores": scores,
+            "best_tokens": best_tokens,
+            "best_scores": best_scores,
+        }
+
+    state = jax.lax.while_loop(cond_fn, body_fn, state)
+    return state["best_tokens"], state["best_scores"]
+
+
+def _reorder_beams(cache, indices):
+    """Gathers the per-beam cache rows at `indices`; the shared prefix stays."""
+    return {
+        name: (
+            _reorder_beams(x, indices)
+            if isinstance(x, Mapping)
+            else x if name.startswith("prefix_") else jnp.take(x, indices, axis=0)
+        )
+        for name, x in cache.items()
+    }
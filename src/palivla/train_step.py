@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Callable
 
 import chex
 import jax
@@ -6,6 +6,7 @@ import jax.numpy as jnp
 import optax
 
 from palivla.components.train_state import TrainState
+from palivla.optimizer import get_loss_scale
 from palivla import constants as c
 
 
@@ -34,25 +35,105 @@ def step_fn(
     batch: Any,
     key: chex.PRNGKey,
     train: bool,
+    build_gen: Callable | None = None,
 ):
+    """
+    One optimizer step. If the batch holds raw "actions" instead of "gen"
+    sequences, they are tokenized on device with `build_gen`.
+    """
+    loss_scale = get_loss_scale(train_state.optimizer_spec)
+
+    if "actions" in batch:
+        batch = {k: v for k, v in batch.items() if k != "actions"} | {
+            "gen": build_gen(batch["actions"])
+        }
+
     def loss_fn(params, batch, key: chex.PRNGKey):
-        logits, _ = train_state.apply_fn(
-            {"params": params},
-            batch["sensors"],
-            batch["sensors_mask"],
-            batch["prompt"],
-            batch["gen"],
-            train=train,
-        )
-        return compute_stats(
-            pred_logits=logits[..., :-1, :],
-            target_tokens=batch["gen"]["tokens"][..., 1:],
-            target_mask_loss=batch["gen"]["mask_loss"][..., 1:],
-        )
+        if "packed" in batch:
+            # Packed sequences come with their (per example) next-token targets.
+            logits, _ = train_state.apply_fn(
+                {"params": params},
+                batch["sensors"],
+                batch["sensors_mask"],
+                batch["packed"],
+                train=train,
+                method=train_state.model.call_packed,
+            )
+            loss, info = compute_stats(
+                pred_logits=logits,
+                target_tokens=batch["packed"]["targets"],
+                target_mask_loss=batch["packed"]["mask_loss"],
+            )
+        else:
+            logits, _ = train_state.apply_fn(
+                {"params": params},
+                batch["sensors"],
+                batch["sensors_mask"],
+                batch["prompt"],
+                batch["gen"],
+                train=train,
+            )
+            loss, info = compute_stats(
+                pred_logits=logits[..., :-1, :],
+                target_tokens=batch["gen"]["tokens"][..., 1:],
+                target_mask_loss=batch["gen"]["mask_loss"][..., 1:],
+            )
+        if loss_scale is not None:
+            loss = loss * loss_scale
+        return loss, info
     grad_fn = jax.grad(loss_fn, has_aux=True)
 
     key, dropout_key = jax.random.split(key)
     grads, info = grad_fn(train_state.params, batch, dropout_key)
+    if loss_scale is not None:
+        grads = jax.tree.map(lambda g: (g.astype(jnp.float32) / loss_scale).astype(g.dtype), grads)
     train_state, info["optimizer"] = train_state.apply_gradients_with_info(grads=grads)
 
     return train_state, info, key
+
+
+def eval_fn(
+    train_state: TrainState,
+    batch: Any,
+    *,
+    sensors_repeat: int = 1,
+):
+    """
+    Teacher-forced evaluation, without autoregressive decoding.
+
+    With `sensors_repeat > 1`, the text batch holds `sensors_repeat` groups of
+    prompts sharing the same sensors, and stats are reported per group. The
+    groups are laid out `(n b)` over the global batch, like the repeated sensors.
+    """
+    sensors_batch_size = jax.tree.leaves(batch["sensors"])[0].shape[0]
+    text_batch_size = batch["gen"]["tokens"].shape[0]
+    if text_batch_size != sensors_repeat * sensors_batch_size:
+        raise ValueError(
+            f"The text batch ({text_batch_size}) must hold sensors_repeat={sensors_repeat} "
+            f"groups of the sensors batch ({sensors_batch_size})"
+        )
+    logits, _ = train_state.apply_fn(
+        {"params": train_state.params},
+        batch["sensors"],
+        batch["sensors_mask"],
+        batch["prompt"],
+        batch["gen"],
+        train=False,
+        sensors_repeat=sensors_repeat,
+    )
+
+    def _per_group(x):
+        return x.reshape(sensors_repeat, -1, *x.shape[1:])
+
+    _, info = jax.vmap(
+        lambda logits, tokens, mask_loss: compute_stats(
+            pred_logits=logits,
+            target_tokens=tokens,
+            target_mask_loss=mask_loss,
+        )
+    )(
+        _per_group(logits[..., :-1, :]),
+        _per_group(batch["gen"]["tokens"][..., 1:]),
+        _per_group(batch["gen"]["mask_loss"][..., 1:]),
+    )
+    return info
@@ -1,4 +1,11 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 import jax
@@ -52,17 +59,208 @@ def host_broadcast_str(x: str | None) -> str:
     return decoded.rstrip()
 
 
-def gcs_recursive_copy(src: str, dst: str):
+def _list_files(src: str) -> list[str]:
+    """Lists all files under `src` (relative paths) with a single walk."""
     from tensorflow import io as io
 
-    io.gfile.makedirs(dst)
-    for item in io.gfile.listdir(src):
-        src_path = io.gfile.join(src, item)
-        dst_path = io.gfile.join(dst, item)
-        if io.gfile.isdir(src_path):
-            gcs_recursive_copy(src_path, dst_path)
-        else:
-            io.gfile.copy(src_path, dst_path, overwrite=True)
+    files = []
+    for dirpath, _, filenames in io.gfile.walk(src):
+        rel_dir = os.path.relpath(dirpath, src) if dirpath != src else ""
+        files.extend(os.path.join(rel_dir, f) for f in filenames)
+    return files
+
+
+def gcs_recursive_copy(src: str, dst: str, *, num_threads: int = 16):
+    """Copies the directory `src` to `dst`, copying files in parallel."""
+    from tensorflow import io as io
+
+    start = time.perf_counter()
+    files = _list_files(src)
+    for d in {os.path.dirname(f) for f in files} | {""}:
+        io.gfile.makedirs(io.gfile.join(dst, d))
+
+    def _copy(f):
+        io.gfile.copy(io.gfile.join(src, f), io.gfile.join(dst, f), overwrite=True)
+
+    with ThreadPoolExecutor(num_threads) as pool:
+        list(pool.map(_copy, files))
+    logging.info(
+        f"Copied {len(files)} files from {src} to {dst} in {time.perf_counter() - start:.2f}s"
+    )
+
+
+def _default_staging_cache_dir() -> str:
+    return os.environ.get(
+        "PALIVLA_STAGING_CACHE", os.path.expanduser("~/.cache/palivla/staging")
+    )
+
+
+def _default_staging_cache_max_bytes() -> int:
+    return int(os.environ.get("PALIVLA_STAGING_CACHE_MAX_BYTES", 64 << 30))
+
+
+@contextmanager
+def _host_lock(path: str, *, remove: bool = False):
+    """
+    Exclusive lock shared by all processes on this host.
+
+    With `remove`, the lock file is deleted on release. Processes that were
+    waiting on the deleted file notice it and lock the new file instead.
+    """
+    while True:
+        f = open(path, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+    try:
+        yield
+    finally:
+        if remove:
+            os.remove(path)
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+def _remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _evict_blobs(blob_dir: str, max_bytes: int) -> int:
+    """Removes the least recently used blobs until the rest take at most `max_bytes`."""
+    blobs = []
+    with os.scandir(blob_dir) as entries:
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in blobs)
+    num_evicted = 0
+    for _, size, path in sorted(blobs):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            num_evicted += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return num_evicted
+
+
+def cached_copy(
+    src: str,
+    dst: str,
+    *,
+    cache_dir: str | None = None,
+    max_cache_bytes: int | None = None,
+    num_threads: int = 16,
+):
+    """
+    Copies the directory `src` to the local directory `dst` through a local,
+    content-addressed cache.
+
+    Files are stored once under `cache_dir`/blobs by the sha256 of their
+    contents, and an index maps each remote file (path, size, mtime) to its
+    blob, so unchanged files are never downloaded twice and identical files
+    (e.g. the same tokenizer in many checkpoints) are stored once. Each remote
+    file is downloaded under its own lock: processes staging the same file wait
+    for a single download, while unrelated files are staged in parallel.
+
+    Blobs are read-only and copied (not linked) to `dst`, so writing to the
+    staged files can't corrupt the cache. The least recently used blobs are
+    evicted once the cache exceeds `max_cache_bytes` (default:
+    $PALIVLA_STAGING_CACHE_MAX_BYTES, or 64 GiB).
+    """
+    from tensorflow import io as io
+
+    cache_dir = cache_dir or _default_staging_cache_dir()
+    if max_cache_bytes is None:
+        max_cache_bytes = _default_staging_cache_max_bytes()
+    blob_dir = os.path.join(cache_dir, "blobs")
+    index_dir = os.path.join(cache_dir, "index")
+    os.makedirs(blob_dir, exist_ok=True)
+    os.makedirs(index_dir, exist_ok=True)
+
+    def _index_path(f):
+        stat = io.gfile.stat(io.gfile.join(src, f))
+        key = f"{io.gfile.join(src, f)}:{stat.length}:{stat.mtime_nsec}"
+        return os.path.join(index_dir, hashlib.sha256(key.encode()).hexdigest())
+
+    def _copy_cached(index_path, target):
+        """Copies the cached blob of a remote file to `target`, if there is one."""
+        try:
+            with open(index_path, "r") as index_file:
+                digest = index_file.read().strip()
+        except OSError:
+            return False
+        if len(digest) != 64:
+            return False  # not a complete sha256
+        blob = os.path.join(blob_dir, digest)
+        try:
+            shutil.copyfile(blob, target)
+        except FileNotFoundError:
+            return False  # evicted
+        # Marks the blob as recently used.
+        os.utime(blob)
+        return True
+
+    def _stage(f):
+        """Copies `f` to `dst` and returns whether it was already cached."""
+        index_path = _index_path(f)
+        target = os.path.join(dst, f)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if _copy_cached(index_path, target):
+            return True
+
+        with _host_lock(index_path + ".lock", remove=True):
+            # Another process may have downloaded it while we waited.
+            if _copy_cached(index_path, target):
+                return True
+
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+            os.close(fd)
+            fd, tmp_index_path = tempfile.mkstemp(dir=index_dir, suffix=".tmp")
+            os.close(fd)
+            try:
+                io.gfile.copy(io.gfile.join(src, f), tmp_path, overwrite=True)
+                digest = hashlib.sha256()
+                with open(tmp_path, "rb") as tmp_file:
+                    for chunk in iter(lambda: tmp_file.read(1 << 20), b""):
+                        digest.update(chunk)
+                shutil.copyfile(tmp_path, target)
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, os.path.join(blob_dir, digest.hexdigest()))
+                # Readers don't take the lock, so the index is replaced atomically.
+                with open(tmp_index_path, "w") as index_file:
+                    index_file.write(digest.hexdigest())
+                os.replace(tmp_index_path, index_path)
+            finally:
+                _remove_if_exists(tmp_path)
+                _remove_if_exists(tmp_index_path)
+        return False
+
+    start = time.perf_counter()
+    files = _list_files(src)
+    with ThreadPoolExecutor(num_threads) as pool:
+        cached = list(pool.map(_stage, files))
+
+    with _host_lock(os.path.join(cache_dir, ".evict.lock")):
+        num_evicted = _evict_blobs(blob_dir, max_cache_bytes)
+
+    logging.info(
+        f"Staged {len(files)} files from {src} ({sum(cached)} cached) in "
+        f"{time.perf_counter() - start:.2f}s, evicted {num_evicted} cached files"
+    )
 
 
 def flatten_wandb_dict(nested_dict: dict, prefix: str = "") -> dict:
@@ -99,11 +297,14 @@ def write_staging_directory(target_dir: str):
         gcs_recursive_copy(temp_dir, target_dir)
 
 @contextmanager
-def read_staging_directory(target_dir: str):
+def read_staging_directory(target_dir: str, *, cache_dir: str | None = None):
     """Stages a directory from GCS to a temporary directory. The temporary directory is deleted on exit.
 
+    Remote directories are staged through the host-local cache (see `cached_copy`).
+
     Args:
         target_dir: Directory to stage from (can be local or GCS path)
+        cache_dir: Local cache directory (defaults to $PALIVLA_STAGING_CACHE or ~/.cache/palivla/staging)
     
     Yields:
         Path to temporary staging directory
@@ -111,6 +312,9 @@ def read_staging_directory(target_dir: str):
     from tensorflow import io as io
 
     with tempfile.TemporaryDirectory() as temp_dir:
-        gcs_recursive_copy(target_dir, temp_dir)
+        if "://" in target_dir:
+            cached_copy(target_dir, temp_dir, cache_dir=cache_dir)
+        else:
+            gcs_recursive_copy(target_dir, temp_dir)
 
         yield temp_dir
\ No newline at end of file